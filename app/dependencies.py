@@ -1,9 +1,16 @@
 # app/dependencies.py
 from fastapi import Request, Depends
+from .utils.matchmaking import Matchmaker
+from .utils.sharding import ShardedUDPManager
 from .utils.udp_manager import UDPManager
-from typing import Annotated
+from typing import Annotated, Union
 
-def get_udp_manager(request: Request) -> UDPManager:
+def get_udp_manager(request: Request) -> Union[UDPManager, ShardedUDPManager]:
     return request.app.state.udp_manager
 
-UDPManagerDep = Annotated[UDPManager, Depends(get_udp_manager)]
\ No newline at end of file
+UDPManagerDep = Annotated[Union[UDPManager, ShardedUDPManager], Depends(get_udp_manager)]
+
+def get_matchmaker(request: Request) -> Matchmaker:
+    return request.app.state.matchmaker
+
+MatchmakerDep = Annotated[Matchmaker, Depends(get_matchmaker)]
\ No newline at end of file
@@ -1,8 +1,12 @@
+import logging
+import os
 from fastapi import FastAPI, Depends
 from typing import List
 
 from fastapi.concurrency import asynccontextmanager
-from .routers import lobbies, players
+from .routers import lobbies, metrics, players
+from .utils.matchmaking import MATCH_LOBBY_SIZE, MATCH_MIN_PLAYERS, Matchmaker
+from .utils.sharding import ShardedUDPManager
 from .utils.udp_manager import UDPManager
 
 udp_manager:UDPManager = None
@@ -10,9 +14,43 @@ udp_manager:UDPManager = None
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup: Initialize UDPManager
+    # UDP_ENGINE=asyncio serves every lobby socket from this event loop instead of threads
+    # UDP_BATCHING=1 coalesces small packets to binary peers into MTU sized datagrams
+    # UDP_SHARDS=<n> spreads lobbies over n worker processes, 0 for one per core
+    # LOG_LEVEL=DEBUG shows per-packet detail from the UDP servers
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
     print("Starting UDP Manager...")
-    udp_manager = UDPManager()
+    batching = os.getenv("UDP_BATCHING") == "1"
+    # UDP_DICTIONARY=<path> is the preset dictionary lobbies created with compression start from
+    dictionary_path = os.getenv("UDP_DICTIONARY")
+    dictionary = None
+    if dictionary_path:
+        with open(dictionary_path, "rb") as dictionary_file:
+            dictionary = dictionary_file.read()
+    # UDP_CAPTURE_DIR=<path> captures every lobby's datagrams there, for capture.replay
+    capture_dir = os.getenv("UDP_CAPTURE_DIR") or None
+    shards = os.getenv("UDP_SHARDS")
+    if shards is not None:
+        udp_manager = ShardedUDPManager(workers=int(shards) or None, batching=batching, dictionary=dictionary,
+                                        capture_dir=capture_dir)
+    else:
+        # UDP_SHARED_PORTS=<reliable>,<unreliable> serves every lobby from those two ports
+        shared_ports = os.getenv("UDP_SHARED_PORTS")
+        udp_manager = UDPManager(
+            engine=os.getenv("UDP_ENGINE", "thread"),
+            batching=batching,
+            shared_ports=tuple(int(port) for port in shared_ports.split(",")) if shared_ports else None,
+            port_workers=int(os.getenv("UDP_PORT_WORKERS", "1")),
+            dictionary=dictionary,
+            capture_dir=capture_dir,
+        )
     app.state.udp_manager = udp_manager
+    # MATCH_LOBBY_SIZE / MATCH_MIN_PLAYERS size matchmade lobbies and the group that opens one
+    app.state.matchmaker = Matchmaker(
+        udp_manager,
+        lobby_size=int(os.getenv("MATCH_LOBBY_SIZE", MATCH_LOBBY_SIZE)),
+        min_players=int(os.getenv("MATCH_MIN_PLAYERS", MATCH_MIN_PLAYERS)),
+    )
     
     yield
     
@@ -34,6 +72,11 @@ app.include_router(
     tags=["players"],
 )
 
+app.include_router(
+    metrics.router,
+    tags=["metrics"],
+)
+
 @app.get("/")
 async def root():
     return {"message": "Welcome to the Game Server API"}
\ No newline at end of file
@@ -1,5 +1,5 @@
 # app/models/lobby.py
-from typing import List
+from typing import List, Optional
 from pydantic import BaseModel
 from .player import Player
 
@@ -9,4 +9,6 @@ class Lobby(BaseModel):
     ip: str
     port_reliable: int
     port_unreliable: int
-    players: List[Player] = []
\ No newline at end of file
+    players: List[Player] = []
+    route_id: Optional[int] = None
+    max_players: Optional[int] = None
\ No newline at end of file
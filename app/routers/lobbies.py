@@ -1,15 +1,29 @@
-from fastapi import APIRouter, HTTPException, Depends, Request
-from typing import Dict, List
+import asyncio
+import base64
+import json
+
+from fastapi import APIRouter, HTTPException, Depends, Query, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from typing import Dict, List, Optional
 
 from app.utils.protocols.udp_client import GameServer
 from ..models.lobby import Lobby
 from ..models.player import Player
 from ..utils.udp_manager import UDPManager
 from ..dependencies import get_udp_manager, UDPManagerDep
+from ..utils.lobby_events import Subscription
+from ..utils.lobby_listing import LobbyListing, lobby_from_info
 from pydantic import BaseModel
 
 router = APIRouter()
 
+# Seconds between comments that keep idle event streams from being cut by proxies
+EVENT_KEEPALIVE = 15.0
+
+# Lobby browsers poll the list, so it is rebuilt only when a lobby or its players change
+listing = LobbyListing()
+
 # Response models
 class MessageResponse(BaseModel):
     message: str
@@ -22,10 +36,31 @@ class LobbyListResponse(BaseModel):
     lobbies: List[Lobby]
     
 
+def join_message(udp_manager, lobby_name: str, server_ports) -> str:
+    """Where a player who joined lobby_name connects: p<reliable>|<unreliable>l[r<route id>]"""
+    message = f"p{server_ports[0]}|{server_ports[1]}l"
+    route_id = udp_manager.route_of(lobby_name)
+    if route_id is not None:
+        # Shared ports: packets must start with the route prefix for this lobby
+        message += f"r{route_id}"
+    return message
+
+
 # Dependency for varifying lobby name isn't already take (TODO: expand to check for game account ID in the future)
 @router.post("/create", status_code=201)
-async def create_lobby(lobby_name, player_id, udp_manager: UDPManagerDep):
-    udp_manager.create_server(lobby_name, player_id)
+async def create_lobby(
+    lobby_name,
+    player_id,
+    udp_manager: UDPManagerDep,
+    tick_rate: Optional[float] = Query(None, gt=0, description="Snapshot rate in Hz for a server-authoritative lobby"),
+    interest_radius: Optional[float] = Query(None, gt=0, description="Only relay updates to players within this distance"),
+    max_players: Optional[int] = Query(None, gt=0, description="Players the lobby takes before joins are refused"),
+    jitter_ms: Optional[float] = Query(None, gt=0, le=500, description="Buffer each player's sequenced updates this long to smooth jitter"),
+    compression: bool = Query(False, description="Compress datagrams to players that ask for it"),
+):
+    udp_manager.create_server(lobby_name, player_id, tick_rate=tick_rate, interest_radius=interest_radius,
+                              max_players=max_players, jitter_delay=jitter_ms / 1000 if jitter_ms else None,
+                              compression=compression)
     return {"message": f"Lobby '{lobby_name}' created successfully."}
 
 @router.post("/join", response_model=MessageResponse)
@@ -34,16 +69,20 @@ async def join_lobby(
     player_id: str,
     udp_manager: UDPManagerDep
 ) -> MessageResponse:
-    if udp_manager.servers.get(lobby_name, {}) == {}:
+    if not udp_manager.has_lobby(lobby_name):
         raise HTTPException(status_code=404, detail="Lobby not found")
     
     player = Player(name=player_id, id=player_id)
 
-    if udp_manager.servers[lobby_name]:
-        server_ports = udp_manager.join_server(lobby_id=lobby_name, player_id=player_id)
+    if udp_manager.has_lobby(lobby_name):
+        try:
+            server_ports = udp_manager.join_server(lobby_id=lobby_name, player_id=player_id)
+        except ValueError as e:
+            # Full, already joined, or removed since the check above
+            raise HTTPException(status_code=409, detail=str(e))
         # Update activity when player joins
         udp_manager.update_activity(lobby_name)
-        return MessageResponse(message=f"p{server_ports[0]}|{server_ports[1]}l")
+        return MessageResponse(message=join_message(udp_manager, lobby_name, server_ports))
     
 
 # TODO: measure what methods perform better for disconnecting. Right now we have safe socket disconnecting
@@ -64,16 +103,96 @@ async def join_lobby(
 
 # lobbies.py
 @router.get("/list", response_model=List[Lobby])
-async def list_lobbies(udp_manager: UDPManagerDep) -> List[Lobby]:
-    lobbies = []
-    for lobby_name, server in udp_manager.servers.items():
-        lobby = Lobby(
-            name=lobby_name,
-            id=lobby_name,  # Assuming lobby ID is the same as the name
-            ip=server.host,  # Accessing the host attribute here
-            port_reliable=server.reliable_port,
-            port_unreliable=server.unreliable_port,
-            players=[Player(name=pid, id=pid) for pid in server.clients.keys()]
-        )
-        lobbies.append(lobby)
-    return lobbies
+async def list_lobbies(
+    request: Request,
+    udp_manager: UDPManagerDep,
+    prefix: Optional[str] = Query(None, description="Only lobbies whose name starts with this"),
+    free_slots: bool = Query(False, description="Only lobbies that can take another player"),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor of the previous page"),
+    limit: Optional[int] = Query(None, gt=0, le=1000, description="Lobbies per page, all by default"),
+):
+    """Lobbies sorted by name. Send the ETag back in If-None-Match to get a 304 while nothing changed."""
+    # Plain data from the manager, which may be gathering it from shard processes
+    listing.refresh(udp_manager)
+    headers = {"ETag": listing.etag, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*"
+                          or listing.etag in (tag.strip() for tag in if_none_match.split(","))):
+        return Response(status_code=304, headers=headers)
+    body, next_cursor = listing.page(prefix, free_slots, cursor, limit)
+    if next_cursor is not None:
+        headers["X-Next-Cursor"] = next_cursor
+    return Response(body, media_type="application/json", headers=headers)
+
+def server_sent_event(event_type: str, version: int, data: dict) -> str:
+    return f"id: {version}\nevent: {event_type}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+async def lobby_event_stream(udp_manager, subscription: Subscription):
+    """A snapshot of every lobby, then the changes after it, resyncing if the subscriber falls behind."""
+    while True:
+        subscription.reset()
+        version = udp_manager.listing_version()
+        lobbies = [jsonable_encoder(lobby_from_info(info)) for info in udp_manager.list_lobbies()]
+        yield server_sent_event("snapshot", version, {"version": version, "lobbies": lobbies})
+        while not subscription.overflowed:
+            try:
+                event = await asyncio.wait_for(subscription.get(), EVENT_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            if event["version"] <= version:
+                continue  # Already in the snapshot
+            if event["type"] == "lobby_created":
+                event = {**event, "lobby": jsonable_encoder(lobby_from_info(event["lobby"]))}
+            yield server_sent_event(event["type"], event["version"], event)
+
+
+@router.get("/events")
+async def lobby_events(udp_manager: UDPManagerDep):
+    """Server-sent events: a snapshot of every lobby, then lobby_created, lobby_removed,
+    player_joined, player_left and player_ready as they happen."""
+    events = udp_manager.events
+    subscription = events.subscribe(asyncio.get_running_loop())
+
+    async def stream():
+        try:
+            async for chunk in lobby_event_stream(udp_manager, subscription):
+                yield chunk
+        finally:
+            events.unsubscribe(subscription)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def compression_response(udp_manager, lobby_name: str, train: bool = False) -> dict:
+    if not udp_manager.has_lobby(lobby_name):
+        raise HTTPException(status_code=404, detail="Lobby not found")
+    try:
+        info = udp_manager.compression_info(lobby_name, train=train)
+    except ValueError as e:
+        # No compression on the lobby, nothing sampled to train on, or removed since the check
+        raise HTTPException(status_code=409, detail=str(e))
+    info["dictionary"] = base64.b64encode(info["dictionary"]).decode("ascii")
+    plain = info["compression_input_bytes"]
+    info["ratio"] = info["compression_output_bytes"] / plain if plain else None
+    return info
+
+
+@router.get("/{lobby_name}/compression")
+async def lobby_compression(lobby_name: str, udp_manager: UDPManagerDep) -> dict:
+    """The dictionary to connect with (base64, and its id for the connect packet), and how well compression pays."""
+    return compression_response(udp_manager, lobby_name)
+
+
+@router.post("/{lobby_name}/compression/train")
+async def train_lobby_compression(lobby_name: str, udp_manager: UDPManagerDep) -> dict:
+    """Build a new dictionary from the lobby's recent traffic. Players on the previous one keep it."""
+    return compression_response(udp_manager, lobby_name, train=True)
+
+
+@router.get("/stats")
+async def lobby_stats(udp_manager: UDPManagerDep) -> Dict[str, Dict[str, Dict[str, int]]]:
+    """Send queue depth and drop counters per lobby, to spot lobbies that are falling behind."""
+    return udp_manager.queue_stats()
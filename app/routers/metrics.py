@@ -0,0 +1,16 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from ..dependencies import UDPManagerDep
+from ..utils.protocols.metrics import render_prometheus
+
+router = APIRouter()
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics(udp_manager: UDPManagerDep):
+    """Per-lobby and per-peer network counters in Prometheus text format."""
+    return PlainTextResponse(render_prometheus(udp_manager.metrics_snapshot()),
+                             media_type=PROMETHEUS_CONTENT_TYPE)
@@ -1,6 +1,61 @@
-from fastapi import APIRouter, HTTPException
-from ..models.player import Player
+from fastapi import APIRouter, HTTPException, Query
+from typing import Optional
+
+from pydantic import BaseModel
+
+from ..dependencies import MatchmakerDep, UDPManagerDep
+from ..utils.matchmaking import Ticket
+from .lobbies import join_message
 
 router = APIRouter()
 
-# TODO: get some meaty potatoes in here
\ No newline at end of file
+
+class TicketResponse(BaseModel):
+    player_id: str
+    status: str
+    lobby: Optional[str] = None
+    # Same p<reliable>|<unreliable>l[r<route id>] connect info as /lobbies/join, once matched
+    message: Optional[str] = None
+
+
+def ticket_response(ticket: Ticket, udp_manager) -> TicketResponse:
+    response = TicketResponse(**ticket.as_dict())
+    if ticket.status == "matched":
+        response.message = join_message(udp_manager, ticket.lobby, ticket.ports)
+    return response
+
+
+@router.post("/matchmaking", response_model=TicketResponse)
+async def enqueue(
+    player_id: str,
+    udp_manager: UDPManagerDep,
+    matchmaker: MatchmakerDep,
+    region: Optional[str] = Query(None, description="Only match with players of this region"),
+    skill_bucket: Optional[int] = Query(None, description="Only match with players of this skill bucket"),
+) -> TicketResponse:
+    """Queue a player for a lobby. Poll the ticket until its status is matched."""
+    try:
+        ticket = matchmaker.enqueue(player_id, region=region, skill_bucket=skill_bucket)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return ticket_response(ticket, udp_manager)
+
+
+@router.get("/matchmaking/stats")
+async def matchmaking_stats(matchmaker: MatchmakerDep):
+    return matchmaker.stats()
+
+
+@router.get("/matchmaking/{player_id}", response_model=TicketResponse)
+async def ticket_status(player_id: str, udp_manager: UDPManagerDep, matchmaker: MatchmakerDep) -> TicketResponse:
+    ticket = matchmaker.status(player_id)
+    if ticket is None:
+        raise HTTPException(status_code=404, detail="Player is not queued")
+    return ticket_response(ticket, udp_manager)
+
+
+@router.delete("/matchmaking/{player_id}")
+async def leave_queue(player_id: str, matchmaker: MatchmakerDep):
+    if not matchmaker.cancel(player_id):
+        raise HTTPException(status_code=404, detail="Player is not queued")
+    return {"message": f"Player '{player_id}' left the queue."}
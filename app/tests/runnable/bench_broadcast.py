@@ -0,0 +1,76 @@
+"""Measure the cost of one broadcast as the lobby grows.
+
+Compares the old path (json.dumps per recipient) with encode-once fan-out
+through the handlers, for both wire formats. Datagrams go to real sockets
+on localhost, so the numbers include the send syscalls.
+
+Run with:
+    python -m app.tests.runnable.bench_broadcast [--rounds 2000]
+"""
+import argparse
+import json
+import socket
+import time
+
+from app.utils.protocols.codec import BINARY, JSON
+from app.utils.protocols.udp_handlers.reliable import ReliableHandler
+from app.utils.protocols.udp_handlers.unreliable import UnreliableHandler
+
+LOBBY_SIZES = (2, 4, 8, 16, 32, 64)
+PACKET = {"type": "update", "client_id": "player-0042", "client_index": 3,
+          "data": {"pos": [103.25, -4.5, 12.0], "vel": [1.5, 0.0, -0.25], "anim": "run", "hp": 87}}
+
+
+def legacy_broadcast(sock, packet: dict, addresses, reliable: bool, state: dict):
+    for address in addresses:
+        if reliable:
+            state["seq"] += 1
+            packet["seq"] = state["seq"]
+        sock.sendto(json.dumps(packet).encode('utf-8'), address)
+
+
+def time_per_broadcast(fn, rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - start) / rounds * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Broadcast fan-out benchmark")
+    parser.add_argument("--rounds", type=int, default=2000, help="Broadcasts per measurement")
+    args = parser.parse_args()
+
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.bind(("127.0.0.1", 0))
+    sinks = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(max(LOBBY_SIZES))]
+    for sink in sinks:
+        sink.bind(("127.0.0.1", 0))
+    reliable = ReliableHandler(sender)
+    unreliable = UnreliableHandler(sender)
+
+    print(f"{'clients':>8}{'channel':>12}{'legacy us':>12}{'json us':>12}{'binary us':>12}")
+    try:
+        for size in LOBBY_SIZES:
+            addresses = [sink.getsockname() for sink in sinks[:size]]
+            for name, handler, is_reliable in (("reliable", reliable, True), ("unreliable", unreliable, False)):
+                state = {"seq": 0}
+                legacy = time_per_broadcast(
+                    lambda: legacy_broadcast(sender, dict(PACKET), addresses, is_reliable, state), args.rounds)
+                results = []
+                for wire in (JSON, BINARY):
+                    results.append(time_per_broadcast(
+                        lambda: handler.send_body(wire.encode_body(PACKET), addresses), args.rounds))
+                    # Keep the retry thread from resending the benchmark's backlog
+                    reliable.peers.clear()
+                print(f"{size:>8}{name:>12}{legacy:>12.1f}{results[0]:>12.1f}{results[1]:>12.1f}")
+    finally:
+        reliable.stop()
+        unreliable.stop()
+        sender.close()
+        for sink in sinks:
+            sink.close()
+
+
+if __name__ == '__main__':
+    main()
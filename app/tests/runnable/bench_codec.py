@@ -0,0 +1,61 @@
+"""Compare the wire codecs on bytes per packet and encode/decode time.
+
+Run with:
+    python -m app.tests.runnable.bench_codec [--number 20000]
+"""
+import argparse
+import json
+import timeit
+
+from app.utils.protocols.codec import BINARY, JSON
+
+SAMPLE_PACKETS = {
+    "connect": {"type": "connect", "client_id": "player-0042", "client_index": 3, "seq": 1},
+    "update": {"type": "update", "client_id": "player-0042", "client_index": 3,
+               "data": {"x": 103.25, "y": -4.5, "rot": 90}},
+    "update_large": {"type": "update", "client_id": "player-0042", "client_index": 3,
+                     "data": {"pos": [103.25, -4.5, 12.0], "vel": [1.5, 0.0, -0.25],
+                              "anim": "run", "hp": 87, "inventory": list(range(16))}},
+    "ack": {"type": "ack", "client_id": "player-0042", "client_index": 3, "seq": 18234, "ack": 18234},
+}
+
+
+def legacy_encode(packet: dict) -> bytes:
+    return json.dumps(packet).encode('utf-8')
+
+
+def legacy_decode(data: bytes) -> dict:
+    return json.loads(data.decode('utf-8'))
+
+
+def measure(encode, decode, packet: dict, number: int) -> dict:
+    data = encode(packet)
+    encode_s = min(timeit.repeat(lambda: encode(packet), number=number, repeat=3))
+    decode_s = min(timeit.repeat(lambda: decode(data), number=number, repeat=3))
+    return {
+        "bytes": len(data),
+        "encode_us": encode_s / number * 1e6,
+        "decode_us": decode_s / number * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Wire codec benchmark")
+    parser.add_argument("--number", type=int, default=20000, help="Iterations per measurement")
+    args = parser.parse_args()
+
+    paths = {
+        "legacy json": (legacy_encode, legacy_decode),
+        "json": (JSON.encode, JSON.decode),
+        "binary": (BINARY.encode, BINARY.decode),
+    }
+    print(f"{'packet':<14}{'codec':<14}{'bytes':>8}{'encode us':>12}{'decode us':>12}")
+    for name, packet in SAMPLE_PACKETS.items():
+        for codec_name, (encode, decode) in paths.items():
+            result = measure(encode, decode, packet, args.number)
+            print(f"{name:<14}{codec_name:<14}{result['bytes']:>8}"
+                  f"{result['encode_us']:>12.2f}{result['decode_us']:>12.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Receive-and-decode cost per datagram: recvfrom versus the receive ring.
+
+Each round queues a burst of datagrams on a loopback socket, then times
+draining and decoding it, so only the receive path is measured. The ring
+saves the per-datagram bytes allocation, which matters more as packets grow.
+
+Run with:
+    python -m app.tests.runnable.bench_receive [--burst 2000] [--rounds 20]
+"""
+import argparse
+import socket
+import time
+
+from app.utils.protocols.codec import BINARY, detect
+from app.utils.protocols.receive import RECV_BUFFER_SIZE, ReceiveRing
+
+PACKETS = {
+    "small": {"type": "update", "client_index": 3, "seq": 1, "data": {"x": 103.25, "y": -4.5, "rot": 90}},
+    "1 KiB": {"type": "update", "client_index": 3, "seq": 1, "data": {"blob": "x" * 1000}},
+}
+
+
+def recvfrom_path(sock: socket.socket):
+    data, address = sock.recvfrom(RECV_BUFFER_SIZE)
+    detect(data).decode(data)
+
+
+def make_ring_path():
+    ring = ReceiveRing()
+
+    def ring_path(sock: socket.socket):
+        data, address = ring.recvfrom(sock)
+        detect(data).decode(data)
+    return ring_path
+
+
+def fill(sender: socket.socket, address, data: bytes, burst: int):
+    for _ in range(burst):
+        sender.sendto(data, address)
+
+
+def run(receive, packet: dict, burst: int, rounds: int) -> float:
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+    receiver.bind(("127.0.0.1", 0))
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    address = receiver.getsockname()
+    data = BINARY.encode(packet)
+    elapsed = 0.0
+    received = 0
+    try:
+        receiver.settimeout(0.2)
+        for _ in range(rounds):
+            fill(sender, address, data, burst)
+            start = time.perf_counter()
+            try:
+                for _ in range(burst):
+                    receive(receiver)
+                    received += 1
+            except socket.timeout:
+                pass  # The kernel dropped part of the burst
+            elapsed += time.perf_counter() - start
+    finally:
+        receiver.close()
+        sender.close()
+    return elapsed / max(received, 1) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Receive path benchmark")
+    parser.add_argument("--burst", type=int, default=2000, help="Datagrams queued per round")
+    parser.add_argument("--rounds", type=int, default=20, help="Rounds per path")
+    args = parser.parse_args()
+
+    print(f"{'packet':<10}{'path':<12}{'us/packet':>12}")
+    for packet_name, packet in PACKETS.items():
+        for name, receive in (("recvfrom", recvfrom_path), ("ring", make_ring_path())):
+            print(f"{packet_name:<10}{name:<12}{run(receive, packet, args.burst, args.rounds):>12.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""Lock hold times of the retransmit path with many packets in flight.
+
+The old handler woke every 100 ms and scanned every pending packet while
+holding ack_lock. The current one arms a single retransmit timer per peer
+and indexes that peer's pending packets by deadline in a heap, so a timer
+run only touches packets whose deadline has passed. Both are driven with
+the same number of in-flight packets and a trickle of acks, the heap once
+spread over many peers and once with every packet in flight to one peer.
+
+Run with:
+    python -m app.tests.runnable.bench_retransmit [--in-flight 100000] [--seconds 3]
+"""
+import argparse
+import json
+import statistics
+import threading
+import time
+
+from app.utils.protocols.codec import BINARY
+from app.utils.protocols.udp_handlers.reliable import ReliableHandler
+
+# Peers the in-flight packets are spread over in the spread run
+PEERS = 100
+
+
+class NullSocket:
+    def sendto(self, data, address):
+        pass
+
+    def sendmsg(self, buffers, ancdata, flags, address):
+        pass
+
+
+class TimedLock:
+    """A lock that records how long every acquisition was held."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.holds = []
+        self.acquired_at = 0.0
+
+    def __enter__(self):
+        self.lock.acquire()
+        self.acquired_at = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.holds.append(time.perf_counter() - self.acquired_at)
+        self.lock.release()
+
+
+def legacy_run(in_flight: int, seconds: float) -> TimedLock:
+    """The pre-scheduler algorithm: a 100 ms poll scanning every pending packet."""
+    lock = TimedLock()
+    sock = NullSocket()
+    packet = {"type": "update", "client_id": "player", "data": {"x": 1}}
+    address = ("127.0.0.1", 9)
+    now = time.time()
+    # Spread send times over the last second so a slice expires on every poll
+    pending = {seq: (packet, address, now - (seq % 1000) / 1000) for seq in range(in_flight)}
+
+    end = time.time() + seconds
+    while time.time() < end:
+        with lock:
+            current_time = time.time()
+            for seq_num, (pkt, addr, timestamp) in list(pending.items()):
+                if current_time - timestamp > 1.0:
+                    sock.sendto(json.dumps(pkt).encode('utf-8'), addr)
+                    pending[seq_num] = (pkt, addr, current_time)
+        time.sleep(0.1)
+    return lock
+
+
+def heap_run(in_flight: int, seconds: float, peers: int) -> TimedLock:
+    handler = ReliableHandler(NullSocket())
+    handler.ack_lock = lock = TimedLock()
+    body = BINARY.encode_body({"type": "update", "client_index": 1, "data": {"x": 1}})
+    addresses = [("127.0.0.1", 10000 + i) for i in range(peers)]
+    try:
+        for _ in range(in_flight // peers):
+            handler.send_body(body, addresses)
+        lock.holds.clear()
+
+        # Ack a slice of every peer's window while retransmit deadlines come due
+        end = time.time() + seconds
+        ack = 1
+        while time.time() < end:
+            for address in addresses:
+                handler.process_ack(address, ack, 0xFFFFFFFF)
+            ack += 33
+            time.sleep(0.01)
+    finally:
+        handler.stop()
+    return lock
+
+
+def report(name: str, lock: TimedLock, seconds: float):
+    holds = sorted(lock.holds)
+    if not holds:
+        print(f"{name:<10} no lock acquisitions")
+        return
+    p99 = holds[int(len(holds) * 0.99) - 1] if len(holds) >= 100 else holds[-1]
+    print(f"{name:<10}{len(holds):>10}{statistics.mean(holds) * 1e6:>12.1f}"
+          f"{p99 * 1e6:>12.1f}{holds[-1] * 1e6:>14.1f}{sum(holds) / seconds * 1e3:>14.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Retransmit scheduler lock benchmark")
+    parser.add_argument("--in-flight", type=int, default=100000, help="Unacknowledged packets")
+    parser.add_argument("--seconds", type=float, default=3.0, help="Duration of each run")
+    args = parser.parse_args()
+
+    print(f"{'impl':<10}{'holds':>10}{'mean us':>12}{'p99 us':>12}{'max us':>14}{'held ms/s':>14}")
+    report("poll+scan", legacy_run(args.in_flight, args.seconds), args.seconds)
+    report("heap", heap_run(args.in_flight, args.seconds, PEERS), args.seconds)
+    report("heap 1", heap_run(args.in_flight, args.seconds, 1), args.seconds)
+
+
+if __name__ == '__main__':
+    main()
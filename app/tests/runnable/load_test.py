@@ -0,0 +1,377 @@
+"""Headless load test: N lobbies, M simulated clients each, JSON results.
+
+The server is a UDPManager, either in this process or in a child process
+(--subprocess) so its CPU time and memory are measured on their own. Every
+client connects over the reliable port, then sends updates at --rate Hz
+carrying their send time. Peers that get an update relayed (or see it in a
+tick-mode snapshot) record the end-to-end latency.
+
+Loss and latency are simulated by an impairment shim wrapped around each
+client's socket. It applies in both directions, so a --loss of 0.05 drops
+about 5% of datagrams on the way in and again on the way out. --seed makes
+the loss pattern and send offsets reproducible.
+
+Results go to stdout (or --output) as one JSON object so runs can be
+compared across commits. Progress goes to stderr.
+
+Run with:
+    python -m app.tests.runnable.load_test [--lobbies 4] [--clients 8] [--rate 20]
+        [--duration 10] [--loss 0.0] [--latency 0] [--jitter 0] [--codec json]
+        [--engine thread] [--batching] [--tick-rate HZ] [--jitter-buffer MS] [--shared-ports]
+        [--subprocess] [--output results.json]
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from typing import List, Optional, Tuple
+
+from app.utils.protocols import codec as codecs
+from app.utils.protocols.shared_port import route_prefix
+from app.utils.udp_manager import UDPManager
+
+SERVER_HOST = "127.0.0.1"
+CONNECT_RETRY = 0.5
+CONNECT_TIMEOUT = 10.0
+# Seconds to keep receiving after the last update was sent
+DRAIN = 0.5
+
+
+class Impairment:
+    """Drops and delays datagrams with a seeded RNG, one direction at a time."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, rng: random.Random,
+                 loss: float = 0.0, latency: float = 0.0, jitter: float = 0.0):
+        self.loop = loop
+        self.rng = rng
+        self.loss = loss
+        self.latency = latency
+        self.jitter = jitter
+        self.dropped = 0
+
+    def deliver(self, callback, *args):
+        if self.loss and self.rng.random() < self.loss:
+            self.dropped += 1
+            return
+        delay = self.latency + (self.rng.uniform(-self.jitter, self.jitter) if self.jitter else 0.0)
+        if delay > 0:
+            self.loop.call_later(delay, callback, *args)
+        else:
+            callback(*args)
+
+
+class SimulatedClient(asyncio.DatagramProtocol):
+    """One player: a single socket talking to both of its lobby's ports."""
+
+    def __init__(self, client_id: str, lobby: dict, codec: codecs.Codec, impairment: Impairment,
+                 latencies: List[float]):
+        self.client_id = client_id
+        self.lobby = lobby
+        self.codec = codec
+        self.impairment = impairment
+        self.latencies = latencies
+        self.prefix = route_prefix(lobby["route_id"]) if lobby.get("route_id") is not None else b""
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self.connected = asyncio.Event()
+        self.snapshot_ack = 0
+        # Latest update number seen per subject, snapshots repeat states they were not acked for
+        self.seen = {}
+        self.sent = 0
+        self.received = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def send(self, packet: dict, reliable: bool):
+        port = self.lobby["reliable_port"] if reliable else self.lobby["unreliable_port"]
+        self.impairment.deliver(self._write, self.prefix + self.codec.encode(packet), port)
+
+    def _write(self, data: bytes, port: int):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.sendto(data, (SERVER_HOST, port))
+
+    def datagram_received(self, data: bytes, address: Tuple[str, int]):
+        self.impairment.deliver(self.on_datagram, data, address[1] == self.lobby["reliable_port"])
+
+    def on_datagram(self, data: bytes, reliable: bool):
+        arrived = time.perf_counter()
+        codec = codecs.detect(data)
+        if codec is codecs.BINARY and codec.is_batch(data):
+            frames = codec.unpack_batch(data)
+        else:
+            frames = [data]
+        for frame in frames:
+            packet = codec.decode(frame)
+            if codec is codecs.BINARY:
+                reliable = bool(codec.flags_of(frame) & codecs.FLAG_RELIABLE)
+            if reliable and packet.get("seq"):
+                self.send({"type": "ack", "ack": packet["seq"], "ack_bits": 0, "client_id": self.client_id},
+                          reliable=True)
+            self.on_packet(packet, arrived)
+
+    def on_packet(self, packet: dict, arrived: float):
+        packet_type = packet.get("type")
+        if packet_type == "connect" and packet.get("client_id") == self.client_id:
+            self.connected.set()
+        elif packet_type == "update":
+            self.record(packet.get("data"), arrived)
+        elif packet_type == "snapshot":
+            self.snapshot_ack = max(self.snapshot_ack, packet.get("tick", 0))
+            for subject, state in packet.get("states", {}).items():
+                if isinstance(state, dict) and state.get("x", -1) > self.seen.get(subject, -1):
+                    self.seen[subject] = state["x"]
+                    self.record(state, arrived)
+
+    def record(self, data, arrived: float):
+        if isinstance(data, dict) and "sent" in data:
+            self.received += 1
+            self.latencies.append(arrived - data["sent"])
+
+    async def connect(self):
+        deadline = time.monotonic() + CONNECT_TIMEOUT
+        while not self.connected.is_set():
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{self.client_id} could not connect")
+            self.send({"type": "connect", "client_id": self.client_id, "seq": 1}, reliable=True)
+            try:
+                await asyncio.wait_for(self.connected.wait(), CONNECT_RETRY)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self, rate: float, until: float, offset: float):
+        await asyncio.sleep(offset)
+        interval = 1 / rate
+        next_send = time.perf_counter()
+        while next_send < until:
+            # Sequenced, so the server drops updates the shim reordered
+            packet = {"type": "update", "client_id": self.client_id, "seq": self.sent + 1,
+                      "data": {"x": self.sent, "sent": time.perf_counter()}}
+            if self.snapshot_ack:
+                packet["snapshot_ack"] = self.snapshot_ack
+            self.send(packet, reliable=False)
+            self.sent += 1
+            next_send += interval
+            await asyncio.sleep(max(0.0, next_send - time.perf_counter()))
+
+    def disconnect(self):
+        self._write(self.prefix + self.codec.encode({"type": "disconnect", "client_id": self.client_id}),
+                    self.lobby["reliable_port"])
+
+
+def start_server(args) -> Tuple[UDPManager, List[dict]]:
+    manager = UDPManager(engine=args.engine, batching=args.batching,
+                         shared_ports=(0, 0) if args.shared_ports else None)
+    lobbies = []
+    for index in range(args.lobbies):
+        name = f"load-{index}"
+        manager.create_server(name, "load", tick_rate=args.tick_rate,
+                              jitter_delay=args.jitter_buffer / 1000 if args.jitter_buffer else None)
+        entry = next(lobby for lobby in manager.list_lobbies() if lobby["name"] == name)
+        lobbies.append({key: entry[key] for key in ("name", "reliable_port", "unreliable_port", "route_id")})
+    return manager, lobbies
+
+
+COUNTERS = ("packets_in", "packets_out", "bytes_in", "bytes_out", "retransmits", "stale_dropped")
+
+
+def server_counters(manager: UDPManager) -> dict:
+    totals = dict.fromkeys(COUNTERS, 0)
+    for snapshot in manager.metrics_snapshot().values():
+        for key in COUNTERS:
+            totals[key] += snapshot[key]
+    totals["cpu_seconds"] = time.process_time()
+    return totals
+
+
+def server_report(manager: UDPManager, start: dict) -> dict:
+    """What the server did since the start counters were taken, connects excluded."""
+    end = server_counters(manager)
+    report = {key: end[key] - start[key] for key in end}
+    report["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return report
+
+
+async def serve_child(args):
+    """--serve: host the lobbies and take start/stop cues on stdin."""
+    loop = asyncio.get_running_loop()
+    manager, lobbies = start_server(args)
+    # stdout is the pipe to the parent, the manager's own prints went to stderr
+    print(json.dumps(lobbies), file=sys.__stdout__, flush=True)
+    await loop.run_in_executor(None, sys.stdin.readline)
+    start = server_counters(manager)
+    await loop.run_in_executor(None, sys.stdin.readline)
+    report = server_report(manager, start)
+    manager.stop_all_servers()
+    print(json.dumps(report), file=sys.__stdout__, flush=True)
+
+
+class ChildServer:
+    def __init__(self, args):
+        command = [sys.executable, "-m", "app.tests.runnable.load_test", "--serve",
+                   "--lobbies", str(args.lobbies), "--engine", args.engine]
+        if args.batching:
+            command.append("--batching")
+        if args.shared_ports:
+            command.append("--shared-ports")
+        if args.tick_rate:
+            command.extend(["--tick-rate", str(args.tick_rate)])
+        if args.jitter_buffer:
+            command.extend(["--jitter-buffer", str(args.jitter_buffer)])
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        self.lobbies = json.loads(self.process.stdout.readline())
+
+    def start(self):
+        self.process.stdin.write("start\n")
+        self.process.stdin.flush()
+
+    def stop(self) -> dict:
+        self.process.stdin.write("stop\n")
+        self.process.stdin.flush()
+        report = json.loads(self.process.stdout.readline())
+        self.process.wait(timeout=10)
+        return report
+
+
+def percentile_ms(values: List[float], fraction: float) -> Optional[float]:
+    """Nearest-rank percentile of sorted seconds, in milliseconds."""
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, round(fraction * len(values)) - 1))
+    return values[index] * 1000
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args) -> dict:
+    loop = asyncio.get_running_loop()
+    rng = random.Random(args.seed)
+    codec = codecs.get_codec(args.codec)
+    if args.subprocess:
+        child = ChildServer(args)
+        manager, lobbies = None, child.lobbies
+    else:
+        child = None
+        manager, lobbies = start_server(args)
+
+    latencies: List[float] = []
+    clients: List[SimulatedClient] = []
+    impairments = []
+    try:
+        for lobby in lobbies:
+            for index in range(args.clients):
+                impairment = Impairment(loop, random.Random(rng.random()), args.loss,
+                                        args.latency / 1000, args.jitter / 1000)
+                impairments.append(impairment)
+                client = SimulatedClient(f"{lobby['name']}-player-{index}", lobby, codec, impairment, latencies)
+                await loop.create_datagram_endpoint(lambda client=client: client, local_addr=(SERVER_HOST, 0))
+                clients.append(client)
+        print(f"Connecting {len(clients)} clients to {len(lobbies)} lobbies...", file=sys.stderr)
+        await asyncio.gather(*(client.connect() for client in clients))
+        latencies.clear()
+
+        print(f"Sending for {args.duration}s...", file=sys.stderr)
+        if child is not None:
+            child.start()
+        start = server_counters(manager) if manager is not None else None
+        started = time.perf_counter()
+        until = started + args.duration
+        await asyncio.gather(*(client.run(args.rate, until, rng.uniform(0, 1 / args.rate)) for client in clients))
+        await asyncio.sleep(DRAIN + args.latency / 1000 * 2)
+        elapsed = time.perf_counter() - started
+        server = child.stop() if child is not None else server_report(manager, start)
+    finally:
+        for client in clients:
+            client.disconnect()
+            client.transport.close()
+        if manager is not None:
+            manager.stop_all_servers()
+
+    sent = sum(client.sent for client in clients)
+    received = sum(client.received for client in clients)
+    latencies.sort()
+    packets = server["packets_in"] + server["packets_out"]
+    result = {
+        "commit": git_commit(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "serve")},
+        "elapsed_seconds": elapsed,
+        "updates_sent": sent,
+        "updates_received": received,
+        "datagrams_dropped_by_shim": sum(impairment.dropped for impairment in impairments),
+        "throughput": {
+            "updates_sent_per_second": sent / elapsed,
+            "updates_received_per_second": received / elapsed,
+            "server_packets_in_per_second": server["packets_in"] / elapsed,
+            "server_packets_out_per_second": server["packets_out"] / elapsed,
+            "server_bytes_out_per_second": server["bytes_out"] / elapsed,
+        },
+        "latency_ms": {
+            "p50": percentile_ms(latencies, 0.5),
+            "p99": percentile_ms(latencies, 0.99),
+            "max": percentile_ms(latencies, 1.0),
+            "mean": statistics.mean(latencies) * 1000 if latencies else None,
+        },
+        "server": {
+            "retransmits": server["retransmits"],
+            "stale_dropped": server["stale_dropped"],
+            "cpu_seconds": server["cpu_seconds"],
+            "cpu_us_per_packet": server["cpu_seconds"] / packets * 1e6 if packets else None,
+            # In process the clients run on the same interpreter and are included
+            "cpu_scope": "server" if child is not None else "process",
+            "max_rss_kb": server["max_rss_kb"],
+        },
+    }
+    if args.tick_rate is None:
+        # Relayed updates go to every client of the lobby, the sender included
+        result["delivery_ratio"] = received / (sent * args.clients) if sent else None
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="UDP server load test")
+    parser.add_argument("--lobbies", type=int, default=4, help="Lobbies to create")
+    parser.add_argument("--clients", type=int, default=8, help="Simulated clients per lobby")
+    parser.add_argument("--rate", type=float, default=20.0, help="Updates per second per client")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of sending")
+    parser.add_argument("--loss", type=float, default=0.0, help="Drop probability per datagram and direction")
+    parser.add_argument("--latency", type=float, default=0.0, help="One-way delay added by the shim, ms")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Uniform +/- jitter on the delay, ms")
+    parser.add_argument("--codec", choices=tuple(codecs.CODECS), default="json", help="Client wire format")
+    parser.add_argument("--engine", choices=("thread", "asyncio"), default="thread", help="Server engine")
+    parser.add_argument("--batching", action="store_true", help="Coalesce server sends to binary peers")
+    parser.add_argument("--tick-rate", type=float, default=None, help="Run authoritative lobbies at this Hz")
+    parser.add_argument("--jitter-buffer", type=float, default=None, help="Server jitter buffer per sender, ms")
+    parser.add_argument("--shared-ports", action="store_true", help="Serve every lobby from two shared ports")
+    parser.add_argument("--subprocess", action="store_true", help="Run the server in a child process")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for loss, jitter and send offsets")
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Keep stdout for the results, the manager logs lobby lifecycle with print
+    with contextlib.redirect_stdout(sys.stderr):
+        if args.serve:
+            asyncio.run(serve_child(args))
+            return
+        result = asyncio.run(run(args))
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Replay a captured lobby into a fresh server and report what it cost.
+
+Captures are written by lobbies of a manager started with UDP_CAPTURE_DIR.
+The inbound datagrams are fed to a new thread engine lobby on loopback in
+their captured order, at the captured pace or faster, so a change can be
+measured against the same real traffic before and after. What the lobby
+sends goes to stand-in loopback addresses nobody listens on.
+
+Run with:
+    python -m app.tests.runnable.replay_capture <capture> [--speed 10] [--rounds 3] [--tick-rate 30]
+
+--speed 0 feeds datagrams back to back, which measures handling cost
+rather than behaviour under the original timing.
+"""
+import argparse
+import socket
+import time
+
+from app.utils.protocols.capture import read_capture, replay
+from app.utils.protocols.udp_client import GameServer
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run(records, speed: float, tick_rate, batching: bool, compression: bool) -> dict:
+    server = GameServer("127.0.0.1", free_port(), free_port(), tick_rate=tick_rate, batching=batching,
+                        compression=compression, client_timeout=None, heartbeat_interval=None)
+    try:
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        fed = replay(server, records, speed)
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+        # Let the send threads drain before the counters are read
+        time.sleep(0.2)
+        snapshot = server.metrics_snapshot()
+    finally:
+        server.stop()
+    ticks = snapshot["tick_seconds"]
+    return {
+        "fed": fed,
+        "seconds": elapsed,
+        "cpu_us": cpu / max(fed, 1) * 1e6,
+        "packets_out": snapshot["packets_out"],
+        "bytes_out": snapshot["bytes_out"],
+        "tick_ms": ticks["sum"] / ticks["count"] * 1e3 if ticks["count"] else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Capture replay benchmark")
+    parser.add_argument("capture", help="Capture file written by a lobby")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed, 0 for back to back")
+    parser.add_argument("--rounds", type=int, default=3, help="Replays, each into a new lobby")
+    parser.add_argument("--tick-rate", type=float, default=None, help="Replay into a tick mode lobby")
+    parser.add_argument("--batching", action="store_true", help="Replay into a batching lobby")
+    parser.add_argument("--compression", action="store_true", help="Replay into a lobby with compression")
+    args = parser.parse_args()
+
+    records = list(read_capture(args.capture))
+    inbound = sum(1 for record in records if not record.outbound)
+    span = records[-1].time - records[0].time if records else 0.0
+    print(f"{len(records)} datagrams captured over {span:.1f}s, {inbound} inbound")
+
+    print(f"{'round':<8}{'fed':>8}{'seconds':>10}{'cpu us/dgram':>14}{'packets out':>13}"
+          f"{'bytes out':>12}{'tick ms':>9}")
+    for index in range(args.rounds):
+        result = run(records, args.speed, args.tick_rate, args.batching, args.compression)
+        print(f"{index + 1:<8}{result['fed']:>8}{result['seconds']:>10.2f}{result['cpu_us']:>14.1f}"
+              f"{result['packets_out']:>13}{result['bytes_out']:>12}{result['tick_ms']:>9.3f}")
+
+
+if __name__ == '__main__':
+    main()
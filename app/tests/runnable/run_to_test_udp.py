@@ -68,6 +68,8 @@ class UDPTestClient:
                 packet = json.loads(data.decode('utf-8'))
                 self._handle_packet(packet)
             except socket.timeout:
+                # Nothing heard for a second: keep the server from timing us out
+                self._send_packet({"type": "heartbeat", "client_id": self.client_id})
                 continue
             except Exception as e:
                 print(f"Error receiving packet: {e}")
@@ -83,8 +85,10 @@ class UDPTestClient:
             print(f"Client {client_id} disconnected")
         elif packet_type == 'update':
             print(f"Update from {client_id}: {packet.get('data')}")
+        elif packet_type == 'heartbeat':
+            pass
         elif packet_type == 'ack':
-            print(f"Received ack for sequence {packet.get('seq')}")
+            print(f"Received ack for sequence {packet.get('ack', packet.get('seq'))}")
 
 def main():
     parser = argparse.ArgumentParser(description='UDP Test Client')
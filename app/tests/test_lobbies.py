@@ -1,6 +1,12 @@
+import asyncio
+import json
+import socket
+
 import pytest
 from app.models.lobby import Lobby
 from app.models.player import Player
+from app.routers.lobbies import lobby_event_stream
+from app.utils.udp_manager import UDPManager
 
 def test_create_lobby(client, mock_udp_manager):
     """Test lobby creation"""
@@ -52,3 +58,99 @@ def test_list_lobbies(client):
     assert isinstance(lobbies, list)
     assert len(lobbies) > 0
     assert any(lobby["name"] == "test_lobby" for lobby in lobbies)
+
+
+def lobby_info(name, players, max_players=None):
+    return {"name": name, "host": "0.0.0.0", "reliable_port": 1, "unreliable_port": 2,
+            "players": players, "route_id": None, "max_players": max_players}
+
+
+def test_list_lobbies_pages_filters_and_revalidates(client, mock_udp_manager):
+    """Test the cached listing: prefix, free slots, cursor pages and ETags"""
+    mock_udp_manager.listing_version.return_value = 1
+    mock_udp_manager.list_lobbies.return_value = [
+        lobby_info("eu-2", ["a", "b"], max_players=2),
+        lobby_info("eu-1", ["c"], max_players=2),
+        lobby_info("eu-3", []),
+        lobby_info("us-1", []),
+    ]
+
+    response = client.get("/lobbies/list", params={"prefix": "eu-", "free_slots": True, "limit": 1})
+    assert [lobby["name"] for lobby in response.json()] == ["eu-1"]
+    cursor = response.headers["x-next-cursor"]
+    response = client.get("/lobbies/list", params={"prefix": "eu-", "free_slots": True, "limit": 1,
+                                                   "cursor": cursor})
+    assert [lobby["name"] for lobby in response.json()] == ["eu-3"]
+    assert "x-next-cursor" not in response.headers
+
+    # Unchanged version: revalidation is a 304 and the manager is not asked again
+    etag = response.headers["etag"]
+    assert client.get("/lobbies/list", headers={"If-None-Match": etag}).status_code == 304
+    assert mock_udp_manager.list_lobbies.call_count == 1
+
+    mock_udp_manager.listing_version.return_value = 2
+    mock_udp_manager.list_lobbies.return_value = [lobby_info("us-1", ["d"])]
+    response = client.get("/lobbies/list", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()[0]["players"] == [{"name": "d", "id": "d", "admin": False, "ready": False, "data": ""}]
+
+
+def test_compression_dictionary_is_served_base64(client, mock_udp_manager):
+    """Test the compression routes: dictionary, ratio and errors"""
+    mock_udp_manager.has_lobby.return_value = True
+    mock_udp_manager.compression_info.return_value = {
+        "dictionary_id": 7, "dictionary": b"\x00\xff", "compression_input_bytes": 200,
+        "compression_output_bytes": 50, "compression_skipped": 0, "compression_seconds": 0.0,
+    }
+    body = client.get("/lobbies/eu-1/compression").json()
+    assert body["dictionary"] == "AP8="
+    assert body["ratio"] == 0.25
+    mock_udp_manager.compression_info.assert_called_with("eu-1", train=False)
+
+    mock_udp_manager.compression_info.side_effect = ValueError("No traffic sampled to train a dictionary on yet.")
+    assert client.post("/lobbies/eu-1/compression/train").status_code == 409
+    mock_udp_manager.has_lobby.return_value = False
+    assert client.get("/lobbies/eu-2/compression").status_code == 404
+
+
+def test_event_stream_sends_a_snapshot_then_changes():
+    """Test the lobby event stream against a real manager and UDP client"""
+    async def scenario():
+        manager = UDPManager(engine="asyncio")
+        manager.create_server("before", "admin")
+        subscription = manager.events.subscribe(asyncio.get_running_loop())
+        stream = lobby_event_stream(manager, subscription)
+
+        async def next_event():
+            chunk = await asyncio.wait_for(stream.__anext__(), timeout=2)
+            fields = dict(line.split(": ", 1) for line in chunk.strip().split("\n"))
+            return fields["event"], json.loads(fields["data"])
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            event, data = await next_event()
+            assert event == "snapshot" and [lobby["name"] for lobby in data["lobbies"]] == ["before"]
+
+            manager.create_server("arena", "admin")
+            event, data = await next_event()
+            assert event == "lobby_created" and data["lobby"]["name"] == "arena"
+
+            port = next(lobby for lobby in manager.list_lobbies() if lobby["name"] == "arena")["reliable_port"]
+            for packet in ({"type": "connect", "client_id": "alice"}, {"type": "ready", "client_id": "alice"}):
+                sock.sendto(json.dumps(packet).encode("utf-8"), ("127.0.0.1", port))
+                await asyncio.sleep(0.05)
+            assert await next_event() == ("player_joined", {"type": "player_joined", "version": 3,
+                                                             "lobby": "arena", "player": "alice"})
+            event, data = await next_event()
+            assert event == "player_ready" and data["ready"] is True
+
+            manager.remove_server("before")
+            event, data = await next_event()
+            assert event == "lobby_removed" and data["lobby"] == "before"
+        finally:
+            await stream.aclose()
+            sock.close()
+            manager.stop_all_servers()
+            await asyncio.sleep(0)
+
+    asyncio.run(scenario())
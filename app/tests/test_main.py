@@ -5,4 +5,19 @@ def test_root(client):
     """Test the root endpoint"""
     response = client.get("/")
     assert response.status_code == 200
-    assert response.json() == {"message": "Welcome to the Game Server API"}
\ No newline at end of file
+    assert response.json() == {"message": "Welcome to the Game Server API"}
+
+def test_metrics_are_served_in_prometheus_format(client, mock_udp_manager):
+    """Test the metrics endpoint renders the manager's snapshots"""
+    histogram = {"buckets": [(0.01, 1)], "sum": 0.004, "count": 1}
+    mock_udp_manager.metrics_snapshot.return_value = {"arena": {
+        "packets_in": 5, "bytes_in": 200, "packets_out": 7, "bytes_out": 300, "retransmits": 0, "stale_dropped": 0,
+        "clients": 1, "pending_acks": 0, "queue_depth": 0, "queue_dropped": 0, "queue_conflated": 0,
+        "compression_input_bytes": 0, "compression_output_bytes": 0, "compression_skipped": 0,
+        "compression_seconds": 0.0,
+        "rtt": histogram, "tick_seconds": histogram, "peers": {},
+    }}
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert 'udp_packets_in_total{lobby="arena"} 5' in response.text
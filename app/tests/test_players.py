@@ -1,3 +1,11 @@
+import pytest
+
+from app.dependencies import get_matchmaker
+from app.main import app
+from app.utils.matchmaking import Matchmaker
+from app.utils.udp_manager import UDPManager
+
+
 def test_players_endpoints(client, mock_udp_manager):
     """Test player-related endpoints"""
     # Since no player endpoints are defined, we're adding placeholders
@@ -5,4 +13,94 @@ def test_players_endpoints(client, mock_udp_manager):
     # Example:
     # response = client.post("/players/create", params={"player_id": "player1"})
     # assert response.status_code == 200
-    pass  # Remove this pass statement when adding actual tests
\ No newline at end of file
+    pass  # Remove this pass statement when adding actual tests
+
+def test_matchmaker_groups_then_backfills_by_pool():
+    """Test that players wait for a group, then fill the open lobby of their pool"""
+    manager = UDPManager()
+    matchmaker = Matchmaker(manager, lobby_size=3, min_players=2)
+    try:
+        assert matchmaker.enqueue("a", region="eu").status == "waiting"
+        # Other pools do not count towards the group
+        assert matchmaker.enqueue("x", region="us").status == "waiting"
+        matchmaker.enqueue("c", region="eu", skill_bucket=1)
+        assert matchmaker.cancel("c") and matchmaker.status("c") is None
+        second = matchmaker.enqueue("b", region="eu")
+        assert second.status == "matched"
+        assert matchmaker.status("a").lobby == second.lobby
+        assert manager.list_lobbies()[0]["max_players"] == 3
+
+        # One slot left: the next eu player takes it, the one after waits again
+        assert matchmaker.enqueue("d", region="eu").lobby == second.lobby
+        assert matchmaker.enqueue("e", region="eu").status == "waiting"
+        assert matchmaker.stats() == {"pools": 2, "waiting": 2, "open_lobbies": 0}
+        with pytest.raises(ValueError):
+            matchmaker.enqueue("e", region="eu")
+    finally:
+        manager.stop_all_servers()
+
+
+def test_matchmaking_endpoints(client, mock_udp_manager):
+    """Test queueing, polling and leaving through the API"""
+    mock_udp_manager.join_server.return_value = (4000, 4001)
+    mock_udp_manager.route_of.return_value = None
+    matchmaker = Matchmaker(mock_udp_manager, lobby_size=4, min_players=1)
+    # The client fixture clears the overrides afterwards
+    app.dependency_overrides[get_matchmaker] = lambda: matchmaker
+
+    response = client.post("/players/matchmaking", params={"player_id": "p1", "region": "eu"})
+    assert response.status_code == 200
+    assert response.json()["message"] == "p4000|4001l"
+    [(lobby, admin), options] = mock_udp_manager.create_server.call_args
+    assert lobby.startswith("match-") and admin == "p1" and options == {"max_players": 4}
+
+    assert client.get("/players/matchmaking/p1").json()["status"] == "matched"
+    assert client.delete("/players/matchmaking/p1").status_code == 200
+    assert client.get("/players/matchmaking/p1").status_code == 404
+
+
+def test_matchmaker_fails_the_group_when_its_lobby_cannot_be_created(client, mock_udp_manager):
+    """Test that a failed lobby create settles its group instead of queueing it again"""
+    mock_udp_manager.create_server.side_effect = OSError("no ports left")
+    matchmaker = Matchmaker(mock_udp_manager, lobby_size=4, min_players=2)
+    app.dependency_overrides[get_matchmaker] = lambda: matchmaker
+
+    assert client.post("/players/matchmaking", params={"player_id": "a"}).json()["status"] == "waiting"
+    response = client.post("/players/matchmaking", params={"player_id": "b"})
+    assert response.status_code == 200 and response.json()["status"] == "failed"
+    assert client.get("/players/matchmaking/a").json()["status"] == "failed"
+    assert matchmaker.stats() == {"pools": 0, "waiting": 0, "open_lobbies": 0}
+
+    # A third player does not pull the failed group into another attempt
+    assert client.post("/players/matchmaking", params={"player_id": "c"}).json()["status"] == "waiting"
+    assert mock_udp_manager.create_server.call_count == 1
+
+    # Failed players may queue again
+    mock_udp_manager.create_server.side_effect = None
+    mock_udp_manager.join_server.return_value = (4000, 4001)
+    mock_udp_manager.route_of.return_value = None
+    assert client.post("/players/matchmaking", params={"player_id": "a"}).json()["status"] == "matched"
+
+
+def test_matchmade_lobbies_avoid_taken_names_and_the_matchmaker_lock():
+    """Test that matchmade lobbies never clash with named ones and are created without the matchmaker's lock"""
+    manager = UDPManager()
+    matchmaker = Matchmaker(manager, lobby_size=3, min_players=2)
+    create_server = manager.create_server
+    locked = []
+
+    def create_and_check(*args, **kwargs):
+        locked.append(matchmaker.lock.locked())
+        return create_server(*args, **kwargs)
+
+    manager.create_server = create_and_check
+    try:
+        for name in ("match-1", "match-2"):
+            manager.create_server(name, "someone")
+        matchmaker.enqueue("a")
+        ticket = matchmaker.enqueue("b")
+        assert ticket.status == "matched" and ticket.lobby not in ("match-1", "match-2")
+        assert locked == [False, False, False]
+        assert matchmaker.enqueue("c").lobby == ticket.lobby
+    finally:
+        manager.stop_all_servers()
@@ -0,0 +1,1132 @@
+import asyncio
+import json
+import logging
+import queue
+import random
+import socket
+import threading
+import time
+import zlib
+from unittest.mock import MagicMock
+
+import pytest
+
+from app.utils.protocols import codec
+from app.utils.protocols.capture import CaptureWriter, read_capture, replay
+from app.utils.protocols.compression import (ADAPT_WINDOW, BACKOFF, COMPRESSED, COMPRESSED_MARKER,
+                                             DICTIONARY_SIZE, Compressor, dictionary_id, train_dictionary)
+from app.utils.protocols.fragments import Reassembler
+from app.utils.protocols.interest import GridInterest
+from app.utils.protocols.jitter import JitterBuffer
+from app.utils.protocols.log import RateLimitFilter
+from app.utils.protocols.metrics import render_prometheus
+from app.utils.protocols.snapshot import SnapshotState
+from app.utils.protocols.shared_port import SharedPortRouter, route_prefix
+from app.utils.protocols.scheduler import ThreadScheduler, Timer, TimerHeap
+from app.utils.protocols.udp_client import STRAY_TIMEOUT, GameServer
+from app.utils.protocols.udp_handlers.batcher import Batcher
+from app.utils.protocols.udp_handlers.reliable import RETRANSMIT_BATCH, ReliableHandler
+from app.utils.protocols.udp_handlers.send_queue import SendQueue
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def udp_client() -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.setblocking(False)
+    return sock
+
+
+async def receive(loop, sock) -> dict:
+    data = await asyncio.wait_for(loop.sock_recv(sock, 4096), timeout=2)
+    return json.loads(data.decode("utf-8"))
+
+
+def test_asyncio_engine_relays_without_threads():
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        threads_before = threading.active_count()
+        server = GameServer("127.0.0.1", free_port(), free_port(), loop=loop)
+        assert threading.active_count() == threads_before
+
+        alice, bob = udp_client(), udp_client()
+        try:
+            for client_id, sock in (("alice", alice), ("bob", bob)):
+                packet = {"type": "connect", "client_id": client_id}
+                sock.sendto(json.dumps(packet).encode("utf-8"), ("127.0.0.1", server.reliable_port))
+                # Every client hears its own connect broadcast
+                while (await receive(loop, sock)).get("client_id") != client_id:
+                    pass
+
+            update = {"type": "update", "client_id": "alice", "data": {"x": 1}}
+            alice.sendto(json.dumps(update).encode("utf-8"), ("127.0.0.1", server.unreliable_port))
+            packet = await receive(loop, bob)
+            while packet["type"] != "update":
+                packet = await receive(loop, bob)
+            assert packet["data"] == {"x": 1}
+        finally:
+            server.stop()
+            alice.close()
+            bob.close()
+            await asyncio.sleep(0)
+        assert server.transports == []
+
+    asyncio.run(scenario())
+
+
+def test_binary_codec_round_trip():
+    packet = {"type": "update", "client_id": "alice", "client_index": 2, "seq": 7,
+              "data": {"x": 1.5, "tags": ["a"]}}
+    data = codec.BINARY.encode(packet)
+    assert codec.detect(data) is codec.BINARY
+    assert len(data) < len(codec.JSON.encode(packet))
+
+    decoded = codec.BINARY.decode(memoryview(data))
+    # The id string is dropped in favour of the index outside of connect packets
+    assert decoded == {"type": "update", "client_index": 2, "seq": 7, "data": {"x": 1.5, "tags": ["a"]}}
+
+
+def test_binary_codec_keeps_unknown_types_and_connect_ids():
+    connect = codec.BINARY.decode(codec.BINARY.encode({"type": "connect", "client_id": "bob", "client_index": 0}))
+    assert connect == {"type": "connect", "client_id": "bob", "client_index": 0}
+
+    custom = codec.BINARY.decode(codec.BINARY.encode({"type": "chat", "text": "hi"}))
+    assert custom == {"type": "chat", "text": "hi"}
+
+
+def test_codec_rejects_bad_packets():
+    data = codec.BINARY.encode({"type": "update", "data": {"x": 1}})
+    with pytest.raises(codec.CodecError):
+        codec.BINARY.decode(data[:-1])
+    with pytest.raises(codec.CodecError):
+        codec.JSON.decode(b"[1, 2]")
+    assert codec.detect(b'{"type": "connect"}') is codec.JSON
+
+
+def test_server_answers_each_peer_in_its_own_codec():
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        server = GameServer("127.0.0.1", free_port(), free_port(), loop=loop)
+        binary, legacy = udp_client(), udp_client()
+        try:
+            binary.sendto(codec.BINARY.encode({"type": "connect", "client_id": "bin"}),
+                          ("127.0.0.1", server.reliable_port))
+            data = await asyncio.wait_for(loop.sock_recv(binary, 4096), timeout=2)
+            welcome = codec.BINARY.decode(data)
+            assert welcome["client_id"] == "bin"
+
+            legacy.sendto(json.dumps({"type": "connect", "client_id": "json"}).encode("utf-8"),
+                          ("127.0.0.1", server.reliable_port))
+            assert (await receive(loop, legacy))["client_id"] == "json"
+
+            # Updates sent by index come out with the sender's id for JSON peers
+            update = {"type": "update", "client_index": welcome["client_index"], "data": {"x": 2}}
+            binary.sendto(codec.BINARY.encode(update), ("127.0.0.1", server.unreliable_port))
+            packet = await receive(loop, legacy)
+            while packet["type"] != "update":
+                packet = await receive(loop, legacy)
+            assert packet["client_id"] == "bin" and packet["data"] == {"x": 2}
+        finally:
+            server.stop()
+            binary.close()
+            legacy.close()
+            await asyncio.sleep(0)
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("wire", [codec.JSON, codec.BINARY])
+def test_body_frames_match_a_full_encode(wire):
+    packet = {"type": "connect", "client_id": "alice", "client_index": 1, "data": {"x": 1}}
+    body = wire.encode_body(packet)
+    framed = b"".join(bytes(buffer) for buffer in body.frame(seq=9, ack=4, ack_bits=3))
+    assert wire.decode(framed) == wire.decode(wire.encode(dict(packet, seq=9, ack=4, ack_bits=3)))
+    assert codec.JSON.decode(b"".join(codec.JSON.encode_body({}).frame(seq=1))) == {"seq": 1}
+
+
+def test_reliable_fan_out_shares_one_body(mock_threading):
+    sock = MagicMock()
+    handler = ReliableHandler(sock)
+    body = codec.BINARY.encode_body({"type": "connect", "client_id": "alice"})
+    addresses = [("127.0.0.1", 5000 + i) for i in range(3)]
+
+    handler.send_body(body, addresses)
+
+    sent = [call.args for call in sock.sendmsg.call_args_list]
+    assert [args[3] for args in sent] == addresses
+    assert all(args[0][1] is body.payload for args in sent)
+    # Every peer has its own sequence space
+    assert [codec.BINARY.decode(b"".join(args[0]))["seq"] for args in sent] == [1, 1, 1]
+    assert all(list(handler.peers[address].pending) == [1] for address in addresses)
+
+    handler.remove_peer(addresses[0])
+    assert addresses[0] not in handler.peers
+
+
+def test_ack_bitfield_covers_a_burst_and_feeds_rtt(mock_threading):
+    handler = ReliableHandler(MagicMock())
+    address = ("127.0.0.1", 5000)
+    body = codec.BINARY.encode_body({"type": "update", "data": {}})
+    for _ in range(5):
+        handler.send_body(body, [address])
+    peer = handler.peers[address]
+
+    # Newest seq 5 plus bits for 4, 3 and 1; seq 2 was lost
+    handler.process_ack(address, 5, 0b1011)
+    assert list(peer.pending) == [2]
+    assert peer.srtt is not None and peer.rto == peer.min_rto
+
+
+def test_inbound_duplicates_are_acked_but_dropped(mock_threading):
+    sock = MagicMock()
+    handler = ReliableHandler(sock)
+    address = ("127.0.0.1", 5000)
+    assert handler.acknowledge(address, 1)
+    assert handler.acknowledge(address, 3)
+    assert handler.acknowledge(address, 2)
+    assert not handler.acknowledge(address, 2)
+
+    ack = codec.JSON.decode(b"".join(sock.sendmsg.call_args.args[0]))
+    assert ack == {"type": "ack", "ack": 3, "ack_bits": 0b11}
+
+
+def test_channels_number_and_ack_in_their_own_sequence_space(mock_threading):
+    handler = ReliableHandler(MagicMock())
+    address = ("127.0.0.1", 5000)
+    for channel in (0, 1, 1):
+        handler.send_body(codec.BINARY.encode_body({"type": "update", "channel": channel}), [address])
+    peer = handler.peers[address]
+    assert list(peer.pending) == [1] and list(peer.lane(1).pending) == [1, 2]
+
+    # An ack only covers the channel it names
+    handler.process_ack(address, 2, 0b1, channel=1)
+    assert list(peer.pending) == [1] and not peer.lane(1).pending
+    assert peer.pending_count() == 1
+
+
+def test_ordered_channel_holds_packets_behind_a_gap_without_stalling_others():
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        server = GameServer("127.0.0.1", free_port(), free_port(), loop=loop, heartbeat_interval=None)
+        alice, bob = udp_client(), udp_client()
+        try:
+            for client_id, sock in (("alice", alice), ("bob", bob)):
+                packet = {"type": "connect", "client_id": client_id}
+                sock.sendto(json.dumps(packet).encode("utf-8"), ("127.0.0.1", server.reliable_port))
+            await asyncio.sleep(0.05)
+            # Channel 1 is ordered and loses its seq 1 for a moment, channel 2 is unordered
+            for channel, seq in ((1, 2), (2, 1), (1, 1)):
+                update = {"type": "update", "client_id": "alice", "channel": channel, "seq": seq,
+                          "data": {"x": (channel, seq)}}
+                alice.sendto(json.dumps(update).encode("utf-8"), ("127.0.0.1", server.reliable_port))
+                await asyncio.sleep(0.01)
+            relayed = []
+            while len(relayed) < 3:
+                packet = await receive(loop, bob)
+                if packet["type"] == "update":
+                    relayed.append(tuple(packet["data"]["x"]))
+            assert relayed == [(2, 1), (1, 1), (1, 2)]
+            acks = []
+            while len(acks) < 3:
+                packet = await receive(loop, alice)
+                if packet["type"] == "ack":
+                    acks.append((packet.get("channel", 0), packet["ack"], packet["ack_bits"]))
+            assert acks == [(1, 2, 0), (2, 1, 0), (1, 2, 0b1)]
+        finally:
+            server.stop()
+            alice.close()
+            bob.close()
+            await asyncio.sleep(0)
+
+    asyncio.run(scenario())
+
+
+class ManualScheduler:
+    """Collects timers so a test can fire them by hand."""
+
+    def __init__(self):
+        self.timers = []
+
+    def call_later(self, delay, callback, *args):
+        timer = Timer(delay, callback, args)
+        self.timers.append(timer)
+        return timer
+
+    def fire(self):
+        timers, self.timers = self.timers, []
+        for timer in timers:
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+        return [timer.deadline for timer in timers if not timer.cancelled]
+
+
+def test_peer_lost_after_max_retries(mock_threading):
+    lost = []
+    scheduler = ManualScheduler()
+    handler = ReliableHandler(MagicMock(), on_peer_lost=lost.append, max_retries=2,
+                              initial_rto=0.5, scheduler=scheduler)
+    address = ("127.0.0.1", 5000)
+    handler.send_body(codec.BINARY.encode_body({"type": "connect"}), [address])
+
+    # Exponential backoff between retries, then the peer is given up on
+    assert scheduler.fire() == [0.5]
+    assert scheduler.fire() == [1.0]
+    assert [timer.deadline for timer in scheduler.timers] == [2.0]
+    scheduler.fire()
+    assert lost == [address] and address not in handler.peers
+
+
+def test_acked_packets_cancel_their_retransmit(mock_threading):
+    scheduler = ManualScheduler()
+    sock = MagicMock()
+    handler = ReliableHandler(sock, scheduler=scheduler)
+    address = ("127.0.0.1", 5000)
+    handler.send_body(codec.BINARY.encode_body({"type": "connect"}), [address])
+    handler.process_ack(address, 1)
+    assert scheduler.timers[0].cancelled
+    scheduler.fire()
+    assert sock.sendmsg.call_count == 1
+
+
+def test_one_retransmit_timer_per_peer_resends_only_what_is_due(mock_threading):
+    scheduler = ManualScheduler()
+    sock = MagicMock()
+    handler = ReliableHandler(sock, scheduler=scheduler, initial_rto=0.5)
+    addresses = [("127.0.0.1", 5000), ("127.0.0.1", 5001)]
+    for _ in range(10):
+        handler.send_body(codec.BINARY.encode_body({"type": "update"}), addresses)
+    assert len(scheduler.timers) == 2
+
+    # The first peer acked everything but seq 1, the second nothing. Only the
+    # first packets were due when the timers ran, the rest wait for theirs.
+    handler.process_ack(addresses[0], 10, 0xFF)
+    sent = sock.sendmsg.call_count
+    scheduler.fire()
+    resent = [(call.args[3], codec.BINARY.decode(b"".join(call.args[0]))["seq"])
+              for call in sock.sendmsg.call_args_list[sent:]]
+    assert resent == [(addresses[0], 1), (addresses[1], 1)]
+    assert len(scheduler.timers) == 2
+    assert handler.peers[addresses[1]].pending_count() == 10
+
+
+def test_a_retransmit_run_resends_at_most_a_batch(mock_threading):
+    scheduler = ManualScheduler()
+    sock = MagicMock()
+    handler = ReliableHandler(sock, scheduler=scheduler, initial_rto=0.5)
+    address = ("127.0.0.1", 5000)
+    for _ in range(RETRANSMIT_BATCH + 10):
+        handler.send_body(codec.BINARY.encode_body({"type": "update"}), [address])
+    peer = handler.peers[address]
+    # Everything is due, one run resends a batch and comes back right away for the rest
+    peer.retransmit_at = time.monotonic() + 0.75
+    sent = sock.sendmsg.call_count
+    scheduler.fire()
+    assert sock.sendmsg.call_count - sent == RETRANSMIT_BATCH
+    assert [timer.deadline for timer in scheduler.timers] == [0.0]
+    scheduler.fire()
+    assert sock.sendmsg.call_count - sent == RETRANSMIT_BATCH + 10
+    assert scheduler.timers[0].deadline == pytest.approx(1.0, abs=0.25)
+    # Acked packets left in the deadline heap are skipped
+    handler.process_ack(address, RETRANSMIT_BATCH + 10, 0)
+    assert peer.next_deadline() is not None
+    handler.process_ack(address, RETRANSMIT_BATCH + 9, 0xFFFFFFFF)
+    assert peer.pending_count() == RETRANSMIT_BATCH + 10 - 34
+    assert [entry.seq for entry in peer.pop_due(float("inf"), 1000)] == list(range(1, RETRANSMIT_BATCH + 10 - 33))
+
+
+def test_out_of_range_ack_fields_are_masked_or_dropped(mock_threading):
+    scheduler = ManualScheduler()
+    handler = ReliableHandler(MagicMock(), scheduler=scheduler)
+    address = ("127.0.0.1", 5000)
+    for _ in range(3):
+        handler.send_body(codec.BINARY.encode_body({"type": "update"}), [address])
+    # Only the 32 bit window counts, a negative bitfield acks what it covers and ends
+    handler.process_ack(address, 3, -1)
+    assert handler.peers[address].pending_count() == 0
+
+    server = GameServer("127.0.0.1", free_port(), free_port(), heartbeat_interval=None)
+    try:
+        server.on_datagram(json.dumps({"type": "connect", "client_id": "alice"}).encode("utf-8"), address, True)
+        server.reliable_handler.process_ack = MagicMock()
+        for packet in ({"type": "ack", "ack": 1, "ack_bits": -1}, {"type": "ack", "ack": 1, "ack_bits": 2 ** 40},
+                       {"type": "ack", "ack": "1"}, {"type": "update", "seq": -5, "data": {}}):
+            server.on_datagram(json.dumps(packet).encode("utf-8"), address, True)
+        server.reliable_handler.process_ack.assert_not_called()
+        assert ("alice", 0) not in server.unreliable_seqs
+    finally:
+        server.stop()
+
+
+def test_batcher_coalesces_frames_up_to_the_mtu():
+    sent = []
+    scheduler = ManualScheduler()
+    batcher = Batcher(lambda buffers, address: sent.append((b"".join(buffers), address)), scheduler, mtu=110)
+    address = ("127.0.0.1", 5000)
+    frames = [codec.BINARY.encode_body({"type": "update", "client_index": i, "data": "x" * 8}).frame(seq=i)
+              for i in (1, 2, 3)]
+    assert len(b"".join(frames[0])) == 39
+
+    for frame in frames:
+        batcher.add(frame, address)
+    # Two frames fill the datagram, the third starts the next one
+    assert len(sent) == 1 and codec.BINARY.is_batch(sent[0][0])
+    assert [codec.BINARY.decode(frame)["seq"] for frame in codec.BINARY.unpack_batch(sent[0][0])] == [1, 2]
+
+    # The flush deadline sends the lone frame without the batch wrapper
+    scheduler.fire()
+    assert codec.BINARY.decode(sent[1][0])["seq"] == 3
+
+    large = codec.BINARY.encode_body({"type": "update", "data": "x" * 200}).frame()
+    batcher.add(frames[0], address)
+    batcher.add(large, address)
+    assert [len(data) for data, _ in sent[2:]] == [39, len(b"".join(large))]
+    assert not batcher.pending
+
+
+def test_batched_server_unpacks_and_coalesces_mixed_channels():
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        server = GameServer("127.0.0.1", free_port(), free_port(), loop=loop, batching=True)
+        client = udp_client()
+        try:
+            connect = codec.BINARY.encode_body({"type": "connect", "client_id": "alice"})
+            update = codec.BINARY.encode_body({"type": "update", "client_index": 0, "data": {"x": 1}})
+            batch = codec.BINARY.pack_batch([connect.frame(seq=1, flags=codec.FLAG_RELIABLE), update.frame()])
+            client.sendto(b"".join(batch), ("127.0.0.1", server.unreliable_port))
+
+            data = await asyncio.wait_for(loop.sock_recv(client, 4096), timeout=2)
+            assert codec.BINARY.is_batch(data)
+            frames = codec.BINARY.unpack_batch(data)
+            packets = [codec.BINARY.decode(frame) for frame in frames]
+            assert [packet["type"] for packet in packets] == ["ack", "connect", "update"]
+            assert [codec.BINARY.flags_of(frame) for frame in frames] == [codec.FLAG_RELIABLE] * 2 + [0]
+            assert packets[0]["ack"] == 1 and packets[2]["data"] == {"x": 1}
+        finally:
+            server.stop()
+            client.close()
+            await asyncio.sleep(0)
+
+    asyncio.run(scenario())
+
+
+def test_send_queue_drops_oldest_and_keeps_latest_per_key():
+    send_queue = SendQueue(max_depth=3, conflate=True)
+    alice, bob = ("127.0.0.1", 5000), ("127.0.0.1", 5001)
+    bodies = [codec.JSON.encode_body({"type": "update", "n": n}) for n in range(5)]
+
+    send_queue.put(bodies[0], [alice, bob], key="carol")
+    send_queue.put(bodies[1], [alice], key="carol")  # Replaces bodies[0] for alice only
+    for body in bodies[2:]:
+        send_queue.put(body, [alice])
+
+    # Peers take turns, alice lost her oldest entry to the depth limit
+    drained = []
+    while send_queue.depth:
+        address, body = send_queue.get(timeout=0)
+        drained.append((address, bodies.index(body)))
+    assert drained == [(alice, 2), (bob, 0), (alice, 3), (alice, 4)]
+    assert send_queue.stats()["dropped"] == 1 and send_queue.stats()["conflated"] == 1
+    with pytest.raises(queue.Empty):
+        send_queue.get(timeout=0)
+
+
+def test_send_queue_signals_high_water_once_per_backlog():
+    signals = []
+    send_queue = SendQueue(high_water=2, on_high_water=lambda address, depth: signals.append(depth))
+    address = ("127.0.0.1", 5000)
+    body = codec.JSON.encode_body({"type": "connect"})
+    for _ in range(4):
+        send_queue.put(body, [address])
+    assert signals == [2] and send_queue.depth == 4
+    send_queue.discard(address)
+    assert send_queue.stats()["depth"] == 0
+
+
+def test_timer_heap_pops_in_deadline_order_and_skips_cancelled():
+    timers = TimerHeap()
+    entries = [Timer(deadline, None, ()) for deadline in (3.0, 1.0, 2.0, 5.0)]
+    for timer in entries:
+        timers.push(timer)
+    entries[2].cancel()
+    assert timers.next_deadline() == 1.0
+    assert [timer.deadline for timer in timers.pop_due(4.0)] == [1.0, 3.0]
+    assert timers.next_deadline() == 5.0
+
+
+def test_thread_scheduler_runs_timers_in_order():
+    scheduler = ThreadScheduler()
+    fired = []
+    done = threading.Event()
+    try:
+        scheduler.call_later(0.05, fired.append, "late")
+        scheduler.call_later(0.01, fired.append, "early")
+        scheduler.call_later(0.02, fired.append, "cancelled").cancel()
+        scheduler.call_later(0.06, done.set)
+        assert done.wait(2)
+    finally:
+        scheduler.stop()
+    assert fired == ["early", "late"]
+
+
+def test_snapshots_are_delta_encoded_against_acked_baselines():
+    state = SnapshotState(history=4)
+    alice, bob = ("127.0.0.1", 1), ("127.0.0.1", 2)
+    recipients = [("alice", alice), ("bob", bob)]
+    state.update("alice", {"x": 1})
+    state.update("bob", {"x": 5})
+
+    [(packet, addresses)] = state.build(recipients)
+    assert packet == {"type": "snapshot", "tick": 1, "baseline": 0,
+                      "states": {"alice": {"x": 1}, "bob": {"x": 5}}}
+    assert addresses == [alice, bob]
+
+    state.ack("alice", 1)
+    state.update("alice", {"x": 2})
+    state.remove("bob")
+    packets = {packet["baseline"]: (packet, addresses) for packet, addresses in state.build(recipients)}
+    # alice only hears what changed since tick 1, bob never acked so gets everything
+    assert packets[1][0]["states"] == {"alice": {"x": 2}} and packets[1][0]["removed"] == ["bob"]
+    assert packets[1][1] == [alice]
+    assert packets[0][0]["states"] == {"alice": {"x": 2}} and packets[0][1] == [bob]
+
+    # Nothing changed since alice's baseline, so she is skipped
+    state.ack("alice", 2)
+    assert [addresses for _, addresses in state.build(recipients)] == [[bob]]
+
+    # Baselines that fell out of the history fall back to a full snapshot
+    for _ in range(4):
+        state.take()
+    [(packet, _)] = state.build(recipients)
+    assert packet["baseline"] == 0
+
+
+def test_tick_mode_sends_snapshots_instead_of_relaying():
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        server = GameServer("127.0.0.1", free_port(), free_port(), loop=loop, tick_rate=50)
+        alice, bob = udp_client(), udp_client()
+        try:
+            for client_id, sock in (("alice", alice), ("bob", bob)):
+                packet = {"type": "connect", "client_id": client_id}
+                sock.sendto(json.dumps(packet).encode("utf-8"), ("127.0.0.1", server.reliable_port))
+                while (await receive(loop, sock)).get("client_id") != client_id:
+                    pass
+
+            update = {"type": "update", "client_id": "alice", "data": {"x": 1}}
+            alice.sendto(json.dumps(update).encode("utf-8"), ("127.0.0.1", server.unreliable_port))
+            packet = await receive(loop, bob)
+            while packet["type"] != "snapshot":
+                assert packet["type"] != "update"
+                packet = await receive(loop, bob)
+            assert packet["states"] == {"alice": {"x": 1}} and packet["baseline"] == 0
+
+            ack = {"type": "snapshot_ack", "client_id": "bob", "snapshot_ack": packet["tick"]}
+            bob.sendto(json.dumps(ack).encode("utf-8"), ("127.0.0.1", server.unreliable_port))
+            await asyncio.sleep(0.05)
+            assert server.snapshots.baselines["bob"] == packet["tick"]
+        finally:
+            server.stop()
+            alice.close()
+            bob.close()
+            await asyncio.sleep(0)
+
+    asyncio.run(scenario())
+
+
+def test_grid_interest_filters_and_throttles_by_distance():
+    interest = GridInterest(radius=100, cell_size=25)
+    clients = {name: ("127.0.0.1", port) for port, name in enumerate(("me", "near", "mid", "far", "away", "new"))}
+    interest.update("me", {"pos": [0, 0]})
+    interest.update("near", {"x": 10, "y": 0})
+    interest.update("mid", {"pos": {"x": 0, "y": 70}})
+    interest.update("far", {"pos": [-90, 0, 5]})
+    interest.update("away", {"pos": [500, 500]})
+
+    received = [interest.recipients("me", clients.items()) for _ in range(4)]
+    counts = {name: sum(address in addresses for addresses in received) for name, address in clients.items()}
+    # "new" never sent a position, so it is treated as in range
+    assert counts == {"me": 4, "near": 4, "mid": 2, "far": 1, "away": 0, "new": 4}
+
+    interest.update("away", {"pos": [5, 5]})
+    assert clients["away"] in interest.recipients("me", clients.items())
+    interest.remove("away")
+    assert interest.nearby((0, 0)).keys() == {"me", "near", "mid", "far"}
+
+
+def test_grid_interest_ignores_non_finite_positions():
+    interest = GridInterest(radius=10, cell_size=0.5)
+    interest.update("me", {"pos": [1, 1]})
+    for data in ({"pos": [float("nan"), 0]}, {"x": float("inf"), "y": 0}, {"pos": ["-Infinity", 0]},
+                 {"pos": [1e308, 0]}):
+        interest.update("me", data)
+        assert interest.positions["me"] == (1.0, 1.0)
+    assert interest.cells == {(2, 2): {"me"}}
+    interest.remove("me")
+    assert not interest.positions and not interest.cells
+
+
+def test_filtered_snapshots_resend_state_hidden_at_the_baseline():
+    state = SnapshotState()
+    interest = GridInterest(radius=10)
+    recipients = [("me", ("127.0.0.1", 1))]
+    for client_id, pos in (("me", [0, 0]), ("other", [50, 0])):
+        interest.update(client_id, {"pos": pos})
+        state.update(client_id, {"pos": pos})
+
+    [(packet, _)] = state.build(recipients, interest)
+    assert packet["states"] == {"me": {"pos": [0, 0]}}
+    state.ack("me", packet["tick"])
+
+    # Walking up to "other" must reveal its state even though it has not changed
+    interest.update("me", {"pos": [45, 0]})
+    state.update("me", {"pos": [45, 0]})
+    [(packet, _)] = state.build(recipients, interest)
+    assert packet["baseline"] == 1
+    assert packet["states"] == {"me": {"pos": [45, 0]}, "other": {"pos": [50, 0]}}
+
+
+def test_shared_ports_route_packets_to_their_lobby():
+    router = SharedPortRouter("127.0.0.1", 0, 0, workers=2)
+    lobbies = {route_id: GameServer("127.0.0.1", router.reliable_port, router.unreliable_port,
+                                    sockets=router.send_sockets) for route_id in (1, 2)}
+    for route_id, server in lobbies.items():
+        router.register(route_id, server)
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.settimeout(2)
+    try:
+        connect = json.dumps({"type": "connect", "client_id": "alice"}).encode("utf-8")
+        client.sendto(route_prefix(2) + connect, ("127.0.0.1", router.reliable_port))
+        data, source = client.recvfrom(4096)
+        assert json.loads(data)["client_id"] == "alice"
+        assert source[1] == router.reliable_port
+        assert "alice" in lobbies[2].clients and not lobbies[1].clients
+
+        # Once routed, the address keeps reaching its lobby without the prefix
+        update = json.dumps({"type": "update", "client_id": "alice", "data": {}}).encode("utf-8")
+        client.sendto(update, ("127.0.0.1", router.unreliable_port))
+        assert json.loads(client.recvfrom(4096)[0])["type"] == "update"
+
+        router.unregister(2)
+        client.sendto(update, ("127.0.0.1", router.unreliable_port))
+        with pytest.raises(socket.timeout):
+            client.settimeout(0.2)
+            client.recvfrom(4096)
+    finally:
+        for server in lobbies.values():
+            server.stop()
+        router.stop()
+        client.close()
+
+
+def test_silent_clients_are_disconnected():
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        changes = []
+        server = GameServer("127.0.0.1", free_port(), free_port(), loop=loop, client_timeout=0.2,
+                            on_clients_changed=lambda server: changes.append(len(server.clients)))
+        alice, bob = udp_client(), udp_client()
+        try:
+            for client_id, sock in (("alice", alice), ("bob", bob)):
+                packet = {"type": "connect", "client_id": client_id}
+                sock.sendto(json.dumps(packet).encode("utf-8"), ("127.0.0.1", server.reliable_port))
+            await asyncio.sleep(0.05)
+            assert set(server.clients) == {"alice", "bob"}
+
+            # Bob keeps talking, alice goes quiet
+            update = json.dumps({"type": "update", "client_id": "bob", "data": {}}).encode("utf-8")
+            for _ in range(6):
+                bob.sendto(update, ("127.0.0.1", server.unreliable_port))
+                await asyncio.sleep(0.05)
+            assert set(server.clients) == {"bob"}
+            assert changes == [1, 2, 1]
+        finally:
+            server.stop()
+            alice.close()
+            bob.close()
+            await asyncio.sleep(0)
+
+    asyncio.run(scenario())
+
+
+def test_disconnect_only_counts_from_the_clients_own_address():
+    server = GameServer("127.0.0.1", free_port(), free_port(), heartbeat_interval=None)
+    alice, mallory = ("127.0.0.1", 40001), ("127.0.0.1", 40002)
+    try:
+        server.on_datagram(json.dumps({"type": "connect", "client_id": "alice"}).encode("utf-8"), alice, True)
+        disconnect = json.dumps({"type": "disconnect", "client_id": "alice"}).encode("utf-8")
+        server.on_datagram(disconnect, mallory, True)
+        assert server.clients == {"alice": alice}
+        assert alice in server.last_seen and alice in server.peer_codecs
+
+        server.on_datagram(disconnect, alice, True)
+        assert server.clients == {}
+        assert alice not in server.last_seen and alice not in server.peer_codecs
+        assert alice not in server.reliable_handler.peers
+    finally:
+        server.stop()
+
+
+def test_state_of_senders_that_never_connect_is_swept():
+    server = GameServer("127.0.0.1", free_port(), free_port(), heartbeat_interval=None)
+    alice = ("127.0.0.1", 40001)
+    strays = [("127.0.0.1", 41000 + i) for i in range(20)]
+    try:
+        server.on_datagram(json.dumps({"type": "connect", "client_id": "alice"}).encode("utf-8"), alice, True)
+        for address in strays:
+            server.on_datagram(json.dumps({"type": "heartbeat", "seq": 1}).encode("utf-8"), address, True)
+        # Counted for the lobby, but no per-peer series
+        snapshot = server.metrics_snapshot()
+        assert list(snapshot["peers"]) == ["alice"] and snapshot["packets_in"] == 21
+
+        server.sweep_strays()
+        assert len(server.last_seen) == 21  # Not silent for long enough yet
+        for address in strays + [alice]:
+            server.last_seen[address] -= STRAY_TIMEOUT
+        server.sweep_strays()
+        assert set(server.last_seen) == set(server.peer_codecs) == {alice}
+        # Alice's own entries depend on whether the connect broadcast was sent yet
+        assert not set(server.metrics.peers) & set(strays)
+        assert not set(server.reliable_handler.peers) & set(strays)
+        assert server.metrics_snapshot()["packets_in"] == 21
+    finally:
+        server.stop()
+
+
+def test_heartbeats_only_go_to_peers_we_are_not_already_sending_to():
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        server = GameServer("127.0.0.1", free_port(), free_port(), loop=loop,
+                            client_timeout=None, heartbeat_interval=0.1)
+        alice, bob = udp_client(), udp_client()
+        try:
+            for client_id, sock in (("alice", alice), ("bob", bob)):
+                packet = {"type": "connect", "client_id": client_id}
+                sock.sendto(json.dumps(packet).encode("utf-8"), ("127.0.0.1", server.reliable_port))
+            await asyncio.sleep(0.05)
+
+            # Relayed updates keep alice's connection warm
+            update = json.dumps({"type": "update", "client_id": "bob", "data": {}}).encode("utf-8")
+            received = []
+            for _ in range(8):
+                bob.sendto(update, ("127.0.0.1", server.unreliable_port))
+                await asyncio.sleep(0.04)
+                while True:
+                    try:
+                        received.append(json.loads(alice.recv(4096))["type"])
+                    except BlockingIOError:
+                        break
+            assert "update" in received and "heartbeat" not in received
+
+            # Once the traffic stops she gets heartbeats instead
+            packet = await receive(loop, alice)
+            while packet["type"] != "heartbeat":
+                packet = await receive(loop, alice)
+        finally:
+            server.stop()
+            alice.close()
+            bob.close()
+            await asyncio.sleep(0)
+
+    asyncio.run(scenario())
+
+
+def test_metrics_count_traffic_per_peer_and_render_as_prometheus():
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        server = GameServer("127.0.0.1", free_port(), free_port(), loop=loop, heartbeat_interval=None)
+        alice, bob = udp_client(), udp_client()
+        try:
+            for client_id, sock in (("alice", alice), ("bob", bob)):
+                packet = {"type": "connect", "client_id": client_id}
+                sock.sendto(json.dumps(packet).encode("utf-8"), ("127.0.0.1", server.reliable_port))
+            await asyncio.sleep(0.05)
+            update = json.dumps({"type": "update", "client_id": "alice", "data": {"x": 1}}).encode("utf-8")
+            alice.sendto(update, ("127.0.0.1", server.unreliable_port))
+            await asyncio.sleep(0.1)
+
+            snapshot = server.metrics_snapshot()
+            assert snapshot["clients"] == 2
+            assert snapshot["peers"]["alice"]["packets_in"] == 2
+            assert snapshot["peers"]["alice"]["bytes_in"] > len(update)
+            assert snapshot["peers"]["bob"]["packets_out"] >= 2  # Her connect and her update
+            assert snapshot["packets_in"] == 3
+
+            text = render_prometheus({"arena": snapshot})
+            assert 'udp_packets_in_total{lobby="arena"} 3' in text
+            assert 'udp_peer_packets_in_total{lobby="arena",peer="alice"} 2' in text
+            assert 'udp_rtt_seconds_bucket{lobby="arena",le="+Inf"}' in text
+            assert "# TYPE udp_tick_seconds histogram" in text
+
+            # A departed peer's counts stay in the lobby totals
+            bob.sendto(json.dumps({"type": "disconnect", "client_id": "bob"}).encode("utf-8"),
+                       ("127.0.0.1", server.reliable_port))
+            await asyncio.sleep(0.05)
+            snapshot = server.metrics_snapshot()
+            assert "bob" not in snapshot["peers"]
+            assert snapshot["packets_in"] == 4
+        finally:
+            server.stop()
+            alice.close()
+            bob.close()
+            await asyncio.sleep(0)
+
+    asyncio.run(scenario())
+
+
+def test_rate_limit_filter_counts_what_it_suppressed(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr("app.utils.protocols.log.time.monotonic", lambda: now[0])
+    rate_limit = RateLimitFilter(interval=5.0)
+
+    def record(arg):
+        record = logging.LogRecord("app.udp", logging.WARNING, __file__, 1, "Error handling packet: %s", (arg,), None)
+        record.rate_limit = True
+        return record
+
+    assert rate_limit.filter(record("a"))
+    # Same template with other arguments is the same message
+    assert not rate_limit.filter(record("b"))
+    assert not rate_limit.filter(record("c"))
+    now[0] = 5.0
+    late = record("d")
+    assert rate_limit.filter(late)
+    assert late.getMessage() == "Error handling packet: d (2 similar messages suppressed)"
+
+
+def test_lifecycle_logs_are_not_rate_limited(caplog, monkeypatch):
+    # Start from a filter that has not seen earlier tests' errors
+    monkeypatch.setattr(logging.getLogger("app.udp"), "filters", [RateLimitFilter()])
+    server = GameServer("127.0.0.1", free_port(), free_port(), heartbeat_interval=None)
+    try:
+        with caplog.at_level(logging.INFO, logger="app.udp"):
+            for port, client_id in enumerate(("alice", "bob", "carol")):
+                packet = {"type": "connect", "client_id": client_id}
+                server.on_datagram(json.dumps(packet).encode("utf-8"), ("127.0.0.1", 6000 + port), True)
+            for _ in range(3):
+                server.on_datagram(b"{", ("127.0.0.1", 6000), True)
+    finally:
+        server.stop()
+    messages = [record.getMessage() for record in caplog.records]
+    assert sum(message.startswith("Client ") and " connected " in message for message in messages) == 3
+    assert sum(message.startswith("Error handling packet") for message in messages) == 1
+
+
+def test_stale_unreliable_updates_are_not_relayed():
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        server = GameServer("127.0.0.1", free_port(), free_port(), loop=loop, heartbeat_interval=None)
+        alice, bob = udp_client(), udp_client()
+        try:
+            for client_id, sock in (("alice", alice), ("bob", bob)):
+                packet = {"type": "connect", "client_id": client_id}
+                sock.sendto(json.dumps(packet).encode("utf-8"), ("127.0.0.1", server.reliable_port))
+            await asyncio.sleep(0.05)
+            # A reordered 3 and a duplicated 5 are dropped, 6 still gets through
+            for seq in (5, 3, 5, 6):
+                update = {"type": "update", "client_id": "alice", "seq": seq, "data": {"x": seq}}
+                alice.sendto(json.dumps(update).encode("utf-8"), ("127.0.0.1", server.unreliable_port))
+                await asyncio.sleep(0.01)
+            relayed = []
+            while len(relayed) < 2:
+                packet = await receive(loop, bob)
+                if packet["type"] == "update":
+                    relayed.append(packet["data"]["x"])
+            assert relayed == [5, 6]
+            assert server.metrics_snapshot()["stale_dropped"] == 2
+        finally:
+            server.stop()
+            alice.close()
+            bob.close()
+            await asyncio.sleep(0)
+
+    asyncio.run(scenario())
+
+
+def test_update_sequences_wrap_at_32_bits():
+    server = GameServer("127.0.0.1", free_port(), free_port(), heartbeat_interval=None)
+    alice = ("127.0.0.1", 40001)
+    try:
+        server.on_datagram(json.dumps({"type": "connect", "client_id": "alice"}).encode("utf-8"), alice, True)
+        # Zero means no sequence, so 2**32 - 1 is followed by 1
+        for seq in (2 ** 32 - 2, 2 ** 32 - 1, 1, 2, 2 ** 32 - 1):
+            update = {"type": "update", "client_id": "alice", "seq": seq, "data": {}}
+            server.on_datagram(json.dumps(update).encode("utf-8"), alice, False)
+        assert server.unreliable_seqs[("alice", 0)] == 2
+        assert server.metrics_snapshot()["stale_dropped"] == 1
+    finally:
+        server.stop()
+
+    scheduler = ManualScheduler()
+    released = []
+    buffer = JitterBuffer(scheduler, lambda packet, address: released.append(packet["seq"]), delay=0.05)
+    for seq in (1, 2 ** 32 - 1, 2):
+        buffer.push(seq, {"seq": seq}, alice)
+    while scheduler.timers:
+        scheduler.fire()
+    assert released == [2 ** 32 - 1, 1, 2]
+
+
+def test_jitter_buffer_restores_order_and_bounds_depth():
+    scheduler = ManualScheduler()
+    released = []
+    buffer = JitterBuffer(scheduler, lambda packet, address: released.append(packet["seq"]), delay=0.05, depth=3)
+    for seq in (2, 1, 3):
+        buffer.push(seq, {"seq": seq}, ("127.0.0.1", 9))
+    assert released == []
+    while scheduler.timers:
+        scheduler.fire()
+    assert released == [1, 2, 3]
+
+    # A full buffer lets its oldest update through without waiting
+    for seq in (7, 5, 6, 4):
+        buffer.push(seq, {"seq": seq}, ("127.0.0.1", 9))
+    assert released[3:] == [4]
+
+
+@pytest.mark.parametrize("wire", [codec.JSON, codec.BINARY])
+def test_fragments_fit_the_size_and_reassemble_in_any_order(wire):
+    packet = {"type": "update", "client_id": "alice", "channel": 2, "data": {"blob": "x" * 5000}}
+    data = b"".join(wire.encode_body(packet).frame())
+    bodies = wire.fragment_bodies(data, 7, 2, 600)
+    frames = [b"".join(bytes(buffer) for buffer in body.frame(seq, 2 ** 32 - 1, 2 ** 32 - 1, codec.FLAG_RELIABLE))
+              for seq, body in enumerate(bodies, 2 ** 32 - 100)]
+    assert len(frames) > 1 and all(len(frame) <= 600 for frame in frames)
+
+    reassembler = Reassembler(ManualScheduler())
+    message = None
+    # Reversed, with a duplicate of the last fragment
+    for frame in [frames[-1]] + frames[::-1]:
+        fragment = wire.decode(frame)
+        assert fragment["type"] == "fragment" and fragment["channel"] == 2
+        message = reassembler.add(("127.0.0.1", 9), 2, fragment["frag_id"], fragment["frag_index"],
+                                  fragment["frag_count"], fragment["chunk"]) or message
+    assert wire.decode(message) == wire.decode(data)
+    assert not reassembler.partials and not reassembler.pending_bytes
+
+
+def test_only_missing_fragments_are_retransmitted(mock_threading):
+    scheduler = ManualScheduler()
+    sock = MagicMock()
+    handler = ReliableHandler(sock, scheduler=scheduler, fragment_size=300)
+    address = ("127.0.0.1", 5000)
+    handler.send_body(codec.BINARY.encode_body({"type": "update", "data": "x" * 1000}), [address])
+    sent = sock.sendmsg.call_count
+    assert sent == 4 and list(handler.peers[address].pending) == [1, 2, 3, 4]
+
+    # Fragment 2 was lost
+    handler.process_ack(address, 4, 0b101)
+    scheduler.fire()
+    retransmitted = [codec.BINARY.decode(b"".join(call.args[0])) for call in sock.sendmsg.call_args_list[sent:]]
+    assert [(packet["seq"], packet["frag_index"]) for packet in retransmitted] == [(2, 1)]
+
+
+def test_reassembly_is_bounded_in_memory_and_time():
+    scheduler = ManualScheduler()
+    reassembler = Reassembler(scheduler, timeout=5, max_pending_bytes=10)
+    address = ("127.0.0.1", 9)
+    reassembler.add(address, 0, 1, 0, 3, b"aaaa")
+    reassembler.add(address, 0, 2, 0, 3, b"bbbb")
+    # Over budget: the oldest message goes first
+    reassembler.add(address, 0, 2, 1, 3, b"bbbb")
+    assert [key[2] for key in reassembler.partials] == [2] and reassembler.pending_bytes[address] == 8
+
+    # Messages that stop making progress are dropped by their timer
+    scheduler.fire()
+    assert reassembler.partials  # Its last fragment only just arrived
+    reassembler.partials[(address, 0, 2)].last_progress -= 5
+    scheduler.fire()
+    assert not reassembler.partials and not reassembler.pending_bytes
+
+
+def test_server_reassembles_large_messages_and_relays_them_in_fragments():
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        server = GameServer("127.0.0.1", free_port(), free_port(), loop=loop, heartbeat_interval=None)
+        alice, bob = udp_client(), udp_client()
+        try:
+            for client_id, sock in (("alice", alice), ("bob", bob)):
+                packet = {"type": "connect", "client_id": client_id}
+                sock.sendto(json.dumps(packet).encode("utf-8"), ("127.0.0.1", server.reliable_port))
+            await asyncio.sleep(0.05)
+            update = {"type": "update", "client_id": "alice", "data": {"level": "#" * 6000}}
+            bodies = codec.JSON.fragment_bodies(json.dumps(update).encode("utf-8"), 1, 0, 1200)
+            for seq, body in enumerate(bodies, 1):
+                alice.sendto(b"".join(bytes(buffer) for buffer in body.frame(seq)),
+                             ("127.0.0.1", server.reliable_port))
+
+            reassembler = Reassembler(ManualScheduler())
+            message = None
+            while message is None:
+                data = await asyncio.wait_for(loop.sock_recv(bob, 4096), timeout=2)
+                assert len(data) <= 1200
+                packet = codec.JSON.decode(data)
+                if packet["type"] == "fragment":
+                    message = reassembler.add(("server", 0), 0, packet["frag_id"], packet["frag_index"],
+                                              packet["frag_count"], packet["chunk"])
+            assert json.loads(message)["data"] == update["data"]
+        finally:
+            server.stop()
+            alice.close()
+            bob.close()
+            await asyncio.sleep(0)
+
+    asyncio.run(scenario())
+
+
+def update_datagram(index: int) -> bytes:
+    return json.dumps({"type": "update", "client_id": f"player-{index % 8}", "seq": index,
+                       "data": {"pos": {"x": index * 0.5, "y": 12.25}, "health": 100, "state": "running"}}).encode("utf-8")
+
+
+def test_trained_dictionary_beats_plain_deflate_and_round_trips():
+    samples = [update_datagram(index) for index in range(200)]
+    dictionary = train_dictionary(samples)
+    assert 0 < len(dictionary) <= DICTIONARY_SIZE and b'"client_id": "player-' in dictionary
+
+    address = ("127.0.0.1", 9)
+    plain, trained = Compressor(), Compressor(dictionary)
+    plain.enable(address, 0)
+    assert not trained.enable(address, 12345)
+    assert trained.enable(address, dictionary_id(dictionary))
+    datagram = update_datagram(1000)
+    with_plain = b"".join(plain.process([datagram], address))
+    with_trained = b"".join(trained.process([datagram], address))
+    assert len(with_trained) < len(with_plain) < len(datagram)
+    assert with_trained[0] == COMPRESSED_MARKER
+    assert trained.decompress(with_trained) == datagram
+    stats = trained.stats()
+    assert stats["compression_input_bytes"] == len(datagram)
+    assert stats["compression_output_bytes"] == len(with_trained)
+
+
+def test_compression_backs_off_while_it_does_not_pay():
+    compressor = Compressor()
+    address = ("127.0.0.1", 9)
+    compressor.enable(address, True)
+    rng = random.Random(1)
+    noise = [rng.randbytes(200) for _ in range(ADAPT_WINDOW + 10)]
+    sent = [compressor.process([datagram], address) for datagram in noise]
+    # Incompressible data goes out as is, and once a window of it did not pay the rest is not tried
+    assert all(buffers[0] is datagram for buffers, datagram in zip(sent, noise))
+    assert compressor.attempts == ADAPT_WINDOW
+    assert compressor.stats()["compression_skipped"] == 10
+    assert compressor.skip == BACKOFF - 10
+
+
+def test_server_compresses_for_peers_that_ask_and_accepts_compressed_datagrams():
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        server = GameServer("127.0.0.1", free_port(), free_port(), loop=loop, heartbeat_interval=None,
+                            compression=True)
+        alice, bob = udp_client(), udp_client()
+        try:
+            for client_id, sock in (("alice", alice), ("bob", bob)):
+                packet = {"type": "connect", "client_id": client_id, "compression": 0}
+                sock.sendto(json.dumps(packet).encode("utf-8"), ("127.0.0.1", server.reliable_port))
+            await asyncio.sleep(0.05)
+
+            # Alice compresses too, with the same raw deflate and (empty) dictionary
+            deflate = zlib.compressobj(6, zlib.DEFLATED, -15)
+            datagram = update_datagram(3)
+            alice.sendto(COMPRESSED.pack(COMPRESSED_MARKER, 0) + deflate.compress(datagram) + deflate.flush(),
+                         ("127.0.0.1", server.unreliable_port))
+            while True:
+                data = await asyncio.wait_for(loop.sock_recv(bob, 4096), timeout=2)
+                if data[0] != COMPRESSED_MARKER:
+                    assert len(data) < 64  # Too small to be worth it
+                    continue
+                packet = json.loads(zlib.decompressobj(-15).decompress(data[COMPRESSED.size:]))
+                if packet["type"] == "update":
+                    break
+            assert packet["data"] == json.loads(datagram)["data"]
+            assert server.metrics_snapshot()["compression_output_bytes"] > 0
+        finally:
+            server.stop()
+            alice.close()
+            bob.close()
+            await asyncio.sleep(0)
+
+    asyncio.run(scenario())
+
+
+def test_connect_asking_for_an_unhashable_dictionary_connects_uncompressed():
+    server = GameServer("127.0.0.1", free_port(), free_port(), heartbeat_interval=None, compression=True)
+    address = ("127.0.0.1", 5000)
+    try:
+        for compression in ([0], {"id": 0}, 0.0):
+            packet = {"type": "connect", "client_id": "alice", "compression": compression}
+            server.on_datagram(json.dumps(packet).encode("utf-8"), address, True)
+            assert server.clients == {"alice": address}
+            assert address not in server.compressor.peers
+    finally:
+        server.stop()
+
+
+def test_capture_round_trips_records_and_drops_past_its_buffer(tmp_path):
+    path = str(tmp_path / "lobby.cap")
+    writer = CaptureWriter(path, max_buffered_bytes=100)
+    writer.record((b'{"type": "connect"}',), ("127.0.0.1", 4000), False, True)
+    writer.record((b"\x01head", memoryview(b"body")), ("::1", 4001), True, False)
+    writer.record((b"x" * 101,), ("127.0.0.1", 4000), False, False)  # Over the buffer
+    writer.close()
+
+    records = list(read_capture(path))
+    assert [(r.outbound, r.reliable, r.address, r.data) for r in records] == [
+        (False, True, ("127.0.0.1", 4000), b'{"type": "connect"}'),
+        (True, False, ("::1", 4001), b"\x01headbody"),
+    ]
+    assert 0 <= records[0].time <= records[1].time
+    assert writer.dropped == 1
+
+    # A record cut short by a crash ends the capture
+    with open(path, "rb") as capture:
+        data = capture.read()
+    with open(path, "wb") as capture:
+        capture.write(data[:-3])
+    assert len(list(read_capture(path))) == 1
+
+
+def test_server_capture_replays_into_a_new_lobby(tmp_path):
+    path = str(tmp_path / "lobby.cap")
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        server = GameServer("127.0.0.1", free_port(), free_port(), loop=loop, heartbeat_interval=None,
+                            capture_path=path)
+        alice, bob = udp_client(), udp_client()
+        try:
+            for client_id, sock in (("alice", alice), ("bob", bob)):
+                packet = {"type": "connect", "client_id": client_id}
+                sock.sendto(json.dumps(packet).encode("utf-8"), ("127.0.0.1", server.reliable_port))
+            await asyncio.sleep(0.05)
+            update = json.dumps({"type": "update", "client_id": "alice", "data": {"x": 1}}).encode("utf-8")
+            alice.sendto(update, ("127.0.0.1", server.unreliable_port))
+            await asyncio.sleep(0.05)
+        finally:
+            server.stop()
+            alice.close()
+            bob.close()
+            await asyncio.sleep(0)
+
+    asyncio.run(scenario())
+    records = list(read_capture(path))
+    inbound = [record for record in records if not record.outbound]
+    assert [json.loads(record.data)["type"] for record in inbound] == ["connect", "connect", "update"]
+    assert [record.reliable for record in inbound] == [True, True, False]
+    relayed = [json.loads(record.data) for record in records if record.outbound]
+    assert {"type": "update", "client_id": "alice", "data": {"x": 1}, "client_index": 0} in relayed
+
+    # Replayed into a fresh lobby, the same clients connect from stand-in addresses
+    server = GameServer("127.0.0.1", free_port(), free_port(), heartbeat_interval=None)
+    try:
+        assert replay(server, records, speed=0) == 3
+        assert set(server.clients) == {"alice", "bob"}
+        assert all(address[0].startswith("127.") for address in server.clients.values())
+        assert server.metrics_snapshot()["packets_in"] == 3
+    finally:
+        server.stop()
@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+from app.utils.sharding import ShardedUDPManager
+
+
+@pytest.fixture
+def sharded_manager():
+    manager = ShardedUDPManager(workers=2)
+    yield manager
+    manager.stop_all_servers()
+
+
+def test_lobbies_spread_over_shards_and_route_calls(sharded_manager):
+    sharded_manager.create_server("alpha", "admin")
+    sharded_manager.create_server("beta", "admin")
+    # Both shards are idle, so the lobby count breaks the tie
+    assert sharded_manager.lobby_shards["alpha"] is not sharded_manager.lobby_shards["beta"]
+
+    with pytest.raises(ValueError):
+        sharded_manager.create_server("alpha", "admin")
+
+    reliable_port, unreliable_port = sharded_manager.join_server("beta", "player1")
+    lobbies = {lobby["name"]: lobby for lobby in sharded_manager.list_lobbies()}
+    assert set(lobbies) == {"alpha", "beta"}
+    assert (lobbies["beta"]["reliable_port"], lobbies["beta"]["unreliable_port"]) == (reliable_port, unreliable_port)
+
+    sharded_manager.remove_server("alpha")
+    assert not sharded_manager.has_lobby("alpha") and sharded_manager.has_lobby("beta")
+    with pytest.raises(ValueError):
+        sharded_manager.join_server("alpha", "player1")
+
+
+def test_lobbies_a_shard_removes_on_its_own_free_their_name(sharded_manager):
+    async def scenario():
+        subscription = sharded_manager.events.subscribe(asyncio.get_running_loop())
+        sharded_manager.create_server("alpha", "admin")
+        version = sharded_manager.listing_version()
+        event = await asyncio.wait_for(subscription.get(), timeout=2)
+        assert event["type"] == "lobby_created" and event["lobby"]["name"] == "alpha"
+
+        # As when the shard expires it, without going through the parent
+        shard = sharded_manager.lobby_shards["alpha"]
+        shard.call("remove_server", "alpha")
+        assert not sharded_manager.has_lobby("alpha")
+        assert sharded_manager.listing_version() > version
+        event = await asyncio.wait_for(subscription.get(), timeout=2)
+        assert event == {"type": "lobby_removed", "version": sharded_manager.listing_version(), "lobby": "alpha"}
+
+        sharded_manager.create_server("alpha", "admin")
+        assert sharded_manager.has_lobby("alpha")
+
+    asyncio.run(scenario())
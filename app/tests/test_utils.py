@@ -5,8 +5,10 @@ from app.models.lobby import Lobby
 from app.models.player import Player
 from unittest.mock import MagicMock
 import json
+import os
 import time
 import socket
+import threading
 
 def test_root(client):
     response = client.get("/")
@@ -94,3 +96,87 @@ def test_lobby_operations(client, mock_udp_manager):
     lobbies = response.json()
     assert len(lobbies[0]["players"]) == 0
  
+
+def test_empty_lobbies_expire_unless_joined():
+    manager = UDPManager(empty_lobby_timeout=0.3)
+    try:
+        manager.create_server("idle", "admin")
+        manager.create_server("joined", "admin")
+        time.sleep(0.2)
+        # A join pushes the deadline out for the player about to connect
+        manager.join_server("joined", "player1")
+        time.sleep(0.2)
+        assert not manager.has_lobby("idle") and manager.has_lobby("joined")
+        time.sleep(0.2)
+        assert not manager.has_lobby("joined")
+    finally:
+        manager.stop_all_servers()
+
+
+def test_racing_creates_of_one_name_make_one_lobby():
+    manager = UDPManager()
+    barrier = threading.Barrier(8)
+    outcomes = []
+
+    def create():
+        barrier.wait()
+        try:
+            manager.create_server("contested", "admin")
+            outcomes.append("created")
+        except ValueError:
+            outcomes.append("exists")
+
+    try:
+        threads = [threading.Thread(target=create) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sorted(outcomes) == ["created"] + ["exists"] * 7
+        assert [lobby["name"] for lobby in manager.list_lobbies()] == ["contested"]
+        assert manager.listing_version() == 1
+        # Every lobby still holds two ports of its own
+        assert len(manager.used_ports) == 2
+    finally:
+        manager.stop_all_servers()
+    assert not manager.used_ports
+
+
+def test_failed_creates_give_their_ports_back():
+    manager = UDPManager()
+    try:
+        with pytest.raises(ValueError):
+            manager.create_server("bad", "admin", channels={0: "reliable_ordered"})
+        with pytest.raises(ValueError):
+            manager.create_server("bad", "admin", tick_rate=-1)
+        assert not manager.used_ports and not manager.has_lobby("bad")
+    finally:
+        manager.stop_all_servers()
+
+
+def test_lobbies_capture_into_a_directory_they_create(tmp_path):
+    manager = UDPManager(capture_dir=str(tmp_path / "captures" / "today"))
+    try:
+        manager.create_server("eu-1", "admin")
+        assert [name.startswith("eu-1-") for name in os.listdir(tmp_path / "captures" / "today")] == [True]
+    finally:
+        manager.stop_all_servers()
+
+    # A capture that cannot be opened fails the create before any socket or thread exists
+    (tmp_path / "not-a-dir").write_text("")
+    manager = UDPManager(capture_dir=str(tmp_path / "not-a-dir"))
+    threads = threading.active_count()
+    try:
+        for _ in range(3):
+            with pytest.raises(OSError):
+                manager.create_server("eu-1", "admin")
+        assert threading.active_count() == threads
+        assert not manager.used_ports and not manager.has_lobby("eu-1")
+    finally:
+        manager.stop_all_servers()
+
+    port = manager.reserve_port()
+    threads = threading.active_count()
+    with pytest.raises(OSError):
+        GameServer("127.0.0.1", port, port, capture_path=str(tmp_path / "missing" / "eu-1.cap"))
+    assert threading.active_count() == threads
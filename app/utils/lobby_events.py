@@ -0,0 +1,78 @@
+import asyncio
+import threading
+from typing import Set
+
+# Events a subscriber may fall behind by before it is resynced with a fresh snapshot
+MAX_PENDING_EVENTS = 1000
+
+
+class Subscription:
+    """One subscriber's queue of lobby events, consumed on its event loop."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, max_pending: int = MAX_PENDING_EVENTS):
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(max_pending)
+        # Set once an event was lost to a full queue, the consumer must resync
+        self.overflowed = False
+
+    def push(self, event: dict):
+        """Queue an event from any thread."""
+        try:
+            self.loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            pass  # The subscriber's loop is closed, it will unsubscribe on its way out
+
+    def _put(self, event: dict):
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    def reset(self):
+        """Forget queued events before the consumer takes a new snapshot. Call on the loop."""
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.overflowed = False
+
+    async def get(self) -> dict:
+        return await self.queue.get()
+
+
+class LobbyEvents:
+    """Fan-out of lobby changes to subscribers such as /lobbies/events streams.
+
+    Every event is a dict with a type, the listing version the change
+    produced, and its details. A subscriber that takes a snapshot after
+    subscribing can skip events whose version is not above the snapshot's:
+    the snapshot already shows them. Events above it may still repeat what
+    the snapshot shows, so applying them must be idempotent.
+    """
+
+    def __init__(self):
+        self.subscribers: Set[Subscription] = set()
+        self.lock = threading.Lock()
+
+    def subscribe(self, loop: asyncio.AbstractEventLoop) -> Subscription:
+        subscription = Subscription(loop)
+        self.attach(subscription)
+        return subscription
+
+    def attach(self, subscriber):
+        """Add any subscriber with a thread safe push(event), such as a shard's pipe to its parent."""
+        with self.lock:
+            self.subscribers.add(subscriber)
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            self.subscribers.discard(subscription)
+
+    def publish(self, event_type: str, version: int, **details):
+        with self.lock:
+            if not self.subscribers:
+                return
+            subscribers = list(self.subscribers)
+        event = {"type": event_type, "version": version, **details}
+        for subscription in subscribers:
+            subscription.push(event)
@@ -0,0 +1,91 @@
+import bisect
+import json
+import secrets
+from typing import Dict, List, Optional, Tuple
+
+from fastapi.encoders import jsonable_encoder
+
+from ..models.lobby import Lobby
+from ..models.player import Player
+
+# Rendered pages kept per listing version, enough for the queries browsers repeat
+MAX_CACHED_PAGES = 64
+
+
+def lobby_from_info(info: dict) -> Lobby:
+    """API model for one entry of a manager's list_lobbies."""
+    return Lobby(
+        name=info["name"],
+        id=info["name"],  # Assuming lobby ID is the same as the name
+        ip=info["host"],
+        port_reliable=info["reliable_port"],
+        port_unreliable=info["unreliable_port"],
+        players=[Player(name=pid, id=pid, ready=pid in info.get("ready", ())) for pid in info["players"]],
+        route_id=info.get("route_id"),
+        max_players=info.get("max_players"),
+    )
+
+
+class LobbyListing:
+    """The lobby list in API form, rebuilt only when the manager's listing version moves.
+
+    Lobbies are kept sorted by name, so a name prefix is a bisect and a
+    cursor is the last name of the previous page. Rendered pages are cached
+    per query until the next rebuild, which makes repeated polling a version
+    check and a dict lookup. Used from the event loop only.
+    """
+
+    def __init__(self):
+        self.manager = None
+        self.version: Optional[int] = None
+        # Versions restart with the process, the epoch keeps old ETags from matching
+        self.epoch = secrets.token_hex(4)
+        self.names: List[str] = []
+        self.lobbies: List[dict] = []
+        self.pages: Dict[tuple, Tuple[bytes, Optional[str]]] = {}
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.epoch}-{self.version}"'
+
+    def refresh(self, manager):
+        # Read the version first, so a change racing the rebuild only makes it fresher than its tag
+        version = manager.listing_version()
+        if manager is self.manager and version == self.version:
+            return
+        lobbies = sorted((jsonable_encoder(lobby_from_info(info)) for info in manager.list_lobbies()),
+                         key=lambda lobby: lobby["name"])
+        self.manager, self.version = manager, version
+        self.names = [lobby["name"] for lobby in lobbies]
+        self.lobbies = lobbies
+        self.pages = {}
+
+    def page(self, prefix: Optional[str] = None, free_slots: bool = False,
+             cursor: Optional[str] = None, limit: Optional[int] = None) -> Tuple[bytes, Optional[str]]:
+        """JSON body of the matching lobbies after cursor, and the cursor of the next page if any."""
+        key = (prefix, free_slots, cursor, limit)
+        cached = self.pages.get(key)
+        if cached is None:
+            lobbies, next_cursor = self._select(prefix, free_slots, cursor, limit)
+            cached = json.dumps(lobbies, separators=(",", ":")).encode("utf-8"), next_cursor
+            if len(self.pages) >= MAX_CACHED_PAGES:
+                self.pages.clear()
+            self.pages[key] = cached
+        return cached
+
+    def _select(self, prefix: Optional[str], free_slots: bool, cursor: Optional[str],
+                limit: Optional[int]) -> Tuple[List[dict], Optional[str]]:
+        start = bisect.bisect_left(self.names, prefix) if prefix else 0
+        if cursor is not None:
+            start = max(start, bisect.bisect_right(self.names, cursor))
+        selected = []
+        for index in range(start, len(self.names)):
+            if prefix and not self.names[index].startswith(prefix):
+                break  # Sorted, so nothing later matches either
+            lobby = self.lobbies[index]
+            if free_slots and lobby["max_players"] is not None and len(lobby["players"]) >= lobby["max_players"]:
+                continue
+            if limit is not None and len(selected) == limit:
+                return selected, selected[-1]["name"]
+            selected.append(lobby)
+        return selected, None
@@ -0,0 +1,104 @@
+import threading
+import zlib
+from types import MappingProxyType
+from typing import FrozenSet, Iterator, Mapping, Optional, Tuple
+
+from .protocols.scheduler import Timer
+from .protocols.udp_client import GameServer
+
+LOCK_STRIPES = 16
+
+
+class LobbyEntry:
+    """Everything the manager tracks about one lobby."""
+    __slots__ = ("name", "server", "admin_id", "route_id", "max_players", "last_activity", "expiry",
+                 "players", "ready")
+
+    def __init__(self, name: str, server: GameServer, admin_id: str, route_id: Optional[int],
+                 max_players: Optional[int], last_activity: float):
+        self.name = name
+        self.server = server
+        self.admin_id = admin_id
+        self.route_id = route_id
+        # None for no limit
+        self.max_players = max_players
+        self.last_activity = last_activity
+        # Expiry deadline while the lobby is empty, None while it has players
+        self.expiry: Optional[Timer] = None
+        # Players and ready players as last announced, to tell what changed
+        self.players: FrozenSet[str] = frozenset()
+        self.ready: FrozenSet[str] = frozenset()
+
+
+class LobbyRegistry:
+    """Lobby name to LobbyEntry map for many concurrent readers and few writers.
+
+    Reads never lock: the map is copy-on-write, so get, iteration and
+    snapshot see one consistent version even while lobbies come and go.
+    Writers serialise per name on one of a fixed set of striped locks, held
+    across the whole create, join or remove so those are atomic per lobby
+    without blocking work on lobbies that hash to other stripes. Publishing
+    a new version of the map takes a short global lock for the copy.
+
+    version goes up whenever a lobby is added or removed or touch() reports
+    a change inside one, so readers can cache anything derived from the
+    lobbies until it moves.
+    """
+
+    def __init__(self, stripes: int = LOCK_STRIPES):
+        self._entries: Mapping[str, LobbyEntry] = MappingProxyType({})
+        self._publish_lock = threading.Lock()
+        self.version = 0
+        # Reentrant so a locked operation can call another one on the same lobby
+        self._stripes = [threading.RLock() for _ in range(stripes)]
+
+    def lock_for(self, name: str) -> threading.RLock:
+        """The lock writers of this lobby hold. crc32 keeps the stripe stable across runs."""
+        return self._stripes[zlib.crc32(name.encode("utf-8")) % len(self._stripes)]
+
+    def get(self, name: str) -> Optional[LobbyEntry]:
+        return self._entries.get(name)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._entries)
+
+    def snapshot(self) -> Mapping[str, LobbyEntry]:
+        """The current version of the map. Later writes publish a new one and leave it alone."""
+        return self._entries
+
+    def items(self) -> Iterator[Tuple[str, LobbyEntry]]:
+        return iter(self._entries.items())
+
+    def add(self, entry: LobbyEntry) -> bool:
+        """Publish entry unless its name is taken. Call with lock_for(entry.name) held."""
+        with self._publish_lock:
+            if entry.name in self._entries:
+                return False
+            entries = dict(self._entries)
+            entries[entry.name] = entry
+            self._entries = MappingProxyType(entries)
+            self.version += 1
+        return True
+
+    def pop(self, name: str) -> Optional[LobbyEntry]:
+        """Unpublish and return a lobby. Call with lock_for(name) held."""
+        with self._publish_lock:
+            entry = self._entries.get(name)
+            if entry is not None:
+                entries = dict(self._entries)
+                del entries[name]
+                self._entries = MappingProxyType(entries)
+                self.version += 1
+        return entry
+
+    def touch(self) -> int:
+        """Note that something listed about a lobby, like its players, changed."""
+        with self._publish_lock:
+            self.version += 1
+            return self.version
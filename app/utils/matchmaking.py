@@ -0,0 +1,248 @@
+import heapq
+import itertools
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Deque, Dict, Hashable, List, Optional, Tuple
+
+from .protocols.log import logger
+
+# Players per matchmade lobby, and how many must be queued before a new one is opened
+MATCH_LOBBY_SIZE = 8
+MATCH_MIN_PLAYERS = 2
+# Seconds a matched or failed ticket stays around for its player to pick up
+MATCHED_TICKET_TTL = 300.0
+
+
+class Ticket:
+    """A player's place in the queue.
+
+    Its status goes from waiting to placing while its lobby is joined or
+    created, then to matched or failed. Cancelled tickets are forgotten.
+    """
+    __slots__ = ("player_id", "pool", "status", "lobby", "ports", "settled_at")
+
+    def __init__(self, player_id: str, pool: Hashable):
+        self.player_id = player_id
+        self.pool = pool
+        self.status = "waiting"
+        self.lobby: Optional[str] = None
+        self.ports: Optional[Tuple[int, int]] = None
+        # When the ticket was matched or failed
+        self.settled_at = 0.0
+
+    def as_dict(self) -> dict:
+        return {"player_id": self.player_id, "status": self.status, "lobby": self.lobby}
+
+
+class _Pool:
+    """Waiting players and lobbies with open slots for one set of match attributes."""
+    __slots__ = ("waiting", "waiting_count", "open_lobbies")
+
+    def __init__(self):
+        # FIFO of tickets, cancelled ones are skipped when they reach the front
+        self.waiting: Deque[Ticket] = deque()
+        self.waiting_count = 0
+        # (free slots, creation order, lobby name): the fullest lobby is filled first
+        self.open_lobbies: List[Tuple[int, int, str]] = []
+
+
+class Matchmaker:
+    """Queues players and groups them into lobbies by capacity and attributes.
+
+    Players with the same region and skill bucket share a pool. A player is
+    placed straight into the pool's fullest lobby that still has a free
+    slot. Without one, players wait until min_players of them are queued,
+    and then a lobby of lobby_size is created for them through the manager.
+    Its remaining slots are kept for later players. Enqueue, cancel and
+    status take O(log n) in the lobbies open in that pool at most, and never
+    look at lobbies of other pools.
+
+    Slots are counted when a player is matched, not when it connects. A
+    player who leaves a matchmade lobby does not free its slot for
+    matchmaking; the lobby's max_players still bounds direct joins.
+
+    If the manager fails to create a lobby, the tickets of that group are
+    marked failed rather than queued again, since the same group would
+    likely fail the same way. Their players may enqueue again.
+
+    Creating and joining lobbies goes through the manager's own locks and
+    binds sockets, so it runs after the matchmaker's lock is released, with
+    the tickets involved placing in the meantime. Matchmade lobbies get
+    random names, which keeps them clear of lobbies created by name.
+    """
+
+    def __init__(self, udp_manager, lobby_size: int = MATCH_LOBBY_SIZE,
+                 min_players: int = MATCH_MIN_PLAYERS, matched_ttl: float = MATCHED_TICKET_TTL):
+        if not 1 <= min_players <= lobby_size:
+            raise ValueError(f"Need 1 <= min_players <= lobby_size, got {min_players} and {lobby_size}.")
+        self.udp_manager = udp_manager
+        self.lobby_size = lobby_size
+        self.min_players = min_players
+        self.matched_ttl = matched_ttl
+        self.pools: Dict[Hashable, _Pool] = {}
+        self.tickets: Dict[str, Ticket] = {}
+        # Matched and failed tickets in the order they settled, dropped once
+        # their player had time to pick them up
+        self.settled: Deque[Ticket] = deque()
+        self.lobby_counter = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def enqueue(self, player_id: str, region: Optional[str] = None,
+                skill_bucket: Optional[int] = None) -> Ticket:
+        """Queue a player, or match it right away when a lobby has room.
+
+        Raises ValueError if the player is already waiting or being placed.
+        """
+        with self.lock:
+            self._expire_settled(time.monotonic())
+            ticket = self.tickets.get(player_id)
+            if ticket is not None and ticket.status in ("waiting", "placing"):
+                raise ValueError(f"Player {player_id} is already queued.")
+            ticket = self.tickets[player_id] = Ticket(player_id, (region, skill_bucket))
+            lobby, group = self._place(ticket)
+        while lobby is not None:
+            try:
+                ports = self.udp_manager.join_server(lobby, player_id)
+            except ValueError:
+                # Expired, removed or filled by direct joins: it leaves the pool
+                with self.lock:
+                    self._close_lobby(ticket.pool, lobby)
+                    if ticket.status != "placing":
+                        return ticket
+                    lobby, group = self._place(ticket)
+                continue
+            with self.lock:
+                if ticket.status == "placing":
+                    self._match(ticket, lobby, ports)
+            return ticket
+        if group is not None:
+            self._open_lobby(ticket.pool, group)
+        return ticket
+
+    def cancel(self, player_id: str) -> bool:
+        """Take a waiting player out of the queue, or forget a matched ticket."""
+        with self.lock:
+            ticket = self.tickets.pop(player_id, None)
+            if ticket is None:
+                return False
+            if ticket.status == "waiting":
+                ticket.status = "cancelled"
+                pool = self.pools[ticket.pool]
+                pool.waiting_count -= 1
+                self._drop_if_idle(ticket.pool, pool)
+            elif ticket.status == "placing":
+                # Its lobby is joined or created without it, the slot stays free
+                ticket.status = "cancelled"
+            return True
+
+    def status(self, player_id: str) -> Optional[Ticket]:
+        with self.lock:
+            return self.tickets.get(player_id)
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                "pools": len(self.pools),
+                "waiting": sum(pool.waiting_count for pool in self.pools.values()),
+                "open_lobbies": sum(len(pool.open_lobbies) for pool in self.pools.values()),
+            }
+
+    def _place(self, ticket: Ticket) -> Tuple[Optional[str], Optional[List[Ticket]]]:
+        """Reserve ticket a slot in its pool's fullest open lobby, or queue it.
+
+        Returns the lobby to join, or else the group to open a lobby for once
+        the queue is long enough. Both are left to the caller to do with the
+        lock released. Called with the lock held.
+        """
+        pool = self.pools.get(ticket.pool)
+        if pool is None:
+            pool = self.pools[ticket.pool] = _Pool()
+        if pool.open_lobbies:
+            free, order, lobby = heapq.heappop(pool.open_lobbies)
+            if free > 1:
+                heapq.heappush(pool.open_lobbies, (free - 1, order, lobby))
+            ticket.status = "placing"
+            return lobby, None
+        pool.waiting.append(ticket)
+        pool.waiting_count += 1
+        if pool.waiting_count < self.min_players:
+            return None, None
+        group = []
+        while len(group) < self.min_players:
+            waiting = pool.waiting.popleft()
+            if waiting.status == "waiting":
+                waiting.status = "placing"
+                group.append(waiting)
+        pool.waiting_count -= len(group)
+        self._drop_if_idle(ticket.pool, pool)
+        return None, group
+
+    def _close_lobby(self, pool_key: Hashable, lobby: str):
+        pool = self.pools.get(pool_key)
+        if pool is not None:
+            pool.open_lobbies = [entry for entry in pool.open_lobbies if entry[2] != lobby]
+            heapq.heapify(pool.open_lobbies)
+            self._drop_if_idle(pool_key, pool)
+
+    def _open_lobby(self, pool_key: Hashable, group: List[Ticket]):
+        """Create a lobby for a group and join its players. Called without the lock."""
+        lobby = f"match-{uuid.uuid4().hex[:12]}"
+        try:
+            self.udp_manager.create_server(lobby, group[0].player_id, max_players=self.lobby_size)
+        except Exception as e:
+            logger.error("Could not create matchmade lobby %s: %s", lobby, e)
+            with self.lock:
+                now = time.monotonic()
+                for ticket in group:
+                    if ticket.status == "placing":
+                        ticket.status = "failed"
+                        self._settle(ticket, now)
+            return
+        joined = []
+        for ticket in group:
+            try:
+                joined.append((ticket, self.udp_manager.join_server(lobby, ticket.player_id)))
+            except ValueError as e:
+                # Removed again before its players got in
+                logger.error("Could not join matchmade lobby %s: %s", lobby, e)
+                break
+        with self.lock:
+            now = time.monotonic()
+            placed = 0
+            for ticket, ports in joined:
+                if ticket.status == "placing":
+                    self._match(ticket, lobby, ports)
+                    placed += 1
+            for ticket in group[len(joined):]:
+                if ticket.status == "placing":
+                    ticket.status = "failed"
+                    self._settle(ticket, now)
+            if len(joined) < len(group):
+                return
+            if self.lobby_size > placed:
+                pool = self.pools.get(pool_key)
+                if pool is None:
+                    pool = self.pools[pool_key] = _Pool()
+                heapq.heappush(pool.open_lobbies, (self.lobby_size - placed, next(self.lobby_counter), lobby))
+
+    def _match(self, ticket: Ticket, lobby: str, ports: Tuple[int, int]):
+        ticket.status = "matched"
+        ticket.lobby = lobby
+        ticket.ports = tuple(ports)
+        self._settle(ticket, time.monotonic())
+
+    def _settle(self, ticket: Ticket, now: float):
+        ticket.settled_at = now
+        self.settled.append(ticket)
+
+    def _expire_settled(self, now: float):
+        while self.settled and now - self.settled[0].settled_at > self.matched_ttl:
+            ticket = self.settled.popleft()
+            if self.tickets.get(ticket.player_id) is ticket:
+                del self.tickets[ticket.player_id]
+
+    def _drop_if_idle(self, pool_key: Hashable, pool: _Pool):
+        if not pool.waiting_count and not pool.open_lobbies:
+            del self.pools[pool_key]
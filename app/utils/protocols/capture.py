@@ -0,0 +1,192 @@
+# capture.py
+import socket
+import struct
+import threading
+import time
+from typing import BinaryIO, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+from .codec import Buffer
+from .log import logger
+
+# A capture file starts with the magic, a version and the wall clock time it was started at
+MAGIC = b"GSFCAP"
+VERSION = 1
+HEADER = struct.Struct("!6sBd")
+# Then one record per datagram: seconds since the start, flags, port and length,
+# followed by the 4 or 16 byte address and the datagram itself
+RECORD = struct.Struct("!dBHI")
+FLAG_OUTBOUND = 0x01
+FLAG_RELIABLE = 0x02
+FLAG_IPV6 = 0x04
+
+# Bytes of datagrams waiting for the writer thread, past which new ones are dropped
+MAX_BUFFERED_BYTES = 8 << 20
+# Seconds the writer thread lets datagrams gather before writing them out
+WRITE_INTERVAL = 0.1
+
+Address = Tuple[str, int]
+
+
+class CaptureRecord(NamedTuple):
+    time: float
+    outbound: bool
+    reliable: bool
+    address: Address
+    data: bytes
+
+
+class CaptureWriter:
+    """Appends a lobby's datagrams, both ways, to a capture file.
+
+    record() only copies the datagram into a buffer. A background thread
+    encodes and writes what gathered every WRITE_INTERVAL seconds, or sooner
+    once half the buffer is used. While the writer falls max_buffered_bytes
+    behind, datagrams are dropped and counted rather than slowing the lobby
+    down. Times are monotonic seconds since the capture was opened.
+    Datagrams are kept as they were on the wire, and replay() feeds a
+    capture back into a server.
+    """
+
+    def __init__(self, path: str, max_buffered_bytes: int = MAX_BUFFERED_BYTES):
+        self.path = path
+        self.max_buffered_bytes = max_buffered_bytes
+        # Never appends to an older capture, whose times would not line up
+        self.file: BinaryIO = open(path, "xb")
+        self.file.write(HEADER.pack(MAGIC, VERSION, time.time()))
+        self.started = time.monotonic()
+        self.pending: List[Tuple[float, int, Address, bytes]] = []
+        self.buffered_bytes = 0
+        self.recorded = 0
+        self.dropped = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def record(self, buffers: Sequence[Buffer], address: Address, outbound: bool, reliable: bool):
+        """Buffer one datagram, given as the buffers it is sent or was received in."""
+        data = b"".join(buffers)
+        now = time.monotonic()
+        flags = (FLAG_OUTBOUND if outbound else 0) | (FLAG_RELIABLE if reliable else 0)
+        with self.condition:
+            if self.closed:
+                return
+            if self.buffered_bytes + len(data) > self.max_buffered_bytes:
+                self.dropped += 1
+                return
+            self.pending.append((now, flags, address, data))
+            self.buffered_bytes += len(data)
+            self.recorded += 1
+            if self.buffered_bytes * 2 > self.max_buffered_bytes:
+                self.condition.notify()
+
+    def _write_loop(self):
+        # Packed addresses, most captures only ever see a few of them
+        addresses: Dict[Address, Tuple[int, bytes]] = {}
+        while True:
+            with self.condition:
+                if not self.closed and self.buffered_bytes * 2 <= self.max_buffered_bytes:
+                    self.condition.wait(WRITE_INTERVAL)
+                batch, self.pending = self.pending, []
+                self.buffered_bytes = 0
+                closed = self.closed
+            if batch:
+                try:
+                    for now, flags, address, data in batch:
+                        packed = addresses.get(address)
+                        if packed is None:
+                            packed = addresses[address] = pack_address(address)
+                        self.file.write(RECORD.pack(now - self.started, flags | packed[0], address[1], len(data)))
+                        self.file.write(packed[1])
+                        self.file.write(data)
+                    self.file.flush()
+                except (OSError, ValueError) as e:
+                    logger.error("Error writing capture %s, stopping it: %s", self.path, e)
+                    with self.condition:
+                        self.closed = True
+                    closed = True
+            if closed:
+                break
+        self.file.close()
+
+    def close(self):
+        """Write out what is still buffered and close the file."""
+        with self.condition:
+            if self.closed and not self.thread.is_alive():
+                return
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        if self.dropped:
+            logger.warning("Capture %s dropped %d of %d datagrams, the disk could not keep up",
+                           self.path, self.dropped, self.recorded + self.dropped)
+
+
+def pack_address(address: Address) -> Tuple[int, bytes]:
+    """Record flag and bytes of an address's host."""
+    if ":" in address[0]:
+        return FLAG_IPV6, socket.inet_pton(socket.AF_INET6, address[0])
+    return 0, socket.inet_aton(address[0])
+
+
+def read_capture(path: str) -> Iterator[CaptureRecord]:
+    """The records of a capture file in the order they were captured.
+
+    A record cut short at the end, as left by a crash, ends the capture.
+    """
+    with open(path, "rb") as capture:
+        header = capture.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise ValueError(f"{path} is not a capture file.")
+        magic, version, _ = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a capture file.")
+        if version != VERSION:
+            raise ValueError(f"Unsupported capture version {version} in {path}.")
+        while True:
+            fields = capture.read(RECORD.size)
+            if len(fields) < RECORD.size:
+                return
+            offset, flags, port, length = RECORD.unpack(fields)
+            ipv6 = flags & FLAG_IPV6
+            host = capture.read(16 if ipv6 else 4)
+            data = capture.read(length)
+            if len(data) < length:
+                return
+            host = socket.inet_ntop(socket.AF_INET6, host) if ipv6 else socket.inet_ntoa(host)
+            yield CaptureRecord(offset, bool(flags & FLAG_OUTBOUND), bool(flags & FLAG_RELIABLE), (host, port), data)
+
+
+def replay_address(index: int, port: int) -> Address:
+    """A loopback address standing in for the index-th peer of a capture."""
+    return f"127.{(1 + (index >> 16)) & 0xFF}.{(index >> 8) & 0xFF}.{index & 0xFF}", port
+
+
+def replay(server, records: Iterable[CaptureRecord], speed: Optional[float] = 1.0) -> int:
+    """Feed the inbound datagrams of a capture to a server, returning how many.
+
+    With speed 1 datagrams arrive as far apart as they were captured, with
+    10 ten times faster, and with None or 0 back to back. Every captured
+    peer is replaced by a loopback address of its own, so replies go
+    nowhere. Datagrams are fed from the calling thread in capture order,
+    which suits a thread engine server. An asyncio server must be replayed
+    from its loop.
+    """
+    addresses: Dict[Address, Address] = {}
+    origin: Optional[Tuple[float, float]] = None
+    fed = 0
+    for record in records:
+        if record.outbound:
+            continue
+        address = addresses.get(record.address)
+        if address is None:
+            address = addresses[record.address] = replay_address(len(addresses), record.address[1])
+        if speed:
+            if origin is None:
+                origin = (time.monotonic(), record.time)
+            delay = origin[0] + (record.time - origin[1]) / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        server.on_datagram(record.data, address, record.reliable)
+        fed += 1
+    return fed
@@ -0,0 +1,44 @@
+# channels.py
+"""Logical channels multiplexed over a lobby's two sockets.
+
+A channel number travels in the packet header, or a JSON "channel" field,
+and each channel has its own sequence space per peer, so a lost packet only
+stalls its own channel. Reliable ordered channels hand packets on in
+sequence, reliable unordered ones as they arrive, and sequenced ones drop
+packets older than the newest seen from the same sender. Packets on a
+channel are relayed on it.
+"""
+from typing import Dict, Mapping, Optional
+
+# Delivery modes of a logical channel
+RELIABLE_ORDERED = "reliable_ordered"
+RELIABLE_UNORDERED = "reliable_unordered"
+SEQUENCED = "sequenced"
+UNRELIABLE = "unreliable"
+MODES = (RELIABLE_ORDERED, RELIABLE_UNORDERED, SEQUENCED, UNRELIABLE)
+RELIABLE_MODES = frozenset((RELIABLE_ORDERED, RELIABLE_UNORDERED))
+
+# Channel 0 is the default every packet without a channel uses. Its mode is picked
+# by the socket a packet arrives on, as before channels existed.
+DEFAULT_CHANNEL = 0
+MAX_CHANNEL = 0xFF
+# e.g. chat and RPCs on 1, fire-and-forget events on 2, state sync on 3
+DEFAULT_CHANNELS: Dict[int, str] = {
+    1: RELIABLE_ORDERED,
+    2: RELIABLE_UNORDERED,
+    3: SEQUENCED,
+}
+
+
+def check_channels(channels: Optional[Mapping[int, str]]) -> Dict[int, str]:
+    """Validate a channel number to mode map, None meaning DEFAULT_CHANNELS."""
+    if channels is None:
+        return dict(DEFAULT_CHANNELS)
+    checked = {}
+    for channel, mode in channels.items():
+        if not DEFAULT_CHANNEL < channel <= MAX_CHANNEL:
+            raise ValueError(f"Channels are numbered 1 to {MAX_CHANNEL}, got {channel}.")
+        if mode not in MODES:
+            raise ValueError(f"Unknown delivery mode {mode}, expected one of {MODES}.")
+        checked[channel] = mode
+    return checked
@@ -0,0 +1,285 @@
+# codec.py
+import base64
+import binascii
+import json
+import struct
+from typing import Dict, List, Union
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+VERSION = 1
+# version, type, flags, channel, client index, seq, ack, ack bits, payload length
+HEADER = struct.Struct("!BBBBHIIIH")
+NO_CLIENT = 0xFFFF
+MAX_PAYLOAD = 0xFFFF
+# Length prefix of each frame inside a batch datagram
+FRAME_LENGTH = struct.Struct("!H")
+# message id, fragment index, fragment count: what a binary fragment carries before its chunk
+FRAGMENT = struct.Struct("!IHH")
+MAX_FRAGMENTS = 0xFFFF
+# Room a JSON fragment needs around its chunk for the frame and fragment fields
+JSON_FRAGMENT_OVERHEAD = 192
+
+# Header flags. Reliable marks frames of the reliable channel, acks included, so
+# they can share a batch datagram with unreliable ones.
+FLAG_RELIABLE = 0x01
+
+PACKET_TYPES: Dict[str, int] = {
+    "connect": 1,
+    "disconnect": 2,
+    "update": 3,
+    "ack": 4,
+    "snapshot": 5,
+    "snapshot_ack": 6,
+    "heartbeat": 7,
+    "fragment": 8,
+    "batch": 15,
+}
+PACKET_NAMES: Dict[int, str] = {code: name for name, code in PACKET_TYPES.items()}
+
+# Fields carried by the binary header and never repeated in its payload
+HEADER_FIELDS = frozenset(("type", "client_index", "seq", "ack", "ack_bits", "channel"))
+# Fields that differ per recipient and are framed around an already encoded body
+FRAME_FIELDS = ("seq", "ack", "ack_bits")
+
+
+class CodecError(ValueError):
+    pass
+
+
+# json.dumps builds a new encoder whenever it gets options, so keep one around
+_ENCODER = json.JSONEncoder(separators=(",", ":"))
+
+
+def _dumps(value) -> bytes:
+    return _ENCODER.encode(value).encode('utf-8')
+
+
+class Body:
+    """A packet encoded once so it can be framed for any number of recipients.
+
+    seq keeps the sequence number the packet arrived with, for channels that
+    forward it instead of numbering packets themselves. channel is the
+    logical channel whose sequence space frames of the body are numbered in.
+    """
+    __slots__ = ("codec", "header", "payload", "seq", "channel")
+
+    def __init__(self, codec, header, payload: bytes, seq: int = 0, channel: int = 0):
+        self.codec = codec
+        self.header = header
+        self.payload = payload
+        self.seq = seq
+        self.channel = channel
+
+    def frame(self, seq: int = 0, ack: int = 0, ack_bits: int = 0, flags: int = 0) -> List[Buffer]:
+        return self.codec.frame(self, seq, ack, ack_bits, flags)
+
+
+def _chunks(data: bytes, size: int) -> List[bytes]:
+    if size <= 0:
+        raise CodecError(f"No room for a fragment chunk in {size} bytes")
+    count = max(1, -(-len(data) // size))
+    if count > MAX_FRAGMENTS:
+        raise CodecError(f"Message of {len(data)} bytes needs more than {MAX_FRAGMENTS} fragments")
+    return [data[offset:offset + size] for offset in range(0, count * size, size)]
+
+
+class JsonCodec:
+    """The original wire format: one JSON object per datagram."""
+    name = "json"
+
+    def fragment_bodies(self, data: bytes, message_id: int, channel: int, size: int) -> List[Body]:
+        """Split an encoded packet into fragment bodies whose frames fit in size bytes.
+
+        The chunks travel base64 encoded, so each fragment holds 3/4 of what
+        is left of size once the fragment fields are written.
+        """
+        chunks = _chunks(data, (size - JSON_FRAGMENT_OVERHEAD) // 4 * 3)
+        bodies = []
+        for index, chunk in enumerate(chunks):
+            packet = {"type": "fragment", "frag_id": message_id, "frag_index": index,
+                      "frag_count": len(chunks), "chunk": base64.b64encode(chunk).decode("ascii")}
+            if channel:
+                packet["channel"] = channel
+            bodies.append(self.encode_body(packet))
+        return bodies
+
+    def encode(self, packet: dict) -> bytes:
+        return _dumps(packet)
+
+    def encode_body(self, packet: dict) -> Body:
+        fields = {key: value for key, value in packet.items() if key not in FRAME_FIELDS}
+        return Body(self, None, _dumps(fields), packet.get("seq", 0), packet.get("channel", 0))
+
+    def frame(self, body: Body, seq: int = 0, ack: int = 0, ack_bits: int = 0, flags: int = 0) -> List[Buffer]:
+        """Splice the per-recipient fields in front of the body's first key. Flags are binary only."""
+        if not (seq or ack):
+            return [body.payload]
+        fields = []
+        if seq:
+            fields.append(b'"seq":%d' % seq)
+        if ack:
+            fields.append(b'"ack":%d,"ack_bits":%d' % (ack, ack_bits))
+        prefix = b"{" + b",".join(fields)
+        if len(body.payload) > 2:
+            prefix += b","
+        return [prefix, memoryview(body.payload)[1:]]
+
+    def decode(self, data: Buffer) -> dict:
+        try:
+            packet = json.loads(str(data, 'utf-8'))
+        except ValueError as e:
+            raise CodecError(f"Invalid JSON packet: {e}") from e
+        if not isinstance(packet, dict):
+            raise CodecError("JSON packet must be an object")
+        if packet.get("type") == "fragment":
+            try:
+                packet["chunk"] = base64.b64decode(packet["chunk"], validate=True)
+            except (KeyError, TypeError, binascii.Error) as e:
+                raise CodecError(f"Invalid fragment chunk: {e}") from e
+        return packet
+
+
+class BinaryCodec:
+    """Struct-packed header followed by a compact JSON payload of the remaining fields.
+
+    The client id travels as the index the server assigned on connect. Connect
+    packets keep the string id in the payload so peers can learn the mapping.
+    """
+    name = "binary"
+
+    def encode(self, packet: dict) -> bytes:
+        body = self.encode_body(packet)
+        header, payload = self.frame(body, body.seq, packet.get("ack", 0), packet.get("ack_bits", 0))
+        return header + payload
+
+    def encode_body(self, packet: dict) -> Body:
+        packet_type = packet.get("type")
+        type_code = PACKET_TYPES.get(packet_type, 0)
+        client_index = packet.get("client_index")
+        if client_index is None:
+            client_index = NO_CLIENT
+
+        fields = {key: value for key, value in packet.items() if key not in HEADER_FIELDS}
+        if type_code == 0 and packet_type is not None:
+            fields["type"] = packet_type
+        if client_index != NO_CLIENT and type_code != PACKET_TYPES["connect"]:
+            fields.pop("client_id", None)
+        payload = _dumps(fields) if fields else b""
+        if len(payload) > MAX_PAYLOAD:
+            raise CodecError(f"Payload of {len(payload)} bytes exceeds {MAX_PAYLOAD}")
+
+        channel = packet.get("channel", 0)
+        return Body(self, (type_code, 0, channel, client_index), payload, packet.get("seq", 0), channel)
+
+    def frame(self, body: Body, seq: int = 0, ack: int = 0, ack_bits: int = 0, flags: int = 0) -> List[Buffer]:
+        type_code, body_flags, channel, client_index = body.header
+        header = HEADER.pack(VERSION, type_code, body_flags | flags, channel, client_index,
+                             seq, ack, ack_bits, len(body.payload))
+        return [header, body.payload]
+
+    def fragment_bodies(self, data: bytes, message_id: int, channel: int, size: int) -> List[Body]:
+        """Split an encoded packet into fragment bodies whose frames fit in size bytes.
+
+        A fragment's payload is its position, packed, followed by the raw chunk.
+        """
+        chunks = _chunks(data, size - HEADER.size - FRAGMENT.size)
+        header = (PACKET_TYPES["fragment"], 0, channel, NO_CLIENT)
+        return [Body(self, header, FRAGMENT.pack(message_id, index, len(chunks)) + chunk, 0, channel)
+                for index, chunk in enumerate(chunks)]
+
+    def pack_batch(self, frames: List[List[Buffer]]) -> List[Buffer]:
+        """Wrap several frames into one datagram, each behind a 2 byte length prefix."""
+        buffers = [b""]
+        length = 0
+        for frame in frames:
+            size = sum(len(buffer) for buffer in frame)
+            buffers.append(FRAME_LENGTH.pack(size))
+            buffers.extend(frame)
+            length += FRAME_LENGTH.size + size
+        buffers[0] = HEADER.pack(VERSION, PACKET_TYPES["batch"], 0, 0, NO_CLIENT, 0, 0, 0, length)
+        return buffers
+
+    def is_batch(self, data: Buffer) -> bool:
+        return len(data) >= HEADER.size and data[1] == PACKET_TYPES["batch"]
+
+    def unpack_batch(self, data: Buffer) -> List[memoryview]:
+        view = memoryview(data)
+        length = HEADER.unpack_from(view)[-1]
+        end = HEADER.size + length
+        if len(view) < end:
+            raise CodecError("Truncated batch")
+        frames = []
+        offset = HEADER.size
+        while offset < end:
+            if offset + FRAME_LENGTH.size > end:
+                raise CodecError("Truncated batch frame length")
+            (size,) = FRAME_LENGTH.unpack_from(view, offset)
+            offset += FRAME_LENGTH.size
+            if offset + size > end:
+                raise CodecError("Truncated batch frame")
+            frames.append(view[offset:offset + size])
+            offset += size
+        return frames
+
+    def flags_of(self, data: Buffer) -> int:
+        return data[2] if len(data) >= HEADER.size else 0
+
+    def decode(self, data: Buffer) -> dict:
+        if len(data) < HEADER.size:
+            raise CodecError(f"Packet of {len(data)} bytes is shorter than the header")
+        (version, type_code, _flags, channel, client_index,
+         seq, ack, ack_bits, length) = HEADER.unpack_from(data)
+        if version != VERSION:
+            raise CodecError(f"Unsupported wire version {version}")
+        end = HEADER.size + length
+        if len(data) < end:
+            raise CodecError("Truncated payload")
+
+        if type_code == PACKET_TYPES["fragment"]:
+            if length < FRAGMENT.size:
+                raise CodecError("Truncated fragment")
+            message_id, index, count = FRAGMENT.unpack_from(data, HEADER.size)
+            # Copied, the chunk outlives a receive buffer that may be reused
+            packet = {"frag_id": message_id, "frag_index": index, "frag_count": count,
+                      "chunk": bytes(data[HEADER.size + FRAGMENT.size:end])}
+        elif length:
+            try:
+                packet = json.loads(str(data[HEADER.size:end], 'utf-8'))
+            except ValueError as e:
+                raise CodecError(f"Invalid payload: {e}") from e
+        else:
+            packet = {}
+        if type_code:
+            packet["type"] = PACKET_NAMES.get(type_code, type_code)
+        if client_index != NO_CLIENT:
+            packet["client_index"] = client_index
+        if seq:
+            packet["seq"] = seq
+        if ack:
+            packet["ack"] = ack
+            packet["ack_bits"] = ack_bits
+        if channel:
+            packet["channel"] = channel
+        return packet
+
+
+JSON = JsonCodec()
+BINARY = BinaryCodec()
+CODECS = {codec.name: codec for codec in (JSON, BINARY)}
+
+Codec = Union[JsonCodec, BinaryCodec]
+
+
+def detect(data: Buffer) -> Codec:
+    """Pick the codec a datagram was written with from its first byte."""
+    if data and data[0] == VERSION:
+        return BINARY
+    return JSON
+
+
+def get_codec(name: str) -> Codec:
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f"Unknown codec {name}, expected one of {tuple(CODECS)}.") from None
@@ -0,0 +1,250 @@
+# compression.py
+import struct
+import threading
+import time
+import zlib
+from collections import Counter, defaultdict, deque
+from typing import Deque, Dict, Iterable, List, Tuple
+
+from .codec import Buffer, CodecError
+
+# Compressed datagrams start with this byte and the id of the dictionary they were
+# compressed with. It can be neither a JSON object, the binary codec's version byte
+# nor a shared port route marker.
+COMPRESSED_MARKER = 0x03
+COMPRESSED = struct.Struct("!BI")
+NO_DICTIONARY = 0
+
+# Raw deflate with a small window and little hash memory: setting up a compressor
+# with a dictionary per datagram then costs microseconds, not the ~70 us of zlib's
+# defaults. The window bounds how much of a dictionary can be used.
+LEVEL = 6
+WINDOW_BITS = 11
+MEM_LEVEL = 2
+DICTIONARY_SIZE = 1 << WINDOW_BITS
+# Decompress with the largest window, so clients may compress with any
+DECOMPRESS_WINDOW_BITS = 15
+MAX_DECOMPRESSED = 64 * 1024
+
+# Datagrams smaller than this go out as they are
+MIN_COMPRESS_SIZE = 48
+# Compressed over plain bytes above which compression is considered not to pay,
+# judged over this many attempts at a time
+MAX_RATIO = 0.9
+ADAPT_WINDOW = 16
+# Datagrams sent plain once compression did not pay, before it is tried again
+BACKOFF = 256
+# Datagrams kept as training samples, and how often one is taken
+MAX_SAMPLES = 512
+SAMPLE_EVERY = 8
+# Dictionaries a lobby keeps, so peers on an older one keep working after a retrain
+MAX_DICTIONARIES = 4
+# Length of the substrings dictionary training counts
+TRAINING_GRAM = 8
+
+
+def dictionary_id(dictionary: bytes) -> int:
+    """Stable id of a dictionary, its Adler-32 as zlib uses. 0 is deflate without one."""
+    return zlib.adler32(dictionary) if dictionary else NO_DICTIONARY
+
+
+def train_dictionary(samples: Iterable[Buffer], size: int = DICTIONARY_SIZE, gram: int = TRAINING_GRAM) -> bytes:
+    """Build a preset dictionary from sample datagrams.
+
+    Counts in how many samples each gram byte substring occurs and keeps the
+    ones found in at least a tenth of them. Starting from the most common,
+    each is grown both ways one byte at a time along its most common
+    overlapping neighbour, so recurring field names and structure come out
+    as whole strings. zlib encodes matches near the end of the dictionary
+    cheapest, so the most common pieces go last.
+    """
+    samples = [bytes(sample) for sample in samples]
+    counts: Counter = Counter()
+    for sample in samples:
+        counts.update({sample[i:i + gram] for i in range(len(sample) - gram + 1)})
+    min_count = max(2, len(samples) // 10)
+    common = [(count, piece) for piece, count in counts.items() if count >= min_count]
+    common.sort(reverse=True)
+    # Common grams by the gram - 1 bytes they start and end with, most common first
+    by_prefix: Dict[bytes, List[bytes]] = defaultdict(list)
+    by_suffix: Dict[bytes, List[bytes]] = defaultdict(list)
+    for _, piece in common:
+        by_prefix[piece[:-1]].append(piece)
+        by_suffix[piece[1:]].append(piece)
+
+    used = set()
+    pieces: List[bytes] = []
+    total = 0
+    for _, seed in common:
+        if total >= size:
+            break
+        if seed in used:
+            continue
+        used.add(seed)
+        piece = seed
+        while len(piece) < size:
+            following = next((g for g in by_prefix[piece[1 - gram:]] if g not in used), None)
+            if following is None:
+                break
+            used.add(following)
+            piece += following[-1:]
+        while len(piece) < size:
+            preceding = next((g for g in by_suffix[piece[:gram - 1]] if g not in used), None)
+            if preceding is None:
+                break
+            used.add(preceding)
+            piece = preceding[:1] + piece
+        pieces.append(piece)
+        total += len(piece)
+    return b"".join(reversed(pieces))[-size:]
+
+
+class Compressor:
+    """zlib compression with a preset dictionary for the peers of one lobby that ask for it.
+
+    A client asks by connecting with {"compression": <dictionary id>}, id 0
+    for no dictionary, and may then send compressed datagrams too. The
+    lobby starts from the dictionary it was given, which train() replaces
+    with one built from the lobby's own traffic.
+
+    Whole datagrams are compressed, batches included, and go out behind a
+    5 byte header naming the dictionary. A datagram that would not shrink
+    is sent as it is. When ADAPT_WINDOW attempts in a row saved less than
+    10% of their bytes, the next BACKOFF datagrams skip compression, so
+    traffic that does not compress costs little. Every SAMPLE_EVERY-th
+    plain datagram is kept as a sample that train() builds a new dictionary
+    from.
+
+    Used from every thread of the lobby, counters and samples are guarded
+    by a lock. The zlib work happens outside of it.
+    """
+
+    def __init__(self, dictionary: bytes = b"", level: int = LEVEL):
+        self.level = level
+        self.dictionaries: Dict[int, bytes] = {NO_DICTIONARY: b""}
+        self.current = self.add_dictionary(dictionary)
+        # Dictionary id each peer that asked for compression decompresses with
+        self.peers: Dict[Tuple[str, int], int] = {}
+        self.samples: Deque[bytes] = deque(maxlen=MAX_SAMPLES)
+        self.seen = 0
+        # Bytes before and after of the attempts since the last decision, and datagrams to skip
+        self.window = [0, 0, 0]
+        self.skip = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.attempts = 0
+        self.skipped = 0
+        self.cpu_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def add_dictionary(self, dictionary: bytes) -> int:
+        dictionary = bytes(dictionary[-DICTIONARY_SIZE:])
+        dict_id = dictionary_id(dictionary)
+        self.dictionaries[dict_id] = dictionary
+        while len(self.dictionaries) > MAX_DICTIONARIES + 1:
+            # Oldest first, deflate without a dictionary always stays
+            del self.dictionaries[next(oldest for oldest in self.dictionaries if oldest != NO_DICTIONARY)]
+        return dict_id
+
+    def dictionary(self) -> Tuple[int, bytes]:
+        """Id and bytes of the dictionary peers should ask for."""
+        return self.current, self.dictionaries[self.current]
+
+    def train(self) -> int:
+        """Make a dictionary built from the sampled traffic the current one, returning its id."""
+        with self.lock:
+            samples = list(self.samples)
+        if not samples:
+            raise ValueError("No traffic sampled to train a dictionary on yet.")
+        dictionary = train_dictionary(samples)
+        with self.lock:
+            self.current = self.add_dictionary(dictionary)
+        return self.current
+
+    def enable(self, address: Tuple[str, int], dict_id) -> bool:
+        """Compress what is sent to address with a dictionary the peer has, if we have it too."""
+        if dict_id is True:
+            dict_id = NO_DICTIONARY
+        # Whatever else a client sends, such as a list, names no dictionary
+        if not isinstance(dict_id, int) or dict_id not in self.dictionaries:
+            return False
+        self.peers[address] = dict_id
+        return True
+
+    def forget(self, address: Tuple[str, int]):
+        self.peers.pop(address, None)
+
+    def process(self, buffers: List[Buffer], address: Tuple[str, int]) -> List[Buffer]:
+        """The buffers of an outgoing datagram, compressed if the peer asked and it pays."""
+        with self.lock:
+            self.seen += 1
+            sample = self.seen % SAMPLE_EVERY == 0
+            dict_id = self.peers.get(address)
+            attempt = dict_id is not None and self.skip == 0
+            if dict_id is not None and not attempt:
+                self.skip -= 1
+                self.skipped += 1
+        if not (sample or attempt):
+            return buffers
+        data = buffers[0] if len(buffers) == 1 else b"".join(buffers)
+        if sample:
+            with self.lock:
+                self.samples.append(bytes(data))
+        if not attempt:
+            return buffers
+        if len(data) < MIN_COMPRESS_SIZE:
+            return buffers
+        dictionary = self.dictionaries.get(dict_id)
+        if dictionary is None:
+            return buffers  # Dropped by a retrain, the peer gets plain datagrams
+        start = time.thread_time()
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -WINDOW_BITS, MEM_LEVEL,
+                                      zlib.Z_DEFAULT_STRATEGY, dictionary)
+        payload = compressor.compress(data) + compressor.flush()
+        elapsed = time.thread_time() - start
+        size = COMPRESSED.size + len(payload)
+        with self.lock:
+            self.cpu_seconds += elapsed
+            self.attempts += 1
+            window = self.window
+            window[0] += 1
+            window[1] += len(data)
+            window[2] += min(size, len(data))
+            if window[0] == ADAPT_WINDOW:
+                if window[2] > MAX_RATIO * window[1]:
+                    self.skip = BACKOFF
+                self.window = [0, 0, 0]
+            if size >= len(data):
+                return buffers
+            self.input_bytes += len(data)
+            self.output_bytes += size
+        return [COMPRESSED.pack(COMPRESSED_MARKER, dict_id), payload]
+
+    def decompress(self, data: Buffer) -> bytes:
+        """A compressed datagram from a peer, as it was before compression."""
+        if len(data) < COMPRESSED.size:
+            raise CodecError("Truncated compressed datagram")
+        _, dict_id = COMPRESSED.unpack_from(data)
+        dictionary = self.dictionaries.get(dict_id)
+        if dictionary is None:
+            raise CodecError(f"Unknown compression dictionary {dict_id}")
+        start = time.thread_time()
+        decompressor = zlib.decompressobj(-DECOMPRESS_WINDOW_BITS, zdict=dictionary)
+        try:
+            plain = decompressor.decompress(memoryview(data)[COMPRESSED.size:], MAX_DECOMPRESSED)
+        except zlib.error as e:
+            raise CodecError(f"Invalid compressed datagram: {e}") from e
+        if decompressor.unconsumed_tail:
+            raise CodecError(f"Compressed datagram inflates past {MAX_DECOMPRESSED} bytes")
+        with self.lock:
+            self.cpu_seconds += time.thread_time() - start
+        return plain
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            return {
+                "compression_input_bytes": self.input_bytes,
+                "compression_output_bytes": self.output_bytes,
+                "compression_skipped": self.skipped,
+                "compression_seconds": self.cpu_seconds,
+            }
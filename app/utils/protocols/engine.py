@@ -0,0 +1,40 @@
+# engine.py
+import asyncio
+from typing import Optional, Tuple
+
+from .log import RATE_LIMITED, logger
+
+
+def call_in_loop(loop: asyncio.AbstractEventLoop, callback, *args):
+    """Run callback on loop, inline when we are already on the loop's thread."""
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        callback(*args)
+    else:
+        loop.call_soon_threadsafe(callback, *args)
+
+
+class LobbyProtocol(asyncio.DatagramProtocol):
+    """Datagram endpoint feeding one of a GameServer's sockets from the event loop."""
+
+    def __init__(self, server, handler, reliable: bool):
+        self.server = server
+        self.handler = handler
+        self.reliable = reliable
+        self.transport: Optional[asyncio.DatagramTransport] = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.handler.transport = transport
+
+    def datagram_received(self, data: bytes, address: Tuple[str, int]):
+        self.server.on_datagram(data, address, self.reliable)
+
+    def error_received(self, exc: Exception):
+        logger.warning("Error receiving packet: %s", exc, extra=RATE_LIMITED)
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self.handler.transport = None
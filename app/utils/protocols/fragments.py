@@ -0,0 +1,124 @@
+# fragments.py
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .log import RATE_LIMITED, logger
+
+# Seconds a partly received message waits for its next fragment before it is dropped
+REASSEMBLY_TIMEOUT = 10.0
+# Bytes of partly received messages kept per peer
+MAX_PENDING_BYTES = 2 << 20
+# Fragments one message may have, which bounds the size of a single message
+MAX_MESSAGE_FRAGMENTS = 1024
+
+Address = Tuple[str, int]
+MessageKey = Tuple[Address, int, int]
+
+
+class _Partial:
+    __slots__ = ("chunks", "missing", "size", "last_progress", "timer")
+
+    def __init__(self, count: int, now: float):
+        self.chunks: List[Optional[bytes]] = [None] * count
+        self.missing = count
+        self.size = 0
+        self.last_progress = now
+        self.timer = None
+
+
+class Reassembler:
+    """Puts fragmented messages back together, per peer, channel and message id.
+
+    Reliable packets too large for one datagram are sent as fragments, each
+    acked and retransmitted on its own. Fragments always travel reliably, so
+    an oversized unreliable packet is sent reliably too.
+
+    Fragments may arrive in any order and more than once. Memory is bounded
+    twice: a message has at most max_fragments fragments, and a peer at most
+    max_pending_bytes of incomplete messages, past which its oldest ones are
+    dropped. A message that goes timeout seconds without a new fragment is
+    dropped too, on one lazily re-armed timer per message.
+    """
+
+    def __init__(self, scheduler, timeout: float = REASSEMBLY_TIMEOUT,
+                 max_pending_bytes: int = MAX_PENDING_BYTES, max_fragments: int = MAX_MESSAGE_FRAGMENTS):
+        self.scheduler = scheduler
+        self.timeout = timeout
+        self.max_pending_bytes = max_pending_bytes
+        self.max_fragments = max_fragments
+        # Insertion ordered, so a peer's oldest message comes first
+        self.partials: Dict[MessageKey, _Partial] = {}
+        self.pending_bytes: Dict[Address, int] = {}
+        self.lock = threading.Lock()
+
+    def add(self, address: Address, channel: int, message_id: int, index: int, count: int,
+            chunk: bytes) -> Optional[bytes]:
+        """Store one fragment, returning the whole message once its last fragment is in."""
+        if not 0 <= index < count <= self.max_fragments:
+            logger.warning("Dropping fragment %s/%s from %s", index, count, address, extra=RATE_LIMITED)
+            return None
+        if count == 1:
+            return chunk
+        key = (address, channel, message_id)
+        with self.lock:
+            partial = self.partials.get(key)
+            if partial is None:
+                partial = self.partials[key] = _Partial(count, time.monotonic())
+                partial.timer = self.scheduler.call_later(self.timeout, self._expire, key, partial)
+            elif len(partial.chunks) != count:
+                logger.warning("Fragment count of message %s from %s changed", message_id, address, extra=RATE_LIMITED)
+                return None
+            if partial.chunks[index] is not None:
+                return None  # Duplicate
+            partial.chunks[index] = chunk
+            partial.missing -= 1
+            partial.size += len(chunk)
+            partial.last_progress = time.monotonic()
+            self.pending_bytes[address] = self.pending_bytes.get(address, 0) + len(chunk)
+            if not partial.missing:
+                self._remove(key, partial)
+                return b"".join(partial.chunks)
+            if self.pending_bytes[address] > self.max_pending_bytes:
+                self._enforce_budget(address, key)
+        return None
+
+    def _enforce_budget(self, address: Address, keep: MessageKey):
+        """Drop the peer's oldest messages until it is back under budget, keep last."""
+        for key in [key for key in self.partials if key[0] == address and key != keep]:
+            if self.pending_bytes.get(address, 0) <= self.max_pending_bytes:
+                return
+            logger.warning("Dropping message %s from %s, too much reassembly pending", key[2], address,
+                           extra=RATE_LIMITED)
+            self._remove(key, self.partials[key])
+        if self.pending_bytes.get(address, 0) > self.max_pending_bytes:
+            logger.warning("Dropping message %s from %s, too large to reassemble", keep[2], address, extra=RATE_LIMITED)
+            self._remove(keep, self.partials[keep])
+
+    def _expire(self, key: MessageKey, partial: _Partial):
+        with self.lock:
+            if self.partials.get(key) is not partial:
+                return
+            idle = time.monotonic() - partial.last_progress
+            if idle < self.timeout:
+                partial.timer = self.scheduler.call_later(self.timeout - idle, self._expire, key, partial)
+                return
+            logger.warning("Message %s from %s timed out with %d fragments missing",
+                           key[2], key[0], partial.missing, extra=RATE_LIMITED)
+            self._remove(key, partial)
+
+    def _remove(self, key: MessageKey, partial: _Partial):
+        del self.partials[key]
+        if partial.timer is not None:
+            partial.timer.cancel()
+        remaining = self.pending_bytes.get(key[0], 0) - partial.size
+        if remaining > 0:
+            self.pending_bytes[key[0]] = remaining
+        else:
+            self.pending_bytes.pop(key[0], None)
+
+    def forget(self, address: Address):
+        """Drop everything partly received from a departed peer."""
+        with self.lock:
+            for key in [key for key in self.partials if key[0] == address]:
+                self._remove(key, self.partials[key])
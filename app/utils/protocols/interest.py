@@ -0,0 +1,158 @@
+# interest.py
+import math
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+Position = Tuple[float, float]
+
+# (fraction of the radius, send every Nth update) from nearest to farthest
+DEFAULT_THROTTLE = ((0.5, 1), (0.75, 2), (1.0, 4))
+
+
+class InterestPolicy:
+    """Decides which peers hear about which clients. The base policy sends everything to everyone."""
+
+    def update(self, client_id: str, data: Any):
+        pass
+
+    def remove(self, client_id: str):
+        pass
+
+    def recipients(self, subject_id: str, clients: Iterable[Tuple[str, Tuple[str, int]]]) -> List[Tuple[str, int]]:
+        """Addresses that should receive an update from subject_id."""
+        return [address for _, address in clients]
+
+    def visible(self, observer_id: str, subjects: Iterable[str], tick: int) -> Optional[Set[str]]:
+        """Clients whose state observer_id gets in this tick's snapshot, None for all of them."""
+        return None
+
+
+def extract_position(data: Any, key: str = "pos", axes: Tuple[int, int] = (0, 1)) -> Optional[Position]:
+    """Read a position from an update payload: data[key] as a list or x/y dict, or data["x"]/data["y"].
+
+    NaN and infinite coordinates count as no position.
+    """
+    if not isinstance(data, dict):
+        return None
+    try:
+        pos = data.get(key)
+        if isinstance(pos, (list, tuple)):
+            x, y = float(pos[axes[0]]), float(pos[axes[1]])
+        else:
+            if not isinstance(pos, dict):
+                pos = data
+            x, y = float(pos["x"]), float(pos["y"])
+    except (IndexError, KeyError, TypeError, ValueError, OverflowError):
+        return None
+    if not (math.isfinite(x) and math.isfinite(y)):
+        return None
+    return x, y
+
+
+class GridInterest(InterestPolicy):
+    """Area of interest on a uniform spatial grid.
+
+    Positions come from the update payload and are bucketed into square cells,
+    so finding the peers within radius of a client only looks at nearby cells.
+    Peers closer in get every update, farther ones every 2nd or 4th (see
+    throttle). Clients that never sent a position are treated as in range.
+    """
+
+    def __init__(self, radius: float = 100.0, cell_size: Optional[float] = None,
+                 throttle: Tuple[Tuple[float, int], ...] = DEFAULT_THROTTLE,
+                 position_key: str = "pos", axes: Tuple[int, int] = (0, 1)):
+        if radius <= 0:
+            raise ValueError(f"Interest radius must be positive, got {radius}.")
+        self.radius = radius
+        self.cell_size = cell_size or radius
+        self.throttle = throttle
+        self.position_key = position_key
+        self.axes = axes
+        self.positions: Dict[str, Position] = {}
+        self.cells: Dict[Tuple[int, int], Set[str]] = {}
+        self.update_counts: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def cell_of(self, position: Position) -> Tuple[int, int]:
+        return math.floor(position[0] / self.cell_size), math.floor(position[1] / self.cell_size)
+
+    def update(self, client_id: str, data: Any):
+        position = extract_position(data, self.position_key, self.axes)
+        if position is None:
+            return
+        try:
+            cell = self.cell_of(position)
+        except OverflowError:
+            # Too far out for the grid, e.g. 1e308 over a cell size below 1
+            return
+        with self.lock:
+            old = self.positions.get(client_id)
+            self.positions[client_id] = position
+            if old is not None:
+                old_cell = self.cell_of(old)
+                if old_cell == cell:
+                    return
+                self._discard(old_cell, client_id)
+            self.cells.setdefault(cell, set()).add(client_id)
+
+    def remove(self, client_id: str):
+        with self.lock:
+            position = self.positions.pop(client_id, None)
+            self.update_counts.pop(client_id, None)
+            if position is not None:
+                self._discard(self.cell_of(position), client_id)
+
+    def _discard(self, cell: Tuple[int, int], client_id: str):
+        members = self.cells.get(cell)
+        if members is not None:
+            members.discard(client_id)
+            if not members:
+                del self.cells[cell]
+
+    def nearby(self, origin: Position) -> Dict[str, float]:
+        """Distance to every positioned client within radius of origin."""
+        reach = math.ceil(self.radius / self.cell_size)
+        cx, cy = self.cell_of(origin)
+        found = {}
+        for x in range(cx - reach, cx + reach + 1):
+            for y in range(cy - reach, cy + reach + 1):
+                for client_id in self.cells.get((x, y), ()):
+                    position = self.positions[client_id]
+                    distance = math.hypot(position[0] - origin[0], position[1] - origin[1])
+                    if distance <= self.radius:
+                        found[client_id] = distance
+        return found
+
+    def divisor(self, distance: float) -> int:
+        for fraction, every in self.throttle:
+            if distance <= self.radius * fraction:
+                return every
+        return self.throttle[-1][1]
+
+    def recipients(self, subject_id: str, clients: Iterable[Tuple[str, Tuple[str, int]]]) -> List[Tuple[str, int]]:
+        with self.lock:
+            origin = self.positions.get(subject_id)
+            if origin is None:
+                return [address for _, address in clients]
+            count = self.update_counts.get(subject_id, 0)
+            self.update_counts[subject_id] = count + 1
+            in_range = self.nearby(origin)
+            addresses = []
+            for client_id, address in clients:
+                if client_id not in self.positions:
+                    addresses.append(address)
+                    continue
+                distance = in_range.get(client_id)
+                if distance is not None and count % self.divisor(distance) == 0:
+                    addresses.append(address)
+            return addresses
+
+    def visible(self, observer_id: str, subjects: Iterable[str], tick: int) -> Optional[Set[str]]:
+        with self.lock:
+            origin = self.positions.get(observer_id)
+            if origin is None:
+                return None
+            in_range = self.nearby(origin)
+            return {subject for subject in subjects
+                    if subject not in self.positions
+                    or (subject in in_range and tick % self.divisor(in_range[subject]) == 0)}
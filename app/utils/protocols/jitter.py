@@ -0,0 +1,98 @@
+# jitter.py
+import heapq
+import itertools
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+from .udp_handlers.peer import SEQ_MODULO, seq_greater
+
+# Updates a buffer holds before the oldest is let through early
+JITTER_DEPTH = 8
+# Bounds on the estimated send interval used to pace releases
+MIN_INTERVAL = 0.001
+MAX_INTERVAL = 0.25
+
+
+class JitterBuffer:
+    """Smooths one sender's unreliable updates before they are relayed.
+
+    The first update after a quiet spell is held for delay seconds, then
+    updates are released oldest sequence first, one per estimated send
+    interval. Updates that arrive out of order within the delay are put back
+    in order instead of being dropped as stale, and a burst after a stall is
+    played out at the sender's own rate instead of all at once. A buffer
+    holding depth updates lets the oldest through right away, so a sender
+    that speeds up adds no more than depth updates of latency.
+
+    Releases run on the scheduler and call release(packet, address).
+    """
+
+    def __init__(self, scheduler, release: Callable[[dict, Tuple[str, int]], None],
+                 delay: float, depth: int = JITTER_DEPTH):
+        self.scheduler = scheduler
+        self.release = release
+        self.delay = delay
+        self.depth = depth
+        # (distance from the first buffered sequence, arrival order, packet, address)
+        self.entries: List[Tuple[int, int, dict, Tuple[str, int]]] = []
+        self.base: Optional[int] = None
+        self.order = itertools.count()
+        self.interval: Optional[float] = None
+        self.last_arrival: Optional[Tuple[int, float]] = None
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def push(self, seq: int, packet: dict, address: Tuple[str, int]):
+        now = time.monotonic()
+        early = None
+        with self.lock:
+            self._estimate_interval(seq, now)
+            if self.base is None or seq_greater(self.base, seq):
+                self._rebase(seq)
+            heapq.heappush(self.entries, ((seq - self.base) % SEQ_MODULO, next(self.order), packet, address))
+            if len(self.entries) > self.depth:
+                early = heapq.heappop(self.entries)
+            if self.timer is None:
+                self.timer = self.scheduler.call_later(self.delay, self._release_next)
+        if early is not None:
+            self.release(early[2], early[3])
+
+    def _estimate_interval(self, seq: int, now: float):
+        if self.last_arrival is not None and seq_greater(seq, self.last_arrival[0]):
+            last_seq, last_time = self.last_arrival
+            sample = (now - last_time) / ((seq - last_seq) % SEQ_MODULO)
+            sample = min(MAX_INTERVAL, max(MIN_INTERVAL, sample))
+            self.interval = sample if self.interval is None else 0.875 * self.interval + 0.125 * sample
+        if self.last_arrival is None or seq_greater(seq, self.last_arrival[0]):
+            self.last_arrival = (seq, now)
+
+    def _rebase(self, seq: int):
+        """Order entries relative to an older sequence that just arrived."""
+        if self.base is not None:
+            self.entries = [((key + self.base - seq) % SEQ_MODULO, order, packet, address)
+                            for key, order, packet, address in self.entries]
+            heapq.heapify(self.entries)
+        self.base = seq
+
+    def _release_next(self):
+        with self.lock:
+            if not self.entries:
+                self.timer = None
+                self.base = None
+                return
+            _, _, packet, address = heapq.heappop(self.entries)
+            if self.entries:
+                self.timer = self.scheduler.call_later(self.interval or self.delay, self._release_next)
+            else:
+                self.timer = None
+                self.base = None
+        self.release(packet, address)
+
+    def clear(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.entries = []
+            self.base = None
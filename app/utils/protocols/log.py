@@ -0,0 +1,46 @@
+# log.py
+import logging
+import threading
+import time
+from typing import Dict, Tuple
+
+LOG_INTERVAL = 5.0
+# extra= of the hot path records a datagram flood could repeat thousands of times a second
+RATE_LIMITED = {"rate_limit": True}
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets one record per message template through every interval seconds.
+
+    Only records logged with extra=RATE_LIMITED are limited, everything else,
+    such as connects and disconnects, always gets through. Limited records
+    are keyed on their logger and unformatted message, so "Error handling
+    packet: %s" counts as one message whatever the error. The next record
+    let through says how many were suppressed in between.
+    """
+
+    def __init__(self, interval: float = LOG_INTERVAL):
+        super().__init__()
+        self.interval = interval
+        self.last: Dict[Tuple[str, int, str], float] = {}
+        self.suppressed: Dict[Tuple[str, int, str], int] = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "rate_limit", False):
+            return True
+        key = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last.get(key, float("-inf")) < self.interval:
+                self.suppressed[key] = self.suppressed.get(key, 0) + 1
+                return False
+            self.last[key] = now
+            suppressed = self.suppressed.pop(key, 0)
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+        return True
+
+
+logger = logging.getLogger("app.udp")
+logger.addFilter(RateLimitFilter())
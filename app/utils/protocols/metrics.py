@@ -0,0 +1,169 @@
+# metrics.py
+import bisect
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+RTT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+TICK_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Sequence[float]):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self) -> dict:
+        cumulative = []
+        total = 0
+        for count in self.counts[:-1]:
+            total += count
+            cumulative.append(total)
+        return {"buckets": list(zip(self.bounds, cumulative)), "sum": self.sum, "count": self.count}
+
+
+class PeerCounters:
+    __slots__ = ("packets_in", "bytes_in", "packets_out", "bytes_out", "retransmits", "stale_dropped")
+
+    def __init__(self):
+        self.packets_in = 0
+        self.bytes_in = 0
+        self.packets_out = 0
+        self.bytes_out = 0
+        self.retransmits = 0
+        self.stale_dropped = 0
+
+
+class LobbyMetrics:
+    """Traffic counters of one lobby, in total and per peer address.
+
+    Counters are bumped without a lock from whichever thread handles the
+    packet. An increment racing another can be lost, which is acceptable for
+    monitoring and keeps the hot path to a dict lookup and a few adds.
+    """
+
+    def __init__(self):
+        self.peers: Dict[Tuple[str, int], PeerCounters] = {}
+        # Totals of departed peers, so lobby counters never go backwards
+        self.retired = PeerCounters()
+        self.rtt = Histogram(RTT_BUCKETS)
+        self.tick_seconds = Histogram(TICK_BUCKETS)
+
+    def peer(self, address: Tuple[str, int]) -> PeerCounters:
+        counters = self.peers.get(address)
+        if counters is None:
+            counters = self.peers[address] = PeerCounters()
+        return counters
+
+    def record_in(self, address: Tuple[str, int], size: int):
+        counters = self.peer(address)
+        counters.packets_in += 1
+        counters.bytes_in += size
+
+    def record_out(self, address: Tuple[str, int], size: int):
+        counters = self.peer(address)
+        counters.packets_out += 1
+        counters.bytes_out += size
+
+    def record_retransmit(self, address: Tuple[str, int]):
+        self.peer(address).retransmits += 1
+
+    def record_stale(self, address: Tuple[str, int]):
+        self.peer(address).stale_dropped += 1
+
+    def forget(self, address: Tuple[str, int]):
+        """Stop tracking a departed peer, folding its counts into the lobby totals."""
+        counters = self.peers.pop(address, None)
+        if counters is not None:
+            for field in PeerCounters.__slots__:
+                setattr(self.retired, field, getattr(self.retired, field) + getattr(counters, field))
+
+    def totals(self) -> Dict[str, int]:
+        totals = {field: getattr(self.retired, field) for field in PeerCounters.__slots__}
+        for counters in list(self.peers.values()):
+            for field in PeerCounters.__slots__:
+                totals[field] += getattr(counters, field)
+        return totals
+
+
+# Exposed name, snapshot key, type, help
+LOBBY_SERIES = (
+    ("packets_in_total", "packets_in", "counter", "Datagrams received"),
+    ("bytes_in_total", "bytes_in", "counter", "Bytes received"),
+    ("packets_out_total", "packets_out", "counter", "Datagrams sent"),
+    ("bytes_out_total", "bytes_out", "counter", "Bytes sent"),
+    ("retransmits_total", "retransmits", "counter", "Reliable packets sent again after a timeout"),
+    ("stale_dropped_total", "stale_dropped", "counter", "Unreliable updates dropped as older than one already relayed"),
+    ("clients", "clients", "gauge", "Connected clients"),
+    ("pending_acks", "pending_acks", "gauge", "Reliable packets waiting for an ack"),
+    ("queue_depth", "queue_depth", "gauge", "Packets waiting in the send queues"),
+    ("queue_dropped_total", "queue_dropped", "counter", "Packets dropped by the send queues"),
+    ("queue_conflated_total", "queue_conflated", "counter", "Queued packets replaced by a newer one"),
+    ("compression_input_bytes_total", "compression_input_bytes", "counter",
+     "Bytes of datagrams that were sent compressed, before compression"),
+    ("compression_output_bytes_total", "compression_output_bytes", "counter",
+     "Bytes of datagrams that were sent compressed, after compression"),
+    ("compression_skipped_total", "compression_skipped", "counter",
+     "Datagrams sent uncompressed while compression was not paying off"),
+    ("compression_cpu_seconds_total", "compression_seconds", "counter", "CPU time spent compressing and decompressing"),
+)
+PEER_SERIES = (
+    ("peer_packets_in_total", "packets_in", "counter", "Datagrams received from the peer"),
+    ("peer_bytes_in_total", "bytes_in", "counter", "Bytes received from the peer"),
+    ("peer_packets_out_total", "packets_out", "counter", "Datagrams sent to the peer"),
+    ("peer_bytes_out_total", "bytes_out", "counter", "Bytes sent to the peer"),
+    ("peer_retransmits_total", "retransmits", "counter", "Reliable packets sent to the peer again"),
+    ("peer_stale_dropped_total", "stale_dropped", "counter", "Out of order or duplicate updates from the peer dropped"),
+    ("peer_pending_acks", "pending_acks", "gauge", "Reliable packets the peer has not acked"),
+    ("peer_srtt_seconds", "srtt", "gauge", "Smoothed round trip time to the peer"),
+)
+HISTOGRAMS = (
+    ("rtt_seconds", "rtt", "Round trip times measured from acks"),
+    ("tick_seconds", "tick_seconds", "Time spent building and sending one tick's snapshots"),
+)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: Dict[str, str]) -> str:
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def render_prometheus(lobbies: Dict[str, dict], prefix: str = "udp") -> str:
+    """Prometheus text exposition of the snapshots from GameServer.metrics_snapshot."""
+    lines: List[str] = []
+
+    def family(name: str, kind: str, help_text: str, samples: Iterable[Tuple[str, float]]):
+        lines.append(f"# HELP {prefix}_{name} {help_text}")
+        lines.append(f"# TYPE {prefix}_{name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{prefix}_{name}{labels} {value}")
+
+    for name, key, kind, help_text in LOBBY_SERIES:
+        family(name, kind, help_text,
+               ((_labels({"lobby": lobby}), snapshot[key]) for lobby, snapshot in lobbies.items()))
+    for name, key, kind, help_text in PEER_SERIES:
+        family(name, kind, help_text,
+               ((_labels({"lobby": lobby, "peer": peer}), values[key])
+                for lobby, snapshot in lobbies.items()
+                for peer, values in snapshot["peers"].items() if values.get(key) is not None))
+    for name, key, help_text in HISTOGRAMS:
+        samples = []
+        for lobby, snapshot in lobbies.items():
+            histogram = snapshot[key]
+            for bound, count in histogram["buckets"]:
+                samples.append((f"_bucket{_labels({'lobby': lobby, 'le': repr(bound)})}", count))
+            samples.append((f"_bucket{_labels({'lobby': lobby, 'le': '+Inf'})}", histogram["count"]))
+            samples.append((f"_sum{_labels({'lobby': lobby})}", histogram["sum"]))
+            samples.append((f"_count{_labels({'lobby': lobby})}", histogram["count"]))
+        family(name, "histogram", help_text, samples)
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,27 @@
+# receive.py
+import socket
+from typing import Tuple
+
+RECV_BUFFER_SIZE = 4096
+RING_SIZE = 8
+
+
+class ReceiveRing:
+    """Preallocated receive buffers for one socket thread, reused round robin.
+
+    Datagrams are read straight into the ring and handed out as memoryview
+    slices, so a receive allocates no bytes object for the payload. A view
+    stays intact until the ring comes back around to its buffer, RING_SIZE
+    receives later, so anything that keeps a datagram past its handler must
+    copy it.
+    """
+
+    def __init__(self, count: int = RING_SIZE, size: int = RECV_BUFFER_SIZE):
+        self.views = [memoryview(bytearray(size)) for _ in range(count)]
+        self.index = 0
+
+    def recvfrom(self, sock: socket.socket) -> Tuple[memoryview, Tuple[str, int]]:
+        view = self.views[self.index]
+        self.index = (self.index + 1) % len(self.views)
+        nbytes, address = sock.recvfrom_into(view)
+        return view[:nbytes], address
@@ -0,0 +1,142 @@
+# scheduler.py
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from typing import Callable, List, Optional
+
+from .engine import call_in_loop
+from .log import logger
+
+
+class Timer:
+    __slots__ = ("deadline", "callback", "args", "cancelled")
+
+    def __init__(self, deadline: float, callback: Callable, args: tuple):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        # Lazy cancellation: the entry stays queued and is skipped when it comes due
+        self.cancelled = True
+
+
+class TimerHeap:
+    """Min-heap of timers keyed on deadline, with lazy cancellation.
+
+    Scheduling and popping are O(log n). Cancelled timers are skipped when they
+    reach the top, and the heap is rebuilt once they make up most of it so
+    cancelled work cannot pile up.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    def push(self, timer: Timer):
+        heapq.heappush(self.heap, (timer.deadline, next(self.counter), timer))
+
+    def next_deadline(self) -> Optional[float]:
+        while self.heap and self.heap[0][2].cancelled:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now: float) -> List[Timer]:
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            timer = heapq.heappop(self.heap)[2]
+            if not timer.cancelled:
+                due.append(timer)
+        return due
+
+    def compact(self):
+        live = [item for item in self.heap if not item[2].cancelled]
+        if len(live) * 2 < len(self.heap):
+            heapq.heapify(live)
+            self.heap = live
+
+
+class ThreadScheduler:
+    """Runs timers from a single background thread, sleeping until the next deadline."""
+
+    COMPACT_EVERY = 4096
+
+    def __init__(self):
+        self.timers = TimerHeap()
+        self.condition = threading.Condition()
+        self.running = True
+        self.scheduled = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def call_later(self, delay: float, callback: Callable, *args) -> Timer:
+        timer = Timer(time.monotonic() + delay, callback, args)
+        with self.condition:
+            earliest = self.timers.next_deadline()
+            self.timers.push(timer)
+            self.scheduled += 1
+            if self.scheduled % self.COMPACT_EVERY == 0:
+                self.timers.compact()
+            # Only wake the thread if it is sleeping past the new deadline
+            if earliest is None or timer.deadline < earliest:
+                self.condition.notify()
+        return timer
+
+    def run(self):
+        while self.running:
+            with self.condition:
+                deadline = self.timers.next_deadline()
+                timeout = None if deadline is None else deadline - time.monotonic()
+                if timeout is None or timeout > 0:
+                    self.condition.wait(timeout)
+                due = self.timers.pop_due(time.monotonic())
+            # Callbacks run outside the lock so they may schedule more timers
+            for timer in due:
+                if not timer.cancelled:
+                    try:
+                        timer.callback(*timer.args)
+                    except Exception:
+                        logger.exception("Error in scheduled callback")
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+
+
+class LoopScheduler:
+    """Schedules timers on an asyncio loop, which keeps its own deadline heap."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.running = True
+
+    def call_later(self, delay: float, callback: Callable, *args) -> Timer:
+        timer = Timer(time.monotonic() + delay, callback, args)
+        call_in_loop(self.loop, self._arm, timer, delay)
+        return timer
+
+    def _arm(self, timer: Timer, delay: float):
+        if self.running and not timer.cancelled:
+            self.loop.call_later(delay, self._fire, timer)
+
+    def _fire(self, timer: Timer):
+        if self.running and not timer.cancelled:
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                logger.exception("Error in scheduled callback")
+
+    def stop(self):
+        self.running = False
+
+
+def make_scheduler(loop: Optional[asyncio.AbstractEventLoop] = None):
+    return ThreadScheduler() if loop is None else LoopScheduler(loop)
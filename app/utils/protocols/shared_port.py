@@ -0,0 +1,119 @@
+# shared_port.py
+import socket
+import struct
+import threading
+from typing import Dict, List, Tuple
+
+from .log import RATE_LIMITED, logger
+from .receive import ReceiveRing
+
+# Datagrams to a shared port start with this byte and the lobby's route id. The
+# byte can be neither a JSON object nor the binary codec's version byte.
+ROUTE_MARKER = 0x02
+ROUTE = struct.Struct("!BI")
+
+HAS_REUSEPORT = hasattr(socket, "SO_REUSEPORT")
+
+
+def route_prefix(route_id: int) -> bytes:
+    return ROUTE.pack(ROUTE_MARKER, route_id)
+
+
+class SharedPortRouter:
+    """One reliable and one unreliable port shared by every lobby.
+
+    Clients put a route prefix (marker byte plus the lobby's 4 byte route id) in
+    front of their packets. The router strips it and hands the packet to that
+    lobby's GameServer. Once an address has been routed, its later packets may
+    leave the prefix out. With workers > 1 each port is opened that many times
+    with SO_REUSEPORT, so the kernel spreads receive work over the sockets.
+    """
+
+    def __init__(self, host: str, reliable_port: int, unreliable_port: int, workers: int = 1):
+        if workers < 1:
+            raise ValueError(f"Need at least one socket per port, got {workers}.")
+        if workers > 1 and not HAS_REUSEPORT:
+            raise ValueError("SO_REUSEPORT is not available on this platform.")
+        self.host = host
+        self.routes: Dict[int, object] = {}
+        self.address_routes: Dict[Tuple[str, int], int] = {}
+        self.lock = threading.Lock()
+        self.running = True
+        self.sockets: Dict[bool, List[socket.socket]] = {True: [], False: []}
+        try:
+            for reliable, port in ((True, reliable_port), (False, unreliable_port)):
+                for _ in range(workers):
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    if workers > 1:
+                        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                    sock.bind((host, port))
+                    # Lets receive threads notice stop() instead of blocking forever
+                    sock.settimeout(0.5)
+                    # Port 0 picks a free port once, the other workers reuse it
+                    port = sock.getsockname()[1]
+                    self.sockets[reliable].append(sock)
+        except OSError:
+            self.close()
+            raise
+        self.reliable_port = self.sockets[True][0].getsockname()[1]
+        self.unreliable_port = self.sockets[False][0].getsockname()[1]
+        self.threads = [threading.Thread(target=self.receive_packets, args=(sock, reliable), daemon=True)
+                        for reliable, socks in self.sockets.items() for sock in socks]
+        for thread in self.threads:
+            thread.start()
+
+    @property
+    def send_sockets(self) -> Tuple[socket.socket, socket.socket]:
+        """Sockets lobbies send from. Any socket bound to a port sends from it."""
+        return self.sockets[True][0], self.sockets[False][0]
+
+    def register(self, route_id: int, server):
+        with self.lock:
+            self.routes[route_id] = server
+
+    def unregister(self, route_id: int):
+        with self.lock:
+            self.routes.pop(route_id, None)
+            for address in [address for address, route in self.address_routes.items() if route == route_id]:
+                del self.address_routes[address]
+
+    def receive_packets(self, sock: socket.socket, reliable: bool):
+        ring = ReceiveRing()
+        while self.running:
+            try:
+                data, address = ring.recvfrom(sock)
+            except socket.timeout:
+                continue
+            except OSError as e:
+                if self.running:
+                    logger.warning("Error receiving packet: %s", e, extra=RATE_LIMITED)
+                continue
+            self.route(data, address, reliable)
+
+    def route(self, data: memoryview, address: Tuple[str, int], reliable: bool):
+        if data and data[0] == ROUTE_MARKER:
+            if len(data) < ROUTE.size:
+                return
+            route_id = ROUTE.unpack_from(data)[1]
+            data = data[ROUTE.size:]
+            with self.lock:
+                server = self.routes.get(route_id)
+                if server is not None and self.address_routes.get(address) != route_id:
+                    self.address_routes[address] = route_id
+        else:
+            with self.lock:
+                server = self.routes.get(self.address_routes.get(address))
+        if server is None:
+            return  # Lobby gone or the sender never said which one it wants
+        server.on_datagram(data, address, reliable)
+
+    def close(self):
+        for socks in self.sockets.values():
+            for sock in socks:
+                sock.close()
+
+    def stop(self):
+        self.running = False
+        for thread in self.threads:
+            thread.join()
+        self.close()
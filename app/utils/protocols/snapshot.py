@@ -0,0 +1,135 @@
+# snapshot.py
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .interest import InterestPolicy
+from .udp_handlers.peer import seq_greater
+
+SNAPSHOT_HISTORY = 32
+
+
+class SnapshotState:
+    """Latest state per client plus the recent snapshots peers can ack as a baseline.
+
+    Every tick freezes the latest states into a numbered snapshot. A peer that
+    acked snapshot N gets only the states that changed since N, and a full
+    snapshot when it has acked nothing still held in the history.
+    """
+
+    def __init__(self, history: int = SNAPSHOT_HISTORY):
+        self.history = history
+        self.latest: Dict[str, Any] = {}
+        self.snapshots: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self.baselines: Dict[str, int] = {}
+        # Per-peer view of the world when an interest policy hides part of it
+        self.frames: Dict[str, "OrderedDict[int, Dict[str, Any]]"] = {}
+        self.tick = 0
+        self.lock = threading.Lock()
+
+    def update(self, client_id: str, state: Any):
+        with self.lock:
+            self.latest[client_id] = state
+
+    def remove(self, client_id: str):
+        with self.lock:
+            self.latest.pop(client_id, None)
+            self.baselines.pop(client_id, None)
+            self.frames.pop(client_id, None)
+
+    def ack(self, client_id: str, tick: int):
+        with self.lock:
+            current = self.baselines.get(client_id)
+            known = tick in self.snapshots or tick in self.frames.get(client_id, ())
+            if known and (current is None or seq_greater(tick, current)):
+                self.baselines[client_id] = tick
+
+    def take(self) -> Tuple[int, Dict[str, Any]]:
+        """Freeze the latest states into the next snapshot."""
+        with self.lock:
+            self.tick += 1
+            snapshot = dict(self.latest)
+            self.snapshots[self.tick] = snapshot
+            while len(self.snapshots) > self.history:
+                self.snapshots.popitem(last=False)
+            return self.tick, snapshot
+
+    def delta(self, view: Dict[str, Any], snapshot: Dict[str, Any],
+              baseline: Optional[Dict[str, Any]]) -> Tuple[Dict[str, Any], List[str]]:
+        """States in view that changed since baseline, and clients gone from the lobby."""
+        if baseline is None:
+            return view, []
+        changed = {client_id: state for client_id, state in view.items()
+                   if client_id not in baseline or baseline[client_id] != state}
+        removed = [client_id for client_id in baseline if client_id not in snapshot]
+        return changed, removed
+
+    def build(self, recipients: Iterable[Tuple[str, Tuple[str, int]]],
+              interest: Optional[InterestPolicy] = None) -> List[Tuple[dict, List[Tuple[str, int]]]]:
+        """Take a snapshot and return the packets to send with their recipients.
+
+        Without an interest policy every peer that acked snapshot N knows
+        exactly snapshot N, so peers sharing a baseline share one delta that is
+        built and encoded once. With one, each peer only sees part of the
+        world, so what it knows is tracked per peer and each gets its own delta.
+        Deltas with nothing in them are not sent.
+        """
+        tick, snapshot = self.take()
+        if interest is not None:
+            return self._build_filtered(tick, snapshot, recipients, interest)
+
+        groups: Dict[int, List[Tuple[str, int]]] = {}
+        with self.lock:
+            for client_id, address in recipients:
+                baseline_tick = self.baselines.get(client_id, 0)
+                if baseline_tick not in self.snapshots:
+                    baseline_tick = 0
+                groups.setdefault(baseline_tick, []).append(address)
+            baselines = {baseline_tick: self.snapshots.get(baseline_tick) for baseline_tick in groups}
+
+        packets = []
+        for baseline_tick, addresses in groups.items():
+            changed, removed = self.delta(snapshot, snapshot, baselines[baseline_tick])
+            packet = self._packet(tick, baseline_tick, changed, removed)
+            if packet is not None:
+                packets.append((packet, addresses))
+        return packets
+
+    def _build_filtered(self, tick: int, snapshot: Dict[str, Any],
+                        recipients: Iterable[Tuple[str, Tuple[str, int]]],
+                        interest: InterestPolicy) -> List[Tuple[dict, List[Tuple[str, int]]]]:
+        packets = []
+        for client_id, address in recipients:
+            visible = interest.visible(client_id, snapshot, tick)
+            if visible is None:
+                view = snapshot
+            else:
+                view = {subject: snapshot[subject] for subject in visible if subject in snapshot}
+            with self.lock:
+                frames = self.frames.setdefault(client_id, OrderedDict())
+                baseline_tick = self.baselines.get(client_id, 0)
+                baseline = frames.get(baseline_tick)
+                if baseline is None:
+                    baseline_tick = 0
+                changed, removed = self.delta(view, snapshot, baseline)
+                packet = self._packet(tick, baseline_tick, changed, removed)
+                if packet is None:
+                    continue
+                # Remember what the peer will know once it acks this tick
+                known = dict(baseline) if baseline is not None else {}
+                known.update(changed)
+                for subject in removed:
+                    known.pop(subject, None)
+                frames[tick] = known
+                while len(frames) > self.history:
+                    frames.popitem(last=False)
+            packets.append((packet, [address]))
+        return packets
+
+    def _packet(self, tick: int, baseline_tick: int, changed: Dict[str, Any], removed: List[str]) -> Optional[dict]:
+        if not changed and not removed:
+            return None
+        packet = {"type": "snapshot", "tick": tick, "baseline": baseline_tick, "states": changed}
+        if removed:
+            packet["removed"] = removed
+        return packet
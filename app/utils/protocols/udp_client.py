@@ -1,92 +1,654 @@
 # game_server.py
+import asyncio
 import socket
 import threading
-import json
-from typing import Dict, Tuple
+import time
+from typing import Callable, Dict, Hashable, List, Optional, Set, Tuple
 
+from . import codec as codecs
+from .capture import CaptureWriter
+from .channels import RELIABLE_MODES, RELIABLE_ORDERED, SEQUENCED, check_channels
+from .compression import COMPRESSED_MARKER, Compressor
+from .engine import LobbyProtocol, call_in_loop
+from .fragments import Reassembler
+from .interest import InterestPolicy
+from .jitter import JitterBuffer
+from .log import RATE_LIMITED, logger
+from .metrics import LobbyMetrics
+from .receive import ReceiveRing
+from .scheduler import make_scheduler
+from .snapshot import SnapshotState
+from .udp_handlers.batcher import DEFAULT_FLUSH_DELAY, DEFAULT_MTU, Batcher
+from .udp_handlers.peer import SEQ_MODULO, seq_greater
 from .udp_handlers.reliable import ReliableHandler
 from .udp_handlers.unreliable import UnreliableHandler
 
+# Seconds without a packet from a client before it is disconnected
+CLIENT_TIMEOUT = 60.0
+# Seconds without sending a client anything before it gets a heartbeat
+HEARTBEAT_INTERVAL = 2.0
+HEARTBEAT = {"type": "heartbeat"}
+# Fields the sequencing and ack logic trusts to be 32 bit unsigned integers
+SEQUENCE_FIELDS = ("seq", "ack", "ack_bits")
+# Seconds per-address state is kept for a sender that is not a connected client
+STRAY_TIMEOUT = 30.0
+NO_COMPRESSION_STATS = {"compression_input_bytes": 0, "compression_output_bytes": 0,
+                        "compression_skipped": 0, "compression_seconds": 0.0}
+
 
 class GameServer:
-    def __init__(self, host: str, reliable_port: int, unreliable_port: int):
+    def __init__(self, host: str, reliable_port: int, unreliable_port: int,
+                 loop: Optional[asyncio.AbstractEventLoop] = None,
+                 tick_rate: Optional[float] = None,
+                 interest: Optional[InterestPolicy] = None,
+                 batching: bool = False, mtu: int = DEFAULT_MTU,
+                 flush_delay: float = DEFAULT_FLUSH_DELAY,
+                 sockets: Optional[Tuple[socket.socket, socket.socket]] = None,
+                 client_timeout: Optional[float] = CLIENT_TIMEOUT,
+                 heartbeat_interval: Optional[float] = HEARTBEAT_INTERVAL,
+                 on_clients_changed: Optional[Callable[["GameServer"], None]] = None,
+                 jitter_delay: Optional[float] = None,
+                 channels: Optional[Dict[int, str]] = None,
+                 compression: bool = False, dictionary: Optional[bytes] = None,
+                 capture_path: Optional[str] = None):
+        """Bind the lobby sockets and start serving them.
+
+        The server relays what each client sends to the others, or with a
+        tick_rate keeps the latest state per client and sends every peer a
+        snapshot delta per tick. Stale and duplicated unreliable updates are
+        dropped before the fan-out. The helpers each feature is built on
+        document it in full: SnapshotState, Batcher, JitterBuffer,
+        Reassembler, Compressor and CaptureWriter.
+
+        Args:
+            loop: Host both sockets as datagram endpoints on this loop instead
+                of giving each a receive thread.
+            tick_rate: Snapshot rate in Hz, None relays updates as they arrive.
+            interest: Policy (e.g. GridInterest) limiting which peers hear each client.
+            batching, mtu, flush_delay: Coalesce what a binary peer is sent within
+                flush_delay seconds into datagrams of up to mtu bytes. Reliable
+                packets larger than mtu are fragmented either way.
+            sockets: Already bound (reliable, unreliable) sockets of a
+                SharedPortRouter, which feeds packets in through on_datagram.
+                They are sent from but never received on or closed.
+            client_timeout: Seconds of silence, from any packet, after which a
+                client is disconnected. None keeps it until it leaves.
+            heartbeat_interval: Seconds without sending a client anything
+                before it is sent a heartbeat, None never sends them.
+            on_clients_changed: Called with the server after every connect,
+                disconnect and ready change.
+            jitter_delay: Seconds each sender's sequenced updates are buffered
+                to restore their order and pace bursts, None relays them at once.
+            channels: Channel number to delivery mode, DEFAULT_CHANNELS if None.
+            compression, dictionary: Compress datagrams to clients that connect
+                with {"compression": <dictionary id>}, starting from dictionary.
+            capture_path: New capture file every datagram both ways is written to.
+        """
+        if sockets is not None and loop is not None:
+            raise ValueError("Shared sockets are only supported on the thread engine.")
+        if tick_rate is not None and tick_rate <= 0:
+            raise ValueError(f"Tick rate must be positive, got {tick_rate}.")
+        self.channels = check_channels(channels)
         self.host = host
         self.reliable_port = reliable_port
         self.unreliable_port = unreliable_port
         self.running = True
         self.clients: Dict[str, Tuple[str, int]] = {}
+        # Clients that said they are ready to start
+        self.ready: Set[str] = set()
+        self.loop = loop
+        self.transports = []
+        # Binary packets carry a small per-lobby index instead of the client id string
+        self.client_indexes: Dict[str, int] = {}
+        self.client_ids: Dict[int, str] = {}
+        # Wire format each address last spoke, replies use the same one
+        self.peer_codecs: Dict[Tuple[str, int], codecs.Codec] = {}
+        self.tick_interval = 1 / tick_rate if tick_rate else None
+        self.snapshots = SnapshotState() if tick_rate else None
+        self.interest = interest
+        self.metrics = LobbyMetrics()
+        self.client_timeout = client_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.on_clients_changed = on_clients_changed
+        # Last packet time per address both ways, checked lazily by one timer per client
+        self.last_seen: Dict[Tuple[str, int], float] = {}
+        self.last_sent: Dict[Tuple[str, int], float] = {}
+        self.liveness_timers = {}
+        # Newest unreliable seq relayed per sender and channel, and their jitter buffers
+        self.unreliable_seqs: Dict[Tuple[str, int], int] = {}
+        self.jitter_delay = jitter_delay
+        self.jitter_buffers: Dict[Tuple[str, int], JitterBuffer] = {}
+
+        # Opened before anything else, so a capture that cannot be written leaves nothing behind
+        self.capture = CaptureWriter(capture_path) if capture_path else None
 
         # Initialize sockets
-        self.reliable_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.reliable_sock.bind((host, reliable_port))
+        self.owns_sockets = sockets is None
+        if sockets is not None:
+            self.reliable_sock, self.unreliable_sock = sockets
+        else:
+            opened = []
+            try:
+                self.reliable_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                opened.append(self.reliable_sock)
+                self.reliable_sock.bind((host, reliable_port))
+
+                self.unreliable_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                opened.append(self.unreliable_sock)
+                self.unreliable_sock.bind((host, unreliable_port))
+            except BaseException:
+                for sock in opened:
+                    sock.close()
+                if self.capture is not None:
+                    self.capture.close()
+                raise
 
-        self.unreliable_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.unreliable_sock.bind((host, unreliable_port))
+        # Initialize handlers and start threads, all timers share one scheduler
+        self.scheduler = make_scheduler(loop)
+        self.reliable_handler = ReliableHandler(self.reliable_sock, loop, self.peer_codecs,
+                                                on_peer_lost=self.handle_peer_lost,
+                                                scheduler=self.scheduler,
+                                                on_high_water=self.handle_backlog,
+                                                fragment_size=mtu)
+        self.unreliable_handler = UnreliableHandler(self.unreliable_sock, loop, self.peer_codecs)
+        self.fragments = Reassembler(self.scheduler)
+        self.compressor = Compressor(dictionary or b"") if compression or dictionary else None
+        self.reliable_handler.compressor = self.compressor
+        self.unreliable_handler.compressor = self.compressor
+        self.batcher = None
+        if batching:
+            self.batcher = Batcher(self.reliable_handler.write_buffers, self.scheduler, mtu, flush_delay)
+            self.reliable_handler.batcher = self.batcher
+            self.unreliable_handler.batcher = self.batcher
+        self.reliable_handler.last_sent = self.last_sent
+        self.unreliable_handler.last_sent = self.last_sent
+        self.reliable_handler.metrics = self.metrics
+        self.unreliable_handler.metrics = self.metrics
+        self.reliable_handler.capture = self.capture
+        self.unreliable_handler.capture = self.capture
+        if self.snapshots is not None:
+            self._schedule_tick(time.monotonic() + self.tick_interval)
+        self.scheduler.call_later(STRAY_TIMEOUT, self._sweep_strays)
 
-        # Initialize handlers and start threads
-        self.reliable_handler = ReliableHandler(self.reliable_sock)
-        self.unreliable_handler = UnreliableHandler(self.unreliable_sock)
+        if loop is not None:
+            self.reliable_sock.setblocking(False)
+            self.unreliable_sock.setblocking(False)
+            call_in_loop(loop, self._start_endpoints)
+        elif self.owns_sockets:
+            # Shared sockets are received on by their router
+            threading.Thread(target=self.receive_packets, args=(self.reliable_sock, True), daemon=True).start()
+            threading.Thread(target=self.receive_packets, args=(self.unreliable_sock, False), daemon=True).start()
 
-        threading.Thread(target=self.receive_packets, args=(self.reliable_sock, True), daemon=True).start()
-        threading.Thread(target=self.receive_packets, args=(self.unreliable_sock, False), daemon=True).start()
+    def _start_endpoints(self):
+        for sock, handler, reliable in ((self.reliable_sock, self.reliable_handler, True),
+                                        (self.unreliable_sock, self.unreliable_handler, False)):
+            task = self.loop.create_task(self.loop.create_datagram_endpoint(
+                lambda handler=handler, reliable=reliable: LobbyProtocol(self, handler, reliable),
+                sock=sock,
+            ))
+            task.add_done_callback(lambda task, sock=sock: self._endpoint_started(task, sock))
+
+    def _endpoint_started(self, task: asyncio.Task, sock: socket.socket):
+        if task.cancelled() or task.exception() is not None:
+            logger.error("Error starting endpoint: %s", task.exception() if not task.cancelled() else "cancelled")
+            sock.close()
+            return
+        transport, _ = task.result()
+        if self.running:
+            self.transports.append(transport)
+        else:
+            # Stopped while the endpoint was being created
+            transport.close()
 
     def receive_packets(self, sock, reliable: bool):
+        ring = ReceiveRing()
         while self.running:
             try:
-                data, address = sock.recvfrom(4096)
-                packet = json.loads(data.decode('utf-8'))
-                self.handle_packet(packet, address, reliable)
+                data, address = ring.recvfrom(sock)
+                self.on_datagram(data, address, reliable)
             except Exception as e:
-                print(f"Error receiving packet: {e}")
+                if self.running:
+                    logger.warning("Error receiving packet: %s", e, extra=RATE_LIMITED)
+
+    def on_datagram(self, data: codecs.Buffer, address: Tuple[str, int], reliable: bool):
+        """Decode a raw datagram from either engine and dispatch it.
+
+        In thread mode data is a view into a reused receive buffer, valid only
+        until this returns unless copied.
+        """
+        self.metrics.record_in(address, len(data))
+        self.last_seen[address] = time.monotonic()
+        if self.capture is not None:
+            self.capture.record((data,), address, False, reliable)
+        try:
+            if data and data[0] == COMPRESSED_MARKER:
+                if self.compressor is None:
+                    raise codecs.CodecError("Compressed datagram to a lobby without compression")
+                data = self.compressor.decompress(data)
+            codec = codecs.detect(data)
+            if codec is codecs.BINARY and codec.is_batch(data):
+                # Frames of a batch say themselves which channel they belong to
+                for frame in codec.unpack_batch(data):
+                    self.on_frame(codec, frame, address, bool(codec.flags_of(frame) & codecs.FLAG_RELIABLE))
+            else:
+                self.on_frame(codec, data, address, reliable)
+        except Exception as e:
+            logger.warning("Error handling packet from %s: %s", address, e, extra=RATE_LIMITED)
+
+    def on_frame(self, codec: codecs.Codec, data: codecs.Buffer, address: Tuple[str, int], reliable: bool):
+        try:
+            packet = codec.decode(data)
+            if self.peer_codecs.get(address) is not codec:
+                self.peer_codecs[address] = codec
+            self.resolve_client(packet)
+            self.handle_packet(packet, address, reliable)
+        except Exception as e:
+            logger.warning("Error handling packet from %s: %s", address, e, extra=RATE_LIMITED)
+
+    def resolve_client(self, packet: dict):
+        """Fill in whichever of client_id/client_index the sender left out."""
+        client_id = packet.get("client_id")
+        if client_id is None:
+            client_index = packet.get("client_index")
+            if client_index is not None:
+                packet["client_id"] = self.client_ids.get(client_index)
+        elif client_id in self.client_indexes:
+            packet["client_index"] = self.client_indexes[client_id]
+
+    def assign_index(self, client_id: str) -> int:
+        index = self.client_indexes.get(client_id)
+        if index is None:
+            index = next(i for i in range(len(self.client_ids) + 1) if i not in self.client_ids)
+            self.client_indexes[client_id] = index
+            self.client_ids[index] = client_id
+        return index
 
     def handle_packet(self, packet: dict, address: Tuple[str, int], reliable: bool):
+        for field in SEQUENCE_FIELDS:
+            value = packet.get(field)
+            # JSON peers may send anything here, binary headers are always in range
+            if value is not None and (type(value) is not int or not 0 <= value < SEQ_MODULO):
+                logger.warning("Dropping packet from %s with invalid %s %r", address, field, value, extra=RATE_LIMITED)
+                return
+        packet_type = packet.get("type")
+        channel = packet.get("channel", 0)
+        mode = None
+        if channel:
+            mode = self.channels.get(channel)
+            if mode is None:
+                logger.warning("Packet from %s on unknown channel %s", address, channel, extra=RATE_LIMITED)
+                return
+            # A channel's mode, not the socket, says how its packets are delivered
+            reliable = mode in RELIABLE_MODES
+        if packet_type == "fragment":
+            # A message is lost with any of its fragments, so they are reliable on every channel
+            reliable = True
+
+        if packet_type == "ack":
+            # Numbered channels get acks for fragments even when they are unreliable
+            if reliable or channel:
+                # Binary acks carry the acked sequence in the ack field, legacy JSON ones in seq
+                ack = packet.get("ack", packet.get("seq"))
+                self.reliable_handler.process_ack(address, ack, packet.get("ack_bits", 0), channel)
+            return
+        if "ack" in packet:
+            # Acks piggybacked on regular traffic, in the sequence space of its channel
+            self.reliable_handler.process_ack(address, packet["ack"], packet.get("ack_bits", 0), channel)
+        seq = packet.get("seq")
+        if reliable and seq:
+            reset = packet_type == "connect"
+            if mode == RELIABLE_ORDERED:
+                for due in self.reliable_handler.receive_ordered(address, seq, packet, reset, channel):
+                    self.dispatch(due, address, reliable)
+                return
+            if not self.reliable_handler.acknowledge(address, seq, reset, channel):
+                return  # Retransmission of a packet we already handled
+        if mode == SEQUENCED and seq and packet_type != "update":
+            # Updates are checked on their own way, through the jitter buffer if there is one
+            key = (packet.get("client_id"), channel)
+            if self._is_stale(key, seq):
+                self.metrics.record_stale(address)
+                return
+            self.unreliable_seqs[key] = seq
+        self.dispatch(packet, address, reliable)
+
+    def dispatch(self, packet: dict, address: Tuple[str, int], reliable: bool):
+        """Act on a packet the channel layer let through."""
         packet_type = packet.get("type")
+        seq = packet.get("seq")
+        if packet_type in ("connect", "disconnect", "ready"):
+            # Membership is announced on the default channel, whichever one it came in on
+            packet.pop("channel", None)
+        if self.snapshots is not None and "snapshot_ack" in packet:
+            self.snapshots.ack(packet.get("client_id"), packet["snapshot_ack"])
 
         if packet_type == "connect":
             self.handle_connect(packet, address)
         elif packet_type == "disconnect":
             self.handle_disconnect(packet, address)
         elif packet_type == "update":
-            self.handle_update(packet, address)
-        elif packet_type == "ack" and reliable:
-            seq_num = packet.get("seq")
-            self.reliable_handler.process_ack(seq_num)
+            if not reliable and seq and packet.get("client_id") in self.clients:
+                self.handle_sequenced_update(packet, address, seq)
+            else:
+                self.handle_update(packet, address)
+        elif packet_type == "snapshot_ack":
+            pass  # Already applied above
+        elif packet_type == "ready":
+            self.handle_ready(packet)
+        elif packet_type == "heartbeat":
+            pass  # on_datagram already noted the sign of life
+        elif packet_type == "fragment":
+            self.handle_fragment(packet, address)
         else:
-            print(f"Unknown packet type: {packet_type}")
+            logger.warning("Unknown packet type: %s", packet_type, extra=RATE_LIMITED)
+
+    def handle_fragment(self, packet: dict, address: Tuple[str, int]):
+        """Store a piece of a message too large for one datagram, and handle the message once whole."""
+        data = self.fragments.add(address, packet.get("channel", 0), packet["frag_id"],
+                                  packet["frag_index"], packet["frag_count"], packet["chunk"])
+        if data is None:
+            return
+        message = codecs.detect(data).decode(data)
+        if message.get("type") == "fragment":
+            logger.warning("Dropping nested fragment from %s", address, extra=RATE_LIMITED)
+            return
+        self.resolve_client(message)
+        self.dispatch(message, address, reliable=True)
 
     def handle_connect(self, packet: dict, address: Tuple[str, int]):
         client_id = packet.get("client_id")
+        # Negotiated before any client state changes. Only the server acts on it, peers do not need to know
+        compression = packet.pop("compression", None)
+        if self.compressor is not None:
+            self.compressor.forget(address)
+            asked = compression is not None and compression is not False
+            if asked and not self.compressor.enable(address, compression):
+                logger.info("Client %s asked for unknown dictionary %r, sending uncompressed", client_id, compression)
         self.clients[client_id] = address
-        print(f"Client {client_id} connected from {address}")
+        # A new session may number its updates from scratch
+        self._drop_sequencing(client_id)
+        packet["client_index"] = self.assign_index(client_id)
+        intervals = [interval for interval in (self.client_timeout, self.heartbeat_interval) if interval is not None]
+        if intervals:
+            self._schedule_liveness_check(client_id, address, min(intervals))
+        logger.info("Client %s connected from %s", client_id, address)
         # Notify other clients
         self.broadcast(packet, reliable=True)
+        if self.on_clients_changed is not None:
+            self.on_clients_changed(self)
 
     def handle_disconnect(self, packet: dict, address: Tuple[str, int]):
         client_id = packet.get("client_id")
-        self.clients.pop(client_id, None)
-        print(f"Client {client_id} disconnected")
+        # Only the address a client connected from may disconnect it, and
+        # everything kept per address below belongs to that one
+        if client_id not in self.clients or self.clients[client_id] != address:
+            logger.info("Ignoring disconnect of %s from %s", client_id, address)
+            return
+        address = self.clients.pop(client_id)
+        self.ready.discard(client_id)
+        self._drop_sequencing(client_id)
+        timer = self.liveness_timers.pop(client_id, None)
+        if timer is not None:
+            timer.cancel()
+        index = self.client_indexes.pop(client_id, None)
+        if index is not None:
+            self.client_ids.pop(index, None)
+        if self.snapshots is not None:
+            self.snapshots.remove(client_id)
+        if self.interest is not None:
+            self.interest.remove(client_id)
+        logger.info("Client %s disconnected", client_id)
         # Notify other clients
         self.broadcast(packet, reliable=True)
-        # Remove client from handlers
-        self.reliable_handler.remove_client(client_id)
-        # self.unreliable_handler.remove_client(client_id)
+        self.forget_address(address)
+        if self.on_clients_changed is not None:
+            self.on_clients_changed(self)
+
+    def forget_address(self, address: Tuple[str, int]):
+        """Drop everything kept for an address: handler peers, codec, fragments and counters."""
+        self.last_seen.pop(address, None)
+        self.last_sent.pop(address, None)
+        self.reliable_handler.remove_peer(address)
+        self.unreliable_handler.queue.discard(address)
+        if self.batcher is not None:
+            self.batcher.flush(address)
+        self.peer_codecs.pop(address, None)
+        self.fragments.forget(address)
+        if self.compressor is not None:
+            self.compressor.forget(address)
+        self.metrics.forget(address)
+
+    def _sweep_strays(self):
+        if not self.running:
+            return
+        try:
+            self.sweep_strays()
+        finally:
+            self.scheduler.call_later(STRAY_TIMEOUT, self._sweep_strays)
+
+    def sweep_strays(self):
+        """Forget addresses that sent something but are no connected client's.
+
+        Every datagram leaves per-address state behind (codec, acks, counters),
+        so senders that never connect, or clients that reconnected from a new
+        port, would otherwise grow it without bound. They are forgotten once
+        silent for STRAY_TIMEOUT seconds.
+        """
+        clients = set(self.clients.values())
+        addresses = set(self.last_seen) | set(self.peer_codecs) | set(self.reliable_handler.peers)
+        addresses.update(self.metrics.peers)
+        cutoff = time.monotonic() - STRAY_TIMEOUT
+        for address in addresses - clients:
+            if address not in self.last_seen or self.last_seen[address] <= cutoff:
+                self.forget_address(address)
+
+
+    def handle_ready(self, packet: dict):
+        """A client marked itself ready ({"ready": true}, the default) or not ready."""
+        client_id = packet.get("client_id")
+        if client_id not in self.clients:
+            return
+        ready = bool(packet.get("ready", True))
+        if ready == (client_id in self.ready):
+            return
+        if ready:
+            self.ready.add(client_id)
+        else:
+            self.ready.discard(client_id)
+        packet["ready"] = ready
+        self.broadcast(packet, reliable=True)
+        if self.on_clients_changed is not None:
+            self.on_clients_changed(self)
+
+    def handle_peer_lost(self, address: Tuple[str, int]):
+        """Disconnect whichever client stopped acknowledging reliable packets."""
+        for client_id, client_address in list(self.clients.items()):
+            if client_address == address:
+                self.handle_disconnect({"type": "disconnect", "client_id": client_id}, address)
 
+    def _schedule_liveness_check(self, client_id: str, address: Tuple[str, int], delay: float):
+        timer = self.liveness_timers.pop(client_id, None)
+        if timer is not None:
+            timer.cancel()
+        self.liveness_timers[client_id] = self.scheduler.call_later(delay, self.check_liveness, client_id, address)
+
+    def check_liveness(self, client_id: str, address: Tuple[str, int]):
+        """Drop the client if it went silent and send it a heartbeat if we did.
+
+        Runs again whenever the next of the two could come due, so a chatty
+        connection costs one timer per interval rather than work per packet.
+        """
+        if not self.running or self.clients.get(client_id) != address:
+            return
+        now = time.monotonic()
+        delays = []
+        if self.client_timeout is not None:
+            idle = now - self.last_seen.get(address, 0.0)
+            if idle >= self.client_timeout:
+                logger.info("Client %s timed out after %.0fs of silence", client_id, idle)
+                self.handle_disconnect({"type": "disconnect", "client_id": client_id}, address)
+                return
+            delays.append(self.client_timeout - idle)
+        if self.heartbeat_interval is not None:
+            quiet = now - self.last_sent.get(address, 0.0)
+            if quiet >= self.heartbeat_interval:
+                self.unreliable_handler.enqueue(HEARTBEAT, address, key="heartbeat")
+                quiet = 0.0
+            delays.append(self.heartbeat_interval - quiet)
+        self._schedule_liveness_check(client_id, address, min(delays))
 
     def handle_update(self, packet: dict, address: Tuple[str, int]):
-        print(f"Received update from {packet.get('client_id')}")
-        self.broadcast(packet, reliable=False)
+        client_id = packet.get("client_id")
+        if self.interest is not None and client_id in self.clients:
+            self.interest.update(client_id, packet.get("data"))
+        if self.snapshots is not None:
+            # Tick mode: the next snapshot carries the state to everyone
+            if client_id in self.clients:
+                self.snapshots.update(client_id, packet.get("data"))
+        else:
+            # A peer that has not been sent this client's last update yet only needs this one
+            channel = packet.get("channel", 0)
+            key = ("update", client_id, channel) if channel else ("update", client_id)
+            if self.interest is not None:
+                addresses = self.interest.recipients(client_id, list(self.clients.items()))
+            else:
+                addresses = list(self.clients.values())
+            self.send_to(packet, addresses, reliable=self.channels.get(channel) in RELIABLE_MODES, key=key)
+
+    def handle_sequenced_update(self, packet: dict, address: Tuple[str, int], seq: int):
+        key = (packet["client_id"], packet.get("channel", 0))
+        if self._is_stale(key, seq):
+            self.metrics.record_stale(address)
+            return
+        if self.jitter_delay is None:
+            self.unreliable_seqs[key] = seq
+            self.handle_update(packet, address)
+            return
+        buffer = self.jitter_buffers.get(key)
+        if buffer is None:
+            buffer = self.jitter_buffers[key] = JitterBuffer(self.scheduler, self._release_update,
+                                                             self.jitter_delay)
+        buffer.push(seq, packet, address)
+
+    def _release_update(self, packet: dict, address: Tuple[str, int]):
+        """Jitter buffer output: relay unless a newer update overtook it or the sender left."""
+        client_id = packet.get("client_id")
+        if not self.running or self.clients.get(client_id) != address:
+            return
+        seq = packet["seq"]
+        key = (client_id, packet.get("channel", 0))
+        if self._is_stale(key, seq):
+            self.metrics.record_stale(address)
+            return
+        self.unreliable_seqs[key] = seq
+        self.handle_update(packet, address)
+
+    def _is_stale(self, key: Tuple[str, int], seq: int) -> bool:
+        last = self.unreliable_seqs.get(key)
+        return last is not None and not seq_greater(seq, last)
+
+    def _drop_sequencing(self, client_id: str):
+        for channel in (0, *self.channels):
+            self.unreliable_seqs.pop((client_id, channel), None)
+            buffer = self.jitter_buffers.pop((client_id, channel), None)
+            if buffer is not None:
+                buffer.clear()
+
+    def handle_backlog(self, address: Tuple[str, int], depth: int):
+        """A peer's reliable queue hit its high-water mark: shed its unreliable backlog."""
+        logger.warning("Peer %s is falling behind with %d reliable packets queued", address, depth, extra=RATE_LIMITED)
+        self.unreliable_handler.queue.discard(address)
+
+    def queue_stats(self) -> Dict[str, Dict[str, int]]:
+        return {"reliable": self.reliable_handler.queue.stats(),
+                "unreliable": self.unreliable_handler.queue.stats()}
+
+    def metrics_snapshot(self) -> dict:
+        """Lobby and per-peer counters in the shape render_prometheus expects."""
+        snapshot = self.metrics.totals()
+        queues = self.queue_stats().values()
+        peers = dict(self.reliable_handler.peers)
+        snapshot.update(
+            clients=len(self.clients),
+            pending_acks=sum(peer.pending_count() for peer in peers.values()),
+            queue_depth=sum(stats["depth"] for stats in queues),
+            queue_dropped=sum(stats["dropped"] for stats in queues),
+            queue_conflated=sum(stats["conflated"] for stats in queues),
+            rtt=self.metrics.rtt.snapshot(),
+            tick_seconds=self.metrics.tick_seconds.snapshot(),
+        )
+        snapshot.update(self.compressor.stats() if self.compressor is not None else NO_COMPRESSION_STATS)
+        names = {address: client_id for client_id, address in self.clients.items()}
+        snapshot["peers"] = {}
+        for address, counters in list(self.metrics.peers.items()):
+            # Only connected clients get a series, strays only count toward the lobby
+            label = names.get(address)
+            if label is None:
+                continue
+            peer = peers.get(address)
+            values = {field: getattr(counters, field) for field in counters.__slots__}
+            values["pending_acks"] = peer.pending_count() if peer is not None else 0
+            values["srtt"] = peer.srtt if peer is not None else None
+            snapshot["peers"][label] = values
+        return snapshot
 
     def broadcast(self, packet: dict, reliable: bool):
-        for address in self.clients.values():
-            if reliable:
-                self.reliable_handler.enqueue(packet, address)
+        self.send_to(packet, list(self.clients.values()), reliable)
+
+    def send_to(self, packet: dict, addresses: List[Tuple[str, int]], reliable: bool,
+                key: Optional[Hashable] = None):
+        """Encode the packet once per wire format in use and fan it out to the addresses.
+
+        Unreliable packets sent with a key replace one with the same key still
+        queued for a recipient.
+        """
+        handler = self.reliable_handler if reliable else self.unreliable_handler
+        fragment_size = self.reliable_handler.fragment_size
+        recipients: Dict[codecs.Codec, List[Tuple[str, int]]] = {}
+        for address in addresses:
+            recipients.setdefault(self.peer_codecs.get(address, codecs.JSON), []).append(address)
+        for codec, group in recipients.items():
+            body = codec.encode_body(packet)
+            if not reliable and fragment_size is not None and len(body.payload) > fragment_size:
+                # Only the reliable channel fragments, the alternative is a datagram IP has to split
+                self.reliable_handler.enqueue_body(body, group)
             else:
-                self.unreliable_handler.enqueue(packet, address)
+                handler.enqueue_body(body, group, key)
+
+    def _schedule_tick(self, deadline: float):
+        self.scheduler.call_later(max(0.0, deadline - time.monotonic()), self.run_tick, deadline)
 
+    def run_tick(self, deadline: float):
+        """Send every peer its snapshot delta for this tick."""
+        if not self.running:
+            return
+        start = time.perf_counter()
+        try:
+            for packet, addresses in self.snapshots.build(list(self.clients.items()), self.interest):
+                # A newer delta covers everything an older one still queued would
+                self.send_to(packet, addresses, reliable=False, key="snapshot")
+        finally:
+            self.metrics.tick_seconds.observe(time.perf_counter() - start)
+            # Schedule from the intended deadline so the tick rate does not drift
+            self._schedule_tick(max(deadline + self.tick_interval, time.monotonic()))
 
     def stop(self):
         self.running = False
         self.reliable_handler.stop()
         self.unreliable_handler.stop()
-        self.reliable_sock.close()
-        self.unreliable_sock.close()
+        if self.batcher is not None:
+            self.batcher.flush_all()
+        self.scheduler.stop()
+        if self.capture is not None:
+            self.capture.close()
+        if self.loop is not None:
+            call_in_loop(self.loop, self._close_endpoints)
+        elif self.owns_sockets:
+            self.reliable_sock.close()
+            self.unreliable_sock.close()
+
+    def _close_endpoints(self):
+        # Transports own their sockets; endpoints still starting close themselves
+        for transport in self.transports:
+            transport.close()
+        self.transports = []
@@ -1,24 +1,107 @@
 # base_handler.py
-import queue
+import asyncio
+import socket
 import threading
+import time
 from abc import ABC, abstractmethod
-from typing import Tuple
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+
+from ..capture import CaptureWriter
+from ..codec import BINARY, JSON, Body, Buffer, Codec
+from ..compression import Compressor
+from ..engine import call_in_loop
+from ..metrics import LobbyMetrics
+from .send_queue import SendQueue
+
+# Scatter/gather sends let a shared body go out behind a per-recipient header without a copy
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
 
 
 class BaseHandler(ABC):
-    def __init__(self, sock):
+    # Whether datagrams go out on the lobby's reliable socket
+    reliable = False
+
+    def __init__(self, sock, loop: Optional[asyncio.AbstractEventLoop] = None,
+                 codecs: Optional[Dict[Tuple[str, int], Codec]] = None,
+                 send_queue: Optional[SendQueue] = None):
         self.sock = sock
-        self.queue = queue.Queue()
+        self.loop = loop
+        # Wire format each peer speaks, shared with the GameServer that fills it in
+        self.codecs = codecs if codecs is not None else {}
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        # Coalesces binary frames per peer when the server enables batching
+        self.batcher = None
+        # When each peer was last sent anything, shared by a server's handlers for keepalives
+        self.last_sent: Dict[Tuple[str, int], float] = {}
+        # Traffic counters of the owning server, if it keeps them
+        self.metrics: Optional[LobbyMetrics] = None
+        # Compresses datagrams to peers that asked for it, when the server enables compression
+        self.compressor: Optional[Compressor] = None
+        # Records every datagram sent, when the server captures its traffic
+        self.capture: Optional[CaptureWriter] = None
+        # Per-peer queues feeding the worker thread, unused with an event loop
+        self.queue = send_queue if send_queue is not None else SendQueue()
         self.running = True
-        self.thread = threading.Thread(target=self.process_queue, daemon=True)
-        self.thread.start()
+        self.thread = None
+        # With an event loop every send happens on the loop, so no queue thread is needed
+        if loop is None:
+            self.thread = threading.Thread(target=self.process_queue, daemon=True)
+            self.thread.start()
 
-    @abstractmethod
     def send(self, packet: dict, address: Tuple[str, int]):
+        self.send_body(self.codec_for(address).encode_body(packet), (address,))
+
+    @abstractmethod
+    def send_body(self, body: Body, addresses: Sequence[Tuple[str, int]]):
+        """Frame an already encoded body for every address and send it."""
         pass
 
-    def enqueue(self, packet: dict, address: Tuple[str, int]):
-        self.queue.put((packet, address))
+    def enqueue(self, packet: dict, address: Tuple[str, int], key: Optional[Hashable] = None):
+        self.enqueue_body(self.codec_for(address).encode_body(packet), (address,), key)
+
+    def enqueue_body(self, body: Body, addresses: Sequence[Tuple[str, int]], key: Optional[Hashable] = None):
+        """Queue a body for every address. A key lets a newer body replace one still queued."""
+        if self.loop is None:
+            self.queue.put(body, addresses, key)
+        else:
+            call_in_loop(self.loop, self.send_body, body, addresses)
+
+    def codec_for(self, address: Tuple[str, int]) -> Codec:
+        return self.codecs.get(address, JSON)
+
+    def sendto(self, data: bytes, address: Tuple[str, int]):
+        if self.transport is not None:
+            self.transport.sendto(data, address)
+        else:
+            self.sock.sendto(data, address)
+
+    def sendto_buffers(self, buffers: List[Buffer], address: Tuple[str, int]):
+        if self.batcher is not None and self.codec_for(address) is BINARY:
+            self.batcher.add(buffers, address)
+        else:
+            self.write_buffers(buffers, address)
+
+    def write_buffers(self, buffers: List[Buffer], address: Tuple[str, int]):
+        """Send buffers as one datagram right away."""
+        self.last_sent[address] = time.monotonic()
+        if self.compressor is not None:
+            buffers = self.compressor.process(buffers, address)
+        if self.metrics is not None:
+            self.metrics.record_out(address, sum(len(buffer) for buffer in buffers))
+        if self.capture is not None:
+            self.capture.record(buffers, address, True, self.reliable)
+        if len(buffers) == 1:
+            self.sendto(buffers[0], address)
+            return
+        # A transport with queued data must keep ordering, so it gets the joined datagram
+        if HAS_SENDMSG and (self.transport is None or self.transport.get_write_buffer_size() == 0):
+            try:
+                self.sock.sendmsg(buffers, (), 0, address)
+                return
+            except BlockingIOError:
+                if self.transport is None:
+                    raise
+        self.sendto(b"".join(buffers), address)
 
     @abstractmethod
     def process_queue(self):
@@ -26,4 +109,5 @@ class BaseHandler(ABC):
 
     def stop(self):
         self.running = False
-        self.thread.join()
\ No newline at end of file
+        if self.thread is not None:
+            self.thread.join()
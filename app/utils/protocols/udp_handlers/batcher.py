@@ -0,0 +1,72 @@
+# batcher.py
+import threading
+from typing import Callable, Dict, List, Tuple
+
+from ..codec import BINARY, FRAME_LENGTH, HEADER, Buffer
+from ..log import RATE_LIMITED, logger
+
+DEFAULT_MTU = 1200
+DEFAULT_FLUSH_DELAY = 0.005
+
+
+class Batcher:
+    """Coalesces frames bound for the same peer into datagrams of up to mtu bytes.
+
+    The first frame queued for a peer arms a short flush deadline. Frames added
+    before it fires share the datagram, which is sent early once the next frame
+    would not fit. A lone frame goes out as is, without the batch wrapper, and
+    a frame too large for any batch is sent straight away.
+    """
+
+    def __init__(self, send: Callable[[List[Buffer], Tuple[str, int]], None], scheduler,
+                 mtu: int = DEFAULT_MTU, flush_delay: float = DEFAULT_FLUSH_DELAY):
+        if mtu <= HEADER.size + FRAME_LENGTH.size:
+            raise ValueError(f"MTU too small for a batch, got {mtu}.")
+        self.send = send
+        self.scheduler = scheduler
+        self.mtu = mtu
+        self.flush_delay = flush_delay
+        self.pending: Dict[Tuple[str, int], List[List[Buffer]]] = {}
+        self.sizes: Dict[Tuple[str, int], int] = {}
+        self.timers = {}
+        self.lock = threading.Lock()
+
+    def add(self, buffers: List[Buffer], address: Tuple[str, int]):
+        size = FRAME_LENGTH.size + sum(len(buffer) for buffer in buffers)
+        with self.lock:
+            if HEADER.size + size > self.mtu:
+                # Keep the peer's frames in order before sending the oversized one
+                self._flush(address)
+                self.send(buffers, address)
+                return
+            if address in self.pending and self.sizes[address] + size > self.mtu:
+                self._flush(address)
+            frames = self.pending.get(address)
+            if frames is None:
+                frames = self.pending[address] = []
+                self.sizes[address] = HEADER.size
+                self.timers[address] = self.scheduler.call_later(self.flush_delay, self.flush, address)
+            frames.append(buffers)
+            self.sizes[address] += size
+
+    def flush(self, address: Tuple[str, int]):
+        with self.lock:
+            self._flush(address)
+
+    def flush_all(self):
+        with self.lock:
+            for address in list(self.pending):
+                self._flush(address)
+
+    def _flush(self, address: Tuple[str, int]):
+        frames = self.pending.pop(address, None)
+        if frames is None:
+            return
+        self.sizes.pop(address, None)
+        timer = self.timers.pop(address, None)
+        if timer is not None:
+            timer.cancel()
+        try:
+            self.send(frames[0] if len(frames) == 1 else BINARY.pack_batch(frames), address)
+        except OSError as e:
+            logger.warning("Error sending batch to %s: %s", address, e, extra=RATE_LIMITED)
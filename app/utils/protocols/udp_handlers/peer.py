@@ -0,0 +1,231 @@
+# peer.py
+import heapq
+import itertools
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from ..codec import Body
+
+SEQ_MODULO = 1 << 32
+ACK_WINDOW = 32
+ACK_MASK = (1 << ACK_WINDOW) - 1
+
+INITIAL_RTO = 1.0
+MIN_RTO = 0.2
+MAX_RTO = 8.0
+MAX_RETRIES = 10
+# Packets an ordered channel holds behind a gap before it stops accepting more
+MAX_HELD = 1024
+
+
+def seq_greater(a: int, b: int) -> bool:
+    """True if sequence a is newer than b, allowing for wraparound."""
+    return a != b and (a - b) % SEQ_MODULO < SEQ_MODULO // 2
+
+
+def seq_next(seq: int) -> int:
+    # Zero means "no sequence" on the wire, so skip it when wrapping
+    return seq % (SEQ_MODULO - 1) + 1
+
+
+class PendingPacket:
+    __slots__ = ("body", "seq", "sent_at", "retries", "rto")
+
+    def __init__(self, body: Body, seq: int, sent_at: float, rto: float):
+        self.body = body
+        self.seq = seq
+        self.sent_at = sent_at
+        self.retries = 0
+        self.rto = rto
+
+
+class SequenceSpace:
+    """Sequence numbers of one channel with one peer, in both directions.
+
+    Packets we send are numbered from last_seq and wait in pending for an
+    ack. What we received is remembered as the newest sequence plus a
+    bitfield of the 32 before it, echoed back in our acks. Ordered channels
+    also hold packets that arrived ahead of a gap until it is filled.
+    """
+
+    def __init__(self):
+        self.last_seq = 0
+        self.pending: Dict[int, PendingPacket] = {}
+        # What we have received from the peer, echoed back in our acks
+        self.remote_seq = 0
+        self.remote_bits = 0
+        # Ordered channels: the next sequence to deliver and what arrived past it
+        self.next_delivery = seq_next(0)
+        self.held: Dict[int, dict] = {}
+
+    def next_seq(self) -> int:
+        self.last_seq = seq_next(self.last_seq)
+        return self.last_seq
+
+    def track(self, body: Body, seq: int, now: float, rto: float) -> PendingPacket:
+        entry = PendingPacket(body, seq, now, rto)
+        self.pending[seq] = entry
+        return entry
+
+    def record_received(self, seq: int) -> bool:
+        """Note an inbound reliable sequence, returning False for duplicates."""
+        if self.remote_seq == 0 or seq_greater(seq, self.remote_seq):
+            shift = (seq - self.remote_seq) % SEQ_MODULO if self.remote_seq else 0
+            if shift > ACK_WINDOW:
+                self.remote_bits = 0
+            elif shift:
+                self.remote_bits = ((self.remote_bits << shift) | (1 << (shift - 1))) & ACK_MASK
+            self.remote_seq = seq
+            return True
+        distance = (self.remote_seq - seq) % SEQ_MODULO
+        if distance == 0 or distance > ACK_WINDOW:
+            # Older than the window: assume it was handled before and just re-ack it
+            return False
+        bit = 1 << (distance - 1)
+        if self.remote_bits & bit:
+            return False
+        self.remote_bits |= bit
+        return True
+
+    def receive_ordered(self, seq: int, packet: dict) -> Optional[List[dict]]:
+        """Accept a packet of an ordered channel, returning what can now be delivered.
+
+        The list is empty for duplicates and for packets held behind a gap.
+        None means seq is too far ahead to hold: it is neither recorded nor
+        to be acked, so the peer sends it again once the gap is filled.
+        """
+        if seq != self.next_delivery and not seq_greater(seq, self.next_delivery):
+            self.record_received(seq)
+            return []  # Delivered before, only the ack was lost
+        if (seq - self.next_delivery) % SEQ_MODULO >= MAX_HELD:
+            return None
+        self.record_received(seq)
+        if seq != self.next_delivery:
+            self.held.setdefault(seq, packet)
+            return []
+        delivered = [packet]
+        self.next_delivery = seq_next(seq)
+        while self.next_delivery in self.held:
+            delivered.append(self.held.pop(self.next_delivery))
+            self.next_delivery = seq_next(self.next_delivery)
+        return delivered
+
+    def reset_remote(self):
+        self.remote_seq = 0
+        self.remote_bits = 0
+        self.next_delivery = seq_next(0)
+        self.held = {}
+
+    def ack_fields(self) -> Tuple[int, int]:
+        return self.remote_seq, self.remote_bits
+
+
+class ReliablePeer(SequenceSpace):
+    """Reliable-channel state for one remote address.
+
+    Each peer numbers its own packets, so one lossy client never delays
+    another. Acks name the newest sequence seen plus a bitfield for the 32
+    before it, so one ack packet can confirm a whole burst. The peer is the
+    sequence space of the default channel, every other channel gets its own
+    in lanes, so a loss on one never holds up another. The RTT estimate is
+    shared by all of them.
+    """
+
+    def __init__(self, address: Tuple[str, int], initial_rto: float = INITIAL_RTO,
+                 min_rto: float = MIN_RTO, max_rto: float = MAX_RTO):
+        super().__init__()
+        self.address = address
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.lanes: Dict[int, SequenceSpace] = {}
+        # Smoothed round trip estimate as in RFC 6298
+        self.srtt: Optional[float] = None
+        self.rttvar: Optional[float] = None
+        self.rto = initial_rto
+        # RTT sample taken by the last process_ack, None if it took none
+        self.last_rtt: Optional[float] = None
+        # One retransmit timer for every channel, armed for retransmit_at
+        self.timer = None
+        self.retransmit_at = 0.0
+        # (deadline, order, packet) of every pending packet on every channel. Acked
+        # and backed off packets are left in place and skipped when they surface.
+        self.deadlines: List[Tuple[float, int, PendingPacket]] = []
+        self.deadline_order = itertools.count()
+
+    def lane(self, channel: int) -> SequenceSpace:
+        if not channel:
+            return self
+        lane = self.lanes.get(channel)
+        if lane is None:
+            lane = self.lanes[channel] = SequenceSpace()
+        return lane
+
+    def all_pending(self) -> Iterator[PendingPacket]:
+        yield from self.pending.values()
+        for lane in list(self.lanes.values()):
+            yield from lane.pending.values()
+
+    def schedule(self, entry: PendingPacket):
+        """Note the retransmit deadline of a packet just sent or resent."""
+        heapq.heappush(self.deadlines, (entry.sent_at + entry.rto, next(self.deadline_order), entry))
+
+    def _is_current(self, deadline: float, entry: PendingPacket) -> bool:
+        return (self.lane(entry.body.channel).pending.get(entry.seq) is entry
+                and deadline == entry.sent_at + entry.rto)
+
+    def pop_due(self, due_by: float, limit: int) -> List[PendingPacket]:
+        """Take up to limit pending packets whose deadline is at or before due_by, earliest first."""
+        due = []
+        while self.deadlines and self.deadlines[0][0] <= due_by and len(due) < limit:
+            deadline, _, entry = heapq.heappop(self.deadlines)
+            if self._is_current(deadline, entry):
+                due.append(entry)
+        return due
+
+    def next_deadline(self) -> Optional[float]:
+        while self.deadlines and not self._is_current(self.deadlines[0][0], self.deadlines[0][2]):
+            heapq.heappop(self.deadlines)
+        return self.deadlines[0][0] if self.deadlines else None
+
+    def pending_count(self) -> int:
+        return len(self.pending) + sum(len(lane.pending) for lane in list(self.lanes.values()))
+
+    def process_ack(self, ack: int, ack_bits: int, now: float, channel: int = 0) -> List[PendingPacket]:
+        """Drop every pending packet of the channel the ack covers and return them."""
+        lane = self.lane(channel)
+        acked = []
+        self.last_rtt = None
+        entry = lane.pending.pop(ack, None)
+        if entry is not None:
+            acked.append(entry)
+            # Karn's rule: a retransmitted packet's ack says nothing about the RTT
+            if entry.retries == 0:
+                self.last_rtt = now - entry.sent_at
+                self.sample_rtt(self.last_rtt)
+        ack_bits &= ACK_MASK
+        if ack_bits:
+            for bit in range(ACK_WINDOW):
+                if ack_bits >> bit & 1:
+                    entry = lane.pending.pop((ack - bit - 1) % SEQ_MODULO, None)
+                    if entry is not None:
+                        acked.append(entry)
+        return acked
+
+    def sample_rtt(self, rtt: float):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(self.max_rto, max(self.min_rto, self.srtt + 4 * self.rttvar))
+
+    def backoff(self, entry: PendingPacket, now: float):
+        entry.retries += 1
+        entry.sent_at = now
+        entry.rto = min(self.max_rto, entry.rto * 2)
+
+    def reset_remote(self):
+        """Forget what was received on every channel, for a peer that starts over."""
+        super().reset_remote()
+        for lane in list(self.lanes.values()):
+            lane.reset_remote()
@@ -1,57 +1,234 @@
 # reliable.py
-import json
+import asyncio
+import itertools
 import queue
 import threading
 import time
-from typing import Dict, Tuple
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
 
 from .base_handler import BaseHandler
+from .peer import INITIAL_RTO, MAX_RETRIES, MAX_RTO, MIN_RTO, SEQ_MODULO, ReliablePeer, SequenceSpace
+from .send_queue import SendQueue
+from ..codec import FLAG_RELIABLE, Body, Codec, CodecError
+from ..log import RATE_LIMITED, logger
+from ..scheduler import make_scheduler
+
+# Bodies queued for one peer before the server is told it is falling behind
+RELIABLE_HIGH_WATER = 256
+# Largest datagram a reliable body goes out in before it is fragmented
+DEFAULT_FRAGMENT_SIZE = 1200
+# Bytes the seq, ack and ack_bits of a JSON frame can add to a body
+FRAME_FIELDS_ROOM = 48
+# Packets one timer run resends at most, so a burst coming due cannot hold ack_lock for long
+RETRANSMIT_BATCH = 256
 
 class ReliableHandler(BaseHandler):
-    def __init__(self, sock):
-        super().__init__(sock)
-        self.sequence_number = 0
-        self.pending_acks: Dict[int, Tuple[dict, Tuple[str, int], float]] = {}
+    reliable = True
+
+    def __init__(self, sock, loop: Optional[asyncio.AbstractEventLoop] = None,
+                 codecs: Optional[Dict[Tuple[str, int], Codec]] = None,
+                 on_peer_lost: Optional[Callable[[Tuple[str, int]], None]] = None,
+                 max_retries: int = MAX_RETRIES, initial_rto: float = INITIAL_RTO,
+                 min_rto: float = MIN_RTO, max_rto: float = MAX_RTO, scheduler=None,
+                 high_water: Optional[int] = RELIABLE_HIGH_WATER,
+                 on_high_water: Optional[Callable[[Tuple[str, int], int], None]] = None,
+                 fragment_size: Optional[int] = DEFAULT_FRAGMENT_SIZE):
+        """Reliable delivery with per-peer sequence spaces and adaptive retransmits.
+
+        Every logical channel has its own sequence space per peer: a body is
+        numbered, acked and retransmitted in the space of its channel, and
+        inbound acks and sequences are taken in the space of the channel
+        their frame names.
+
+        Args:
+            on_peer_lost: Called with the address of a peer that failed to ack
+                a packet max_retries times. Its pending packets are dropped first.
+            max_retries: Retransmissions of one packet before giving up on the peer.
+            initial_rto, min_rto, max_rto: Retransmit timeout bounds in seconds. The
+                timeout follows each peer's smoothed RTT and doubles per retry.
+            scheduler: Timer scheduler shared with the owning server. One is
+                created, and stopped with the handler, when none is given.
+            high_water, on_high_water: Reliable bodies are never dropped. Instead
+                on_high_water gets the address and queue depth of a peer whose
+                queue reaches high_water, once until it drains to half of it.
+            fragment_size: Bodies that would make a datagram larger than this
+                are sent as fragments that fit it. Each fragment is numbered,
+                acked and retransmitted on its own, so a loss only costs the
+                missing fragments. None sends every body whole.
+        """
+        super().__init__(sock, loop, codecs, SendQueue(high_water=high_water, on_high_water=on_high_water))
+        self.peers: Dict[Tuple[str, int], ReliablePeer] = {}
+        self.on_peer_lost = on_peer_lost
+        self.max_retries = max_retries
+        self.initial_rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.ack_bodies: Dict[Tuple[Codec, int], Body] = {}
         self.ack_lock = threading.Lock()
-        self.retry_thread = threading.Thread(target=self.retry_unacknowledged_packets, daemon=True)
-        self.retry_thread.start()
+        # Every peer has one retransmit timer on the scheduler, armed for its earliest deadline
+        self.owns_scheduler = scheduler is None
+        self.scheduler = make_scheduler(loop) if scheduler is None else scheduler
+        self.fragment_size = fragment_size
+        self.message_ids = itertools.count(1)
+
+    def get_peer(self, address: Tuple[str, int]) -> ReliablePeer:
+        peer = self.peers.get(address)
+        if peer is None:
+            peer = ReliablePeer(address, self.initial_rto, self.min_rto, self.max_rto)
+            self.peers[address] = peer
+        return peer
 
-    def send(self, packet: dict, address: Tuple[str, int]):
+    def send_body(self, body: Body, addresses: Sequence[Tuple[str, int]]):
+        # The body is shared, only the sequence and ack fields in the frame differ per peer
+        bodies = self.fragment(body)
         with self.ack_lock:
-            self.sequence_number += 1
-            packet["seq"] = self.sequence_number
-            encoded_packet = json.dumps(packet).encode('utf-8')
-            self.sock.sendto(encoded_packet, address)
-            self.pending_acks[self.sequence_number] = (packet, address, time.time())
+            current_time = time.monotonic()
+            for address in addresses:
+                peer = self.get_peer(address)
+                lane = peer.lane(body.channel)
+                for part in bodies:
+                    seq = lane.next_seq()
+                    self.sendto_buffers(part.frame(seq, *lane.ack_fields(), FLAG_RELIABLE), address)
+                    peer.schedule(lane.track(part, seq, current_time, peer.rto))
+                if bodies:
+                    self._arm(peer, current_time + peer.rto, peer.rto)
+
+    def _arm(self, peer: ReliablePeer, deadline: float, delay: float):
+        """Make sure the peer's retransmit timer runs by deadline, delay seconds from now."""
+        if peer.timer is not None:
+            if peer.retransmit_at <= deadline:
+                return
+            peer.timer.cancel()
+        peer.retransmit_at = deadline
+        peer.timer = self.scheduler.call_later(delay, self.retransmit, peer)
+
+    def fragment(self, body: Body) -> List[Body]:
+        """The body itself if it fits in one datagram, else its fragments."""
+        if self.fragment_size is None:
+            return [body]
+        data = body.frame()
+        # Room for the sequence and ack fields the frame gets per peer
+        if sum(len(buffer) for buffer in data) + FRAME_FIELDS_ROOM <= self.fragment_size:
+            return [body]
+        message_id = next(self.message_ids) % SEQ_MODULO
+        try:
+            return body.codec.fragment_bodies(b"".join(data), message_id, body.channel, self.fragment_size)
+        except CodecError as e:
+            logger.warning("Dropping a body too large to send: %s", e, extra=RATE_LIMITED)
+            return []
 
     def process_queue(self):
         while self.running:
             try:
-                packet, address = self.queue.get(timeout=0.1)
-                self.send(packet, address)
+                address, body = self.queue.get(timeout=0.1)
+                self.send_body(body, (address,))
             except queue.Empty:
                 continue
 
-    def process_ack(self, seq_num: int):
+    def process_ack(self, address: Tuple[str, int], ack: int, ack_bits: int = 0, channel: int = 0):
         with self.ack_lock:
-            self.pending_acks.pop(seq_num, None)
+            peer = self.peers.get(address)
+            if peer is not None and ack:
+                acked = peer.process_ack(ack, ack_bits, time.monotonic(), channel)
+                if acked and peer.timer is not None and not peer.pending_count():
+                    peer.timer.cancel()
+                    peer.timer = None
+                    peer.deadlines.clear()
+                if peer.last_rtt is not None and self.metrics is not None:
+                    self.metrics.rtt.observe(peer.last_rtt)
 
-    def retry_unacknowledged_packets(self):
-        while self.running:
-            with self.ack_lock:
-                current_time = time.time()
-                for seq_num, (packet, address, timestamp) in list(self.pending_acks.items()):
-                    if current_time - timestamp > 1.0:  # ack_timeout
-                        encoded_packet = json.dumps(packet).encode('utf-8')
-                        self.sock.sendto(encoded_packet, address)
-                        self.pending_acks[seq_num] = (packet, address, current_time)
-            time.sleep(0.1)
+    def acknowledge(self, address: Tuple[str, int], seq: int, reset: bool = False, channel: int = 0) -> bool:
+        """Ack an inbound reliable packet, returning False if it is a duplicate.
+
+        The ack covers the 32 sequences before seq as well, so a lost ack is
+        repaired by the next one. reset starts fresh receive windows on every
+        channel, for peers that reconnect and number their packets from the
+        start again.
+        """
+        with self.ack_lock:
+            peer = self.get_peer(address)
+            if reset:
+                peer.reset_remote()
+            lane = peer.lane(channel)
+            is_new = lane.record_received(seq)
+            self._send_ack(address, lane, channel)
+        return is_new
+
+    def receive_ordered(self, address: Tuple[str, int], seq: int, packet: dict,
+                        reset: bool = False, channel: int = 0) -> List[dict]:
+        """Ack an inbound packet of an ordered channel and return the packets now due, in order.
+
+        A packet past a gap is held and acked, and comes out of a later call
+        once the packets before it arrived. One too far past the gap is
+        dropped unacked for the peer to resend.
+        """
+        with self.ack_lock:
+            peer = self.get_peer(address)
+            if reset:
+                peer.reset_remote()
+            lane = peer.lane(channel)
+            delivered = lane.receive_ordered(seq, packet)
+            if delivered is None:
+                return []
+            self._send_ack(address, lane, channel)
+        return delivered
+
+    def _send_ack(self, address: Tuple[str, int], lane: SequenceSpace, channel: int):
+        codec = self.codec_for(address)
+        ack_body = self.ack_bodies.get((codec, channel))
+        if ack_body is None:
+            packet = {"type": "ack", "channel": channel} if channel else {"type": "ack"}
+            ack_body = self.ack_bodies[codec, channel] = codec.encode_body(packet)
+        self.sendto_buffers(ack_body.frame(0, *lane.ack_fields(), FLAG_RELIABLE), address)
+
+    def retransmit(self, peer: ReliablePeer):
+        """Retransmit timer of a peer: resend the packets that are due and re-arm for the next.
+
+        Only packets whose deadline passed are touched, at most RETRANSMIT_BATCH
+        of them per run. The timer runs again right away for the rest.
+        """
+        lost = False
+        with self.ack_lock:
+            if self.peers.get(peer.address) is not peer:
+                return
+            peer.timer = None
+            now = time.monotonic()
+            # A timer that runs a little early still resends what was due at its deadline
+            due_by = max(now, peer.retransmit_at)
+            for entry in peer.pop_due(due_by, RETRANSMIT_BATCH):
+                if entry.retries >= self.max_retries:
+                    lost = True
+                    break
+                peer.backoff(entry, now)
+                peer.schedule(entry)
+                if self.metrics is not None:
+                    self.metrics.record_retransmit(peer.address)
+                lane = peer.lane(entry.body.channel)
+                self.sendto_buffers(entry.body.frame(entry.seq, *lane.ack_fields(), FLAG_RELIABLE),
+                                    peer.address)
+            if lost:
+                self.peers.pop(peer.address, None)
+            else:
+                deadline = peer.next_deadline()
+                if deadline is not None and deadline <= due_by:
+                    # More came due than one batch resends
+                    self._arm(peer, due_by, 0.0)
+                elif deadline is not None:
+                    self._arm(peer, deadline, deadline - now)
+        if lost:
+            logger.warning("Peer %s stopped acknowledging packets", peer.address)
+            if self.on_peer_lost is not None:
+                self.on_peer_lost(peer.address)
 
     def stop(self):
         super().stop()
-        self.retry_thread.join()
+        if self.owns_scheduler:
+            self.scheduler.stop()
 
-    def remove_client(self, client_id: str):
+    def remove_peer(self, address: Tuple[str, int]):
         with self.ack_lock:
-            # Remove pending acks for the client
-            self.pending_acks = {seq: data for seq, data in self.pending_acks.items() if data[0].get("client_id") != client_id}
+            # Stop retransmitting anything still owed to the departed peer
+            self.queue.discard(address)
+            peer = self.peers.pop(address, None)
+            if peer is not None and peer.timer is not None:
+                peer.timer.cancel()
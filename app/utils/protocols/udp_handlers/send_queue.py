@@ -0,0 +1,138 @@
+# send_queue.py
+import queue
+import threading
+from collections import deque
+from typing import Callable, Deque, Dict, Hashable, Optional, Sequence, Tuple
+
+from ..codec import Body
+
+Address = Tuple[str, int]
+
+
+class _Entry:
+    __slots__ = ("key", "body")
+
+    def __init__(self, key: Optional[Hashable], body: Body):
+        self.key = key
+        self.body = body
+
+
+class _PeerQueue:
+    __slots__ = ("entries", "latest", "above_high_water")
+
+    def __init__(self):
+        self.entries: Deque[_Entry] = deque()
+        # Queued entry per conflation key, so a newer body can take its place
+        self.latest: Dict[Hashable, _Entry] = {}
+        self.above_high_water = False
+
+
+class SendQueue:
+    """Per-peer send queues drained round robin by a handler's worker thread.
+
+    A fan-out shares one body across the recipients' queues. With max_depth a
+    full peer queue drops its oldest entry to make room, and with conflate a
+    body queued under a key replaces the one still waiting under the same key,
+    so a slow peer gets the latest state instead of a backlog of stale ones.
+    Queues without a bound never drop, but on_high_water is called with the
+    peer's address and depth when it first reaches high_water.
+    """
+
+    def __init__(self, max_depth: Optional[int] = None, conflate: bool = False,
+                 high_water: Optional[int] = None,
+                 on_high_water: Optional[Callable[[Address, int], None]] = None):
+        if max_depth is not None and max_depth < 1:
+            raise ValueError(f"Queue depth must be positive, got {max_depth}.")
+        self.max_depth = max_depth
+        self.conflate = conflate
+        self.high_water = high_water
+        self.on_high_water = on_high_water
+        self.peers: Dict[Address, _PeerQueue] = {}
+        # Peers with something queued, in the order they get their next turn
+        self.ready: Deque[Address] = deque()
+        self.condition = threading.Condition()
+        self.depth = 0
+        self.dropped = 0
+        self.conflated = 0
+        self.high_water_events = 0
+
+    def put(self, body: Body, addresses: Sequence[Address], key: Optional[Hashable] = None):
+        signals = []
+        with self.condition:
+            for address in addresses:
+                peer = self.peers.get(address)
+                if peer is None:
+                    peer = self.peers[address] = _PeerQueue()
+                if not peer.entries:
+                    self.ready.append(address)
+                if key is not None and self.conflate:
+                    entry = peer.latest.get(key)
+                    if entry is not None:
+                        entry.body = body
+                        self.conflated += 1
+                        continue
+                if self.max_depth is not None and len(peer.entries) >= self.max_depth:
+                    self._forget(peer, peer.entries.popleft())
+                    self.depth -= 1
+                    self.dropped += 1
+                entry = _Entry(key, body)
+                peer.entries.append(entry)
+                if key is not None and self.conflate:
+                    peer.latest[key] = entry
+                self.depth += 1
+                if self.high_water is not None and not peer.above_high_water \
+                        and len(peer.entries) >= self.high_water:
+                    peer.above_high_water = True
+                    self.high_water_events += 1
+                    signals.append((address, len(peer.entries)))
+            self.condition.notify()
+        # Outside the lock so the callback may enqueue or inspect the queue
+        if self.on_high_water is not None:
+            for address, depth in signals:
+                self.on_high_water(address, depth)
+
+    def get(self, timeout: Optional[float] = None) -> Tuple[Address, Body]:
+        """Next body to send and its recipient, raising queue.Empty on timeout."""
+        with self.condition:
+            if not self.ready and not self.condition.wait_for(lambda: self.ready, timeout):
+                raise queue.Empty
+            address = self.ready.popleft()
+            peer = self.peers[address]
+            entry = peer.entries.popleft()
+            self._forget(peer, entry)
+            self.depth -= 1
+            if peer.entries:
+                self.ready.append(address)
+            else:
+                del self.peers[address]
+            if peer.above_high_water and self.high_water is not None \
+                    and len(peer.entries) <= self.high_water // 2:
+                peer.above_high_water = False
+            return address, entry.body
+
+    def discard(self, address: Address):
+        """Drop everything still queued for a peer that went away."""
+        with self.condition:
+            peer = self.peers.pop(address, None)
+            if peer is not None:
+                self.depth -= len(peer.entries)
+                self.ready.remove(address)
+
+    def record_drop(self, count: int = 1):
+        """Count bodies dropped before they reached the queue, e.g. by a full transport."""
+        with self.condition:
+            self.dropped += count
+
+    def stats(self) -> Dict[str, int]:
+        with self.condition:
+            return {
+                "depth": self.depth,
+                "max_peer_depth": max((len(peer.entries) for peer in self.peers.values()), default=0),
+                "dropped": self.dropped,
+                "conflated": self.conflated,
+                "high_water_events": self.high_water_events,
+            }
+
+    def _forget(self, peer: _PeerQueue, entry: _Entry):
+        if entry.key is not None and peer.latest.get(entry.key) is entry:
+            del peer.latest[entry.key]
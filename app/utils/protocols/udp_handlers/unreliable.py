@@ -1,20 +1,47 @@
 # unreliable.py
-import json
+import asyncio
 import queue
-from typing import Tuple
+from typing import Dict, Optional, Sequence, Tuple
 
 from .base_handler import BaseHandler
+from .send_queue import SendQueue
+from ..codec import Body, Codec
+
+# Bodies waiting per peer before the oldest is dropped
+UNRELIABLE_QUEUE_DEPTH = 64
+# Bytes an event loop transport may hold back before unreliable sends are dropped
+MAX_BUFFERED = 64 * 1024
 
 class UnreliableHandler(BaseHandler):
-    def send(self, packet: dict, address: Tuple[str, int]):
-        encoded_packet = json.dumps(packet).encode('utf-8')
-        self.sock.sendto(encoded_packet, address)
+    def __init__(self, sock, loop: Optional[asyncio.AbstractEventLoop] = None,
+                 codecs: Optional[Dict[Tuple[str, int], Codec]] = None,
+                 queue_depth: int = UNRELIABLE_QUEUE_DEPTH, max_buffered: int = MAX_BUFFERED):
+        """Fire-and-forget sends that shed stale traffic instead of queueing it.
+
+        Args:
+            queue_depth: Bodies queued per peer before the oldest is dropped.
+                Bodies queued with a key replace the one still waiting under
+                that key, so a slow peer only gets each client's latest update.
+            max_buffered: With an event loop there is no queue, sends are
+                dropped while the transport holds more than this many bytes.
+        """
+        super().__init__(sock, loop, codecs, SendQueue(max_depth=queue_depth, conflate=True))
+        self.max_buffered = max_buffered
+
+    def send_body(self, body: Body, addresses: Sequence[Tuple[str, int]]):
+        if self.transport is not None and self.transport.get_write_buffer_size() > self.max_buffered:
+            # The socket is not keeping up, newer state will follow
+            self.queue.record_drop(len(addresses))
+            return
+        # Nothing differs per recipient, so every peer gets the same buffers
+        buffers = body.frame(body.seq)
+        for address in addresses:
+            self.sendto_buffers(buffers, address)
 
     def process_queue(self):
         while self.running:
             try:
-                packet, address = self.queue.get(timeout=0.01)
-                self.send(packet, address)
+                address, body = self.queue.get(timeout=0.01)
+                self.send_body(body, (address,))
             except queue.Empty:
                 continue
-
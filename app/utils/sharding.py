@@ -0,0 +1,274 @@
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .lobby_events import LobbyEvents
+from .udp_manager import UDPManager
+
+# Packets per second that weigh as much as one connected player when placing lobbies
+PACKETS_PER_PLAYER = 30.0
+
+
+class ShardPipe:
+    """Worker end of a shard's pipe, shared by call replies and the lobby events of every lobby thread."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+
+    def send(self, message: tuple):
+        with self.lock:
+            self.conn.send(message)
+
+    def push(self, event: dict):
+        try:
+            self.send(("event", event))
+        except OSError:
+            pass  # The parent is gone or the shard is shutting down
+
+
+def _serve_shard(conn, options: dict):
+    """Worker process: host a UDPManager, run the calls sent over conn and send its lobby events back."""
+    manager = UDPManager(**options)
+    pipe = ShardPipe(conn)
+    manager.events.attach(pipe)
+    try:
+        while True:
+            try:
+                method, args, kwargs = conn.recv()
+            except EOFError:
+                break
+            if method == "stop_all_servers":
+                manager.stop_all_servers()
+                pipe.send(("ok", None))
+                break
+            try:
+                pipe.send(("ok", getattr(manager, method)(*args, **kwargs)))
+            except Exception as e:
+                pipe.send(("error", e))
+    finally:
+        if manager.running:
+            manager.stop_all_servers()
+        conn.close()
+
+
+class Shard:
+    """Handle on one worker process. Calls are serialised since they share a pipe.
+
+    A reader thread takes everything the worker sends: replies go to the
+    waiting call, lobby events to on_event. Both come in the order the
+    worker sent them, so the events a call caused are handled before it
+    returns.
+    """
+
+    def __init__(self, index: int, context, options: dict, on_event: Callable[["Shard", Optional[dict]], None]):
+        self.index = index
+        self.on_event = on_event
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=_serve_shard, args=(child, options),
+                                       name=f"udp-shard-{index}", daemon=True)
+        self.process.start()
+        child.close()
+        self.lock = threading.Lock()
+        self.replies: queue.Queue = queue.Queue()
+        self.running = True
+        self.reader = threading.Thread(target=self._read, name=f"udp-shard-{index}-reader", daemon=True)
+        self.reader.start()
+        # Last load sample, to turn the packet counter into a rate
+        self.sampled_at = time.monotonic()
+        self.packets = 0
+
+    def _read(self):
+        while True:
+            try:
+                status, payload = self.conn.recv()
+            except (EOFError, OSError) as e:
+                self.running = False
+                self.replies.put(("gone", e))
+                # Every lobby of the shard went with it
+                self.on_event(self, None)
+                return
+            if status == "event":
+                self.on_event(self, payload)
+            else:
+                self.replies.put((status, payload))
+
+    def send(self, method: str, *args, **kwargs):
+        try:
+            self.conn.send((method, args, kwargs))
+        except OSError as e:
+            raise RuntimeError(f"UDP shard {self.index} is not running: {e}") from e
+
+    def reply(self, timeout: Optional[float] = None):
+        try:
+            status, result = self.replies.get(timeout=timeout)
+        except queue.Empty:
+            raise RuntimeError(f"UDP shard {self.index} did not reply in {timeout} seconds.") from None
+        if status == "gone":
+            raise RuntimeError(f"UDP shard {self.index} is not running: {result}")
+        if status == "error":
+            raise result
+        return result
+
+    def call(self, method: str, *args, **kwargs):
+        with self.lock:
+            if not self.running:
+                raise RuntimeError(f"UDP shard {self.index} is not running.")
+            self.send(method, *args, **kwargs)
+            return self.reply()
+
+    def score(self) -> Tuple[float, int]:
+        """Load used for placement, lower is better: weighted players, then lobby count."""
+        load = self.call("load")
+        now = time.monotonic()
+        elapsed = max(now - self.sampled_at, 1e-3)
+        rate = max(load["packets"] - self.packets, 0) / elapsed
+        self.sampled_at, self.packets = now, load["packets"]
+        return load["players"] + rate / PACKETS_PER_PLAYER, load["lobbies"]
+
+
+class ShardedUDPManager:
+    def __init__(self, workers: Optional[int] = None, batching: bool = False,
+                 dictionary: Optional[bytes] = None, capture_dir: Optional[str] = None):
+        """Spread lobbies over worker processes so one node can use every core.
+
+        Each worker hosts its own UDPManager on the thread engine and the API
+        process forwards calls to it over a pipe. New lobbies go to the shard
+        with the fewest players, counting packet rate as extra load, so busy
+        lobbies push new ones elsewhere. Workers send their lobby events back
+        up the pipe, which keeps the lobby to shard map current when a shard
+        expires a lobby on its own, and which are republished on events.
+
+        Args:
+            workers: Number of worker processes, one per CPU core by default.
+            batching, dictionary, capture_dir: Passed to every shard's UDPManager.
+        """
+        workers = workers or os.cpu_count() or 1
+        if workers < 1:
+            raise ValueError(f"Need at least one shard, got {workers}.")
+        # Forking a process that already runs threads is unsafe, so always spawn
+        context = multiprocessing.get_context("spawn")
+        options = {"engine": "thread", "batching": batching, "dictionary": dictionary,
+                   "capture_dir": capture_dir}
+        self.lobby_shards: Dict[str, Shard] = {}
+        self.lock = threading.Lock()
+        self.events = LobbyEvents()
+        # Shard versions only mean something within their shard, so forwarded events are renumbered
+        self.version = 0
+        self.version_lock = threading.Lock()
+        self.running = True
+        self.shards = [Shard(index, context, options, self._on_shard_event) for index in range(workers)]
+
+    def _on_shard_event(self, shard: Shard, event: Optional[dict]):
+        """Track lobbies by their lifecycle events and republish every event. None when the shard died."""
+        if event is None:
+            names = [name for name, owner in list(self.lobby_shards.items()) if owner is shard]
+            for name in names:
+                self._on_shard_event(shard, {"type": "lobby_removed", "lobby": name})
+            return
+        event_type = event["type"]
+        if event_type == "lobby_created":
+            self.lobby_shards[event["lobby"]["name"]] = shard
+        elif event_type == "lobby_removed":
+            # Reader threads update the map without self.lock, which create_server holds across shard calls
+            if self.lobby_shards.get(event["lobby"]) is not shard:
+                return
+            del self.lobby_shards[event["lobby"]]
+        details = {key: value for key, value in event.items() if key not in ("type", "version")}
+        with self.version_lock:
+            self.version += 1
+            self.events.publish(event_type, self.version, **details)
+
+    def shard_of(self, lobby_id: str) -> Shard:
+        shard = self.lobby_shards.get(lobby_id)
+        if shard is None:
+            raise ValueError(f"Lobby {lobby_id} does not exist.")
+        return shard
+
+    def create_server(self, lobby_name: str, admin_id: str, tick_rate: Optional[float] = None,
+                      interest_radius: Optional[float] = None, max_players: Optional[int] = None,
+                      jitter_delay: Optional[float] = None, channels: Optional[Dict[int, str]] = None,
+                      compression: bool = False):
+        """Create the lobby on the least loaded shard."""
+        with self.lock:
+            if lobby_name in self.lobby_shards:
+                raise ValueError(f"Lobby {lobby_name} already exists.")
+            shard = min(self.shards, key=Shard.score)
+            # Its lobby_created event maps the name to the shard before the call returns
+            shard.call("create_server", lobby_name, admin_id, tick_rate=tick_rate,
+                       interest_radius=interest_radius, max_players=max_players,
+                       jitter_delay=jitter_delay, channels=channels, compression=compression)
+        print(f"Lobby {lobby_name} placed on shard {shard.index}")
+
+    def join_server(self, lobby_id: str, player_id: str) -> Tuple[int, int]:
+        return tuple(self.shard_of(lobby_id).call("join_server", lobby_id, player_id))
+
+    def update_activity(self, lobby_id: str):
+        shard = self.lobby_shards.get(lobby_id)
+        if shard is not None:
+            shard.call("update_activity", lobby_id)
+
+    def route_of(self, lobby_id: str) -> Optional[int]:
+        # Shards bind their own ports, shared ports would mix every shard's lobbies
+        return None
+
+    def has_lobby(self, lobby_id: str) -> bool:
+        return lobby_id in self.lobby_shards
+
+    def listing_version(self) -> int:
+        # Every change to a shard's listing comes with an event, and every event moves the version
+        return self.version
+
+    def list_lobbies(self) -> List[dict]:
+        lobbies = []
+        for shard in self.shards:
+            lobbies.extend(shard.call("list_lobbies"))
+        return lobbies
+
+    def queue_stats(self) -> Dict[str, dict]:
+        stats = {}
+        for shard in self.shards:
+            stats.update(shard.call("queue_stats"))
+        return stats
+
+    def metrics_snapshot(self) -> Dict[str, dict]:
+        snapshots = {}
+        for shard in self.shards:
+            snapshots.update(shard.call("metrics_snapshot"))
+        return snapshots
+
+    def compression_info(self, lobby_id: str, train: bool = False) -> dict:
+        return self.shard_of(lobby_id).call("compression_info", lobby_id, train=train)
+
+    def remove_server(self, lobby_id: str):
+        # The shard's lobby_removed event drops it from the map
+        self.shard_of(lobby_id).call("remove_server", lobby_id)
+
+    def stop_all_servers(self):
+        """Stop every shard's servers and wait for the workers to exit."""
+        self.running = False
+        # Ask every shard before waiting on any so they shut down in parallel
+        asked = []
+        for shard in self.shards:
+            with shard.lock:
+                try:
+                    shard.send("stop_all_servers")
+                    asked.append(shard)
+                except RuntimeError as e:
+                    print(e)
+        for shard in self.shards:
+            if shard in asked:
+                try:
+                    shard.reply(timeout=5)
+                except RuntimeError:
+                    pass
+            shard.reader.join(timeout=5)
+            shard.conn.close()
+            shard.process.join(timeout=5)
+            if shard.process.is_alive():
+                shard.process.terminate()
+        self.lobby_shards.clear()
+        print("All shards stopped.")
@@ -1,80 +1,216 @@
+import asyncio
+import functools
+import itertools
+import os
 import socket
 import time
 import threading
-from .protocols.udp_client import GameServer
-from typing import Dict, Set, Tuple
+from .lobby_events import LobbyEvents
+from .lobby_registry import LobbyEntry, LobbyRegistry
+from .protocols.interest import GridInterest
+from .protocols.scheduler import make_scheduler
+from .protocols.shared_port import SharedPortRouter
+from .protocols.udp_client import CLIENT_TIMEOUT, HEARTBEAT_INTERVAL, GameServer
+from typing import Dict, List, Optional, Set, Tuple
+from urllib.parse import quote
+
+ENGINES = ("thread", "asyncio")
+EMPTY_LOBBY_TIMEOUT = 300  # 5 minutes in seconds
 
 class UDPManager:
-    def __init__(self):
-        self.servers: Dict[str, GameServer] = {}
+    def __init__(self, engine: str = "thread", batching: bool = False,
+                 shared_ports: Optional[Tuple[int, int]] = None, port_workers: int = 1,
+                 empty_lobby_timeout: float = EMPTY_LOBBY_TIMEOUT,
+                 client_timeout: Optional[float] = CLIENT_TIMEOUT,
+                 heartbeat_interval: Optional[float] = HEARTBEAT_INTERVAL,
+                 dictionary: Optional[bytes] = None, capture_dir: Optional[str] = None):
+        """Track lobby servers and their ports.
+
+        Args:
+            engine: "thread" runs every lobby on its own socket threads, "asyncio"
+                hosts every lobby socket on the running event loop instead. The
+                asyncio engine must be created from inside that loop.
+            batching: Coalesce everything each lobby sends a binary peer within a
+                few milliseconds into MTU sized datagrams.
+            shared_ports: (reliable, unreliable) ports every lobby shares instead
+                of binding two of its own. Clients address their lobby with the
+                route id join_server hands out. Thread engine only.
+            port_workers: Sockets opened per shared port with SO_REUSEPORT, so
+                the kernel spreads receive work over that many threads.
+            empty_lobby_timeout: Seconds a lobby may stay empty, counted from when
+                it emptied or last saw a join, before it is removed.
+            client_timeout: Seconds of silence after which a lobby drops a
+                client, None keeps silent clients forever.
+            heartbeat_interval: Seconds without sending a client anything before
+                its lobby sends a heartbeat, None never sends them.
+            dictionary: Preset dictionary every lobby created with compression
+                starts with, e.g. one trained for the game from captured traffic.
+            capture_dir: Directory every lobby captures its datagrams to, in a
+                file of its own per lobby. None captures nothing.
+        """
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown UDP engine {engine}, expected one of {ENGINES}.")
+        if shared_ports is not None and engine != "thread":
+            raise ValueError("Shared ports are only supported on the thread engine.")
+        self.engine = engine
+        self.batching = batching
+        self.loop = asyncio.get_running_loop() if engine == "asyncio" else None
+        # Request handlers, socket threads and the reaper all touch the registry,
+        # which locks per lobby for writes and lets reads go without locking
+        self.lobbies = LobbyRegistry()
+        self.events = LobbyEvents()
         self.used_ports: Set[int] = set()
-        self.lobby_admins: Dict[str, str] = {}  # Maps lobby_name to admin_id
+        self.ports_lock = threading.Lock()
         self.host = '0.0.0.0'  # Bind to all interfaces (to be replaced)
         self.interface = '127.0.0.1'  # Bind to a specific interface (localhost for example)
-        self.last_activity: Dict[str, float] = {}  # Track last activity time per lobby
-        self.cleanup_thread = threading.Thread(target=self._cleanup_inactive_lobbies, daemon=True)
+        self.router: Optional[SharedPortRouter] = None
+        self.route_counter = itertools.count(1)
+        if shared_ports is not None:
+            self.router = SharedPortRouter(self.host, *shared_ports, workers=port_workers)
+        self.empty_lobby_timeout = empty_lobby_timeout
+        self.client_timeout = client_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.dictionary = dictionary
+        self.capture_dir = capture_dir
+        # Empty lobbies have an expiry deadline on the scheduler, occupied ones none
+        self.scheduler = make_scheduler(self.loop)
         self.running = True
-        self.cleanup_thread.start()
 
-    def _cleanup_inactive_lobbies(self):
-        """Background thread to cleanup empty lobbies after a timeout"""
-        EMPTY_LOBBY_TIMEOUT = 300  # 5 minutes in seconds
-        
-        while self.running:
-            current_time = time.time()
-            
-            # Check each lobby's player count
-            for lobby_id in list(self.servers.keys()):
-                server = self.servers.get(lobby_id)
-                if server and not server.clients:  # Empty lobby
-                    # Only track time when lobby becomes empty
-                    if lobby_id not in self.last_activity:
-                        self.last_activity[lobby_id] = current_time
-                    elif current_time - self.last_activity[lobby_id] > EMPTY_LOBBY_TIMEOUT:
-                        print(f"Removing empty lobby {lobby_id}")
-                        self.remove_server(lobby_id)
-                else:
-                    # Lobby has players, remove from tracking
-                    self.last_activity.pop(lobby_id, None)
-            
-            # Check every 30 seconds
-            time.sleep(30)
-
-    def find_free_port(self) -> int:
-        """Find an available non-reserved port."""
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            s.bind((self.interface, 0))  # Bind to a specific interface and let the OS assign an available port
-            port = s.getsockname()[1]
-            # Ensure the port is not already used in the manager
-            while port in self.used_ports:
-                s.bind((self.interface, 0))
+    def _schedule_expiry(self, entry: LobbyEntry):
+        """(Re)arm an empty lobby's expiry deadline. Called with the lobby's lock held."""
+        self._cancel_expiry(entry)
+        entry.expiry = self.scheduler.call_later(self.empty_lobby_timeout, self._expire_lobby, entry.name)
+
+    def _cancel_expiry(self, entry: LobbyEntry):
+        if entry.expiry is not None:
+            entry.expiry.cancel()
+            entry.expiry = None
+
+    def _on_clients_changed(self, lobby_id: str, server: GameServer):
+        with self.lobbies.lock_for(lobby_id):
+            entry = self.lobbies.get(lobby_id)
+            if entry is None or entry.server is not server:
+                return
+            self._announce_players(entry)
+            if server.clients:
+                self._cancel_expiry(entry)
+            elif entry.expiry is None:
+                entry.last_activity = time.time()
+                self._schedule_expiry(entry)
+
+    def _announce_players(self, entry: LobbyEntry):
+        """Publish who joined, left or changed ready state since last time. Called with the lobby's lock held."""
+        players, ready = frozenset(entry.server.clients), frozenset(entry.server.ready)
+        version = self.lobbies.touch()
+        for player_id in players - entry.players:
+            self.events.publish("player_joined", version, lobby=entry.name, player=player_id)
+        for player_id in entry.players - players:
+            self.events.publish("player_left", version, lobby=entry.name, player=player_id)
+        for player_id in (ready ^ entry.ready) & players:
+            self.events.publish("player_ready", version, lobby=entry.name, player=player_id,
+                                ready=player_id in ready)
+        entry.players, entry.ready = players, ready
+
+    def _expire_lobby(self, lobby_id: str):
+        with self.lobbies.lock_for(lobby_id):
+            entry = self.lobbies.get(lobby_id)
+            # A join may have pushed the deadline out after this timer came due
+            if entry is None or entry.server.clients or entry.expiry is None \
+                    or entry.expiry.deadline > time.monotonic():
+                return
+            print(f"Removing empty lobby {lobby_id}")
+            self._unpublish(entry)
+        self._stop_lobby(entry)
+
+    def reserve_port(self) -> int:
+        """Find an available port no other lobby holds and reserve it."""
+        while True:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                s.bind((self.interface, 0))  # Bind to a specific interface and let the OS assign an available port
                 port = s.getsockname()[1]
-            return port
+            with self.ports_lock:
+                if port not in self.used_ports:
+                    self.used_ports.add(port)
+                    return port
+
+    def release_ports(self, *ports: int):
+        with self.ports_lock:
+            self.used_ports.difference_update(ports)
 
-    def create_server(self, lobby_name: str, admin_id: str):
+    def capture_path(self, lobby_name: str) -> Optional[str]:
+        if self.capture_dir is None:
+            return None
+        os.makedirs(self.capture_dir, exist_ok=True)
+        # Unique per lobby created, as names are reused
+        return os.path.join(self.capture_dir, f"{quote(lobby_name, safe='')}-{time.time_ns()}.cap")
+
+    def create_server(self, lobby_name: str, admin_id: str, tick_rate: Optional[float] = None,
+                      interest_radius: Optional[float] = None, max_players: Optional[int] = None,
+                      jitter_delay: Optional[float] = None, channels: Optional[Dict[int, str]] = None,
+                      compression: bool = False):
         """Create a new game server for a lobby.
-        
+
+        Creating a name that exists, or that another request is creating at
+        the same moment, raises ValueError for all but the first.
+
         Args:
             lobby_name: Name/ID of the lobby
             admin_id: ID of the player who will be admin
+            tick_rate: Snapshot rate in Hz for an authoritative lobby, None relays
+                every update as it arrives
+            interest_radius: Only forward a client's updates to peers within this
+                distance of its position, None forwards them to everyone
+            max_players: Players the lobby takes before joins are refused, None
+                for no limit
+            jitter_delay: Seconds each sender's sequenced updates are buffered to
+                restore their order and pace bursts, None relays them at once
+            channels: Channel number to delivery mode, see GameServer. None for
+                DEFAULT_CHANNELS
+            compression: Compress datagrams to clients that ask for it, starting
+                from the manager's dictionary
         """
-        if lobby_name in self.servers:
-            raise ValueError(f"Lobby {lobby_name} already exists.")
-
-        # Find free ports for reliable and unreliable sockets
-        port_reliable = self.find_free_port()
-        self.used_ports.add(port_reliable)
-
-        port_unreliable = self.find_free_port()
-        self.used_ports.add(port_unreliable)
-        print(f"Found free ports: {port_reliable} (reliable), {port_unreliable} (unreliable)")
-
-        # Create server bound to all interfaces
-        server = GameServer(self.host, port_reliable, port_unreliable)
-        self.servers[lobby_name] = server
-        self.lobby_admins[lobby_name] = admin_id
-        self.last_activity[lobby_name] = time.time()
-        
+        if max_players is not None and max_players < 1:
+            raise ValueError(f"A lobby needs room for at least one player, got {max_players}.")
+        # Held while the sockets are bound, so a racing create of the same name waits and then fails
+        with self.lobbies.lock_for(lobby_name):
+            if lobby_name in self.lobbies:
+                raise ValueError(f"Lobby {lobby_name} already exists.")
+
+            interest = GridInterest(radius=interest_radius) if interest_radius else None
+            options = dict(tick_rate=tick_rate, interest=interest, batching=self.batching,
+                           jitter_delay=jitter_delay, channels=channels,
+                           compression=compression, dictionary=self.dictionary if compression else None,
+                           client_timeout=self.client_timeout,
+                           heartbeat_interval=self.heartbeat_interval,
+                           on_clients_changed=functools.partial(self._on_clients_changed, lobby_name),
+                           capture_path=self.capture_path(lobby_name))
+            route_id = None
+            if self.router is not None:
+                # Every lobby sends from the shared sockets, the router demultiplexes by route id
+                port_reliable, port_unreliable = self.router.reliable_port, self.router.unreliable_port
+                route_id = next(self.route_counter)
+                server = GameServer(self.host, port_reliable, port_unreliable,
+                                    sockets=self.router.send_sockets, **options)
+            else:
+                # Find free ports for reliable and unreliable sockets
+                port_reliable = self.reserve_port()
+                port_unreliable = self.reserve_port()
+                print(f"Found free ports: {port_reliable} (reliable), {port_unreliable} (unreliable)")
+
+                # Create server bound to all interfaces
+                try:
+                    server = GameServer(self.host, port_reliable, port_unreliable, loop=self.loop, **options)
+                except BaseException:
+                    self.release_ports(port_reliable, port_unreliable)
+                    raise
+            entry = LobbyEntry(lobby_name, server, admin_id, route_id, max_players, time.time())
+            self.lobbies.add(entry)
+            if route_id is not None:
+                self.router.register(route_id, server)
+            self.events.publish("lobby_created", self.lobbies.version, lobby=self._describe(entry))
+            # New lobbies start empty, so they expire unless someone joins
+            self._schedule_expiry(entry)
+
         print(f"Lobby {lobby_name} created and started on ports {port_reliable} (reliable), {port_unreliable} (unreliable)")
 
     def join_server(self, lobby_id: str, player_id: str) -> Tuple[int, int]:
@@ -87,46 +223,133 @@ class UDPManager:
         Returns:
             Tuple of (reliable_port, unreliable_port)
         """
-        server = self.servers.get(lobby_id)
-        if not server:
-            raise ValueError(f"Lobby {lobby_id} does not exist.")
-        
-        # Check if player is already in the lobby
-        if player_id in server.clients:
-            raise ValueError(f"Player {player_id} is already in lobby {lobby_id}")
+        with self.lobbies.lock_for(lobby_id):
+            entry = self.lobbies.get(lobby_id)
+            if not entry:
+                raise ValueError(f"Lobby {lobby_id} does not exist.")
+            server = entry.server
 
-        # Set admin status if this player created the lobby
-        is_admin = self.lobby_admins.get(lobby_id) == player_id
-        
-        # Update last activity when player joins
-        self.last_activity[lobby_id] = time.time()
-        
-        # The actual connection will happen via UDP after getting these ports
-        return server.reliable_port, server.unreliable_port
+            # Check if player is already in the lobby
+            if player_id in server.clients:
+                raise ValueError(f"Player {player_id} is already in lobby {lobby_id}")
+            if entry.max_players is not None and len(server.clients) >= entry.max_players:
+                raise ValueError(f"Lobby {lobby_id} is full.")
+
+            # Set admin status if this player created the lobby
+            is_admin = entry.admin_id == player_id
+
+            # Update last activity when player joins
+            self.update_activity(lobby_id)
+
+            # The actual connection will happen via UDP after getting these ports
+            return server.reliable_port, server.unreliable_port
 
     def update_activity(self, lobby_id: str):
         """Update the last activity timestamp for a lobby"""
-        if lobby_id in self.servers:
-            self.last_activity[lobby_id] = time.time()
+        with self.lobbies.lock_for(lobby_id):
+            entry = self.lobbies.get(lobby_id)
+            if entry is not None:
+                entry.last_activity = time.time()
+                # Give a player who is about to connect the full timeout
+                if not entry.server.clients:
+                    self._schedule_expiry(entry)
+
+    def route_of(self, lobby_id: str) -> Optional[int]:
+        """Id clients prefix their packets with on the shared ports, None without them."""
+        entry = self.lobbies.get(lobby_id)
+        return entry.route_id if entry is not None else None
+
+    def has_lobby(self, lobby_id: str) -> bool:
+        return lobby_id in self.lobbies
+
+    def listing_version(self) -> int:
+        """Goes up whenever list_lobbies would return something different."""
+        return self.lobbies.version
+
+    def list_lobbies(self) -> List[dict]:
+        """Describe every lobby as plain data, the form shards report it in."""
+        return [self._describe(entry) for entry in self.lobbies.snapshot().values()]
+
+    def _describe(self, entry: LobbyEntry) -> dict:
+        return {
+            "name": entry.name,
+            "host": entry.server.host,
+            "reliable_port": entry.server.reliable_port,
+            "unreliable_port": entry.server.unreliable_port,
+            "players": list(entry.server.clients),
+            "ready": list(entry.server.ready),
+            "route_id": entry.route_id,
+            "max_players": entry.max_players,
+        }
+
+    def load(self) -> Dict[str, int]:
+        """Totals used to place new lobbies when lobbies are spread over processes."""
+        servers = [entry.server for entry in self.lobbies.snapshot().values()]
+        return {
+            "lobbies": len(servers),
+            "players": sum(len(server.clients) for server in servers),
+            "packets": sum(server.metrics.totals()["packets_in"] for server in servers),
+        }
+
+    def queue_stats(self) -> Dict[str, Dict[str, Dict[str, int]]]:
+        """Send queue depth and drop counters per lobby and channel."""
+        return {lobby_name: entry.server.queue_stats() for lobby_name, entry in self.lobbies.items()}
+
+    def metrics_snapshot(self) -> Dict[str, dict]:
+        """Network counters per lobby, see GameServer.metrics_snapshot."""
+        return {lobby_name: entry.server.metrics_snapshot() for lobby_name, entry in self.lobbies.items()}
+
+    def compression_info(self, lobby_id: str, train: bool = False) -> dict:
+        """A lobby's current dictionary and compression counters, after retraining it if train.
+
+        Raises ValueError for unknown lobbies, lobbies without compression, and
+        training before any traffic was sampled.
+        """
+        entry = self.lobbies.get(lobby_id)
+        if entry is None:
+            raise ValueError(f"Lobby {lobby_id} does not exist.")
+        compressor = entry.server.compressor
+        if compressor is None:
+            raise ValueError(f"Lobby {lobby_id} was created without compression.")
+        if train:
+            compressor.train()
+        dictionary_id, dictionary = compressor.dictionary()
+        return {"dictionary_id": dictionary_id, "dictionary": dictionary, **compressor.stats()}
 
     def remove_server(self, lobby_id: str):
         """Remove a server and clean up its resources."""
-        server = self.servers.pop(lobby_id, None)
-        if server:
-            self.used_ports.discard(server.reliable_port)
-            self.used_ports.discard(server.unreliable_port)
-            self.lobby_admins.pop(lobby_id, None)
-            self.last_activity.pop(lobby_id, None)
-            server.stop()
-            print(f"Lobby {lobby_id} stopped and removed.")
-        else:
-            raise ValueError(f"Lobby {lobby_id} does not exist.")
+        with self.lobbies.lock_for(lobby_id):
+            entry = self.lobbies.get(lobby_id)
+            if not entry:
+                raise ValueError(f"Lobby {lobby_id} does not exist.")
+            self._unpublish(entry)
+        self._stop_lobby(entry)
+
+    def _unpublish(self, entry: LobbyEntry):
+        """Make a lobby unreachable. Called with its lock held."""
+        self.lobbies.pop(entry.name)
+        self.events.publish("lobby_removed", self.lobbies.version, lobby=entry.name)
+        self._cancel_expiry(entry)
+        if entry.route_id is not None:
+            self.router.unregister(entry.route_id)
+
+    def _stop_lobby(self, entry: LobbyEntry):
+        # Stopping joins the lobby's threads, which may be waiting on its lock, so the lock is not held
+        server = entry.server
+        server.stop()
+        if server.owns_sockets:
+            self.release_ports(server.reliable_port, server.unreliable_port)
+        print(f"Lobby {entry.name} stopped and removed.")
 
     def stop_all_servers(self):
-        """Stop all servers and cleanup thread."""
+        """Stop all servers and the reaper."""
         self.running = False
-        if self.cleanup_thread.is_alive():
-            self.cleanup_thread.join()
-        for server_id in list(self.servers.keys()):
-            self.remove_server(server_id)
+        self.scheduler.stop()
+        for server_id in list(self.lobbies):
+            try:
+                self.remove_server(server_id)
+            except ValueError:
+                pass  # Removed by a request that raced the shutdown
+        if self.router is not None:
+            self.router.stop()
         print("All servers stopped and removed.")